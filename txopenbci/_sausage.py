@@ -11,13 +11,16 @@ from twisted.python.failure import Failure
 
 from ometa.tube import TrampolinedParser
 
+from .metrics import REGISTRY, SIZE_BUCKETS, timer
 
-def makeProtocol(source, sender, receiver, bindings=None, name='Grammar'):
+
+def makeProtocol(source, sender, receiver, bindings=None, name='Grammar',
+                 framers=None, metrics=None):
     if bindings is None:
         bindings = {}
     grammar = OMeta(source).parseGrammar(name)
     return functools.partial(
-        ParserProtocol, grammar, sender, receiver, bindings)
+        ParserProtocol, grammar, sender, receiver, bindings, framers, metrics)
 
 
 class ParserProtocol(Protocol):
@@ -26,7 +29,8 @@ class ParserProtocol(Protocol):
     """
 
 
-    def __init__(self, grammar, sender, receiver, bindings):
+    def __init__(self, grammar, sender, receiver, bindings, framers=None,
+                 metrics=None):
         """
         Initialize the parser.
 
@@ -34,15 +38,31 @@ class ParserProtocol(Protocol):
         :param sender: A sender with setTransport & stopFlow.
         :param receiver: A receiver with prepareParsing & finishParsing.
         :param bindings: A dict of additional globals for the grammar rules.
+        :param framers: (optional) A dict mapping rule names to factories
+            which take the receiver and return an object with ``receive`` and
+            ``pending``. Those rules are handled by the framer instead of
+            the grammar.
+        :param metrics: (optional) the `txopenbci.metrics.Registry` to count
+            bytes and time parsing in; by default, the global one.
         """
 
+        if metrics is None:
+            metrics = REGISTRY
+        self._bytesReceived = metrics.counter(
+            'txopenbci_serial_bytes_total', "Bytes read from the device.")
+        self._chunkBytes = metrics.histogram(
+            'txopenbci_serial_read_bytes', "Bytes in each read from the "
+            "device.", SIZE_BUCKETS)
+        self._parseSeconds = metrics.histogram(
+            'txopenbci_parse_seconds', "Seconds spent handling each read from "
+            "the device, including everything done with the samples in it.")
         self._grammar = grammar
         self._bindings = dict(bindings)
         self.sender = sender
         self.receiver = receiver
         self._disconnecting = False
         self._parser = SwitchingTrampolinedParser(
-            self._grammar, self.receiver, self._bindings)
+            self._grammar, self.receiver, self._bindings, framers)
 
     def connectionMade(self):
         """
@@ -62,8 +82,12 @@ class ParserProtocol(Protocol):
         if self._disconnecting:
             return
 
+        self._bytesReceived.inc(len(data))
+        self._chunkBytes.observe(len(data))
+        start = timer()
         try:
             self._parser.receive(data)
+            self._parseSeconds.observe(timer() - start)
         except Exception:
             # TODO: rethink parser-exception handling. Even if we're treating
             # the error as unrecoverable, we still may want to send a
@@ -93,15 +117,73 @@ class ParserProtocol(Protocol):
         self._disconnecting = True
 
 
+class _FramedRule(object):
+    """
+    Stands in for the grammar interpreter while a framer handles the rule.
+
+    `TrampolinedParser.receive` hands it the data, and, as it never asks
+    for more, takes the rule to have finished with no input left over; so
+    it calls ``_setupInterp`` again, which keeps this framer while the rule
+    stays the same.
+    """
+
+    def __init__(self, framer):
+        self.framer = framer
+        self.input = _NoInput()
+
+
+    def receive(self, data):
+        self.framer.receive(data)
+
+
+
+class _NoInput(object):
+    data = ()
+    position = 0
+
+
+
 class SwitchingTrampolinedParser(TrampolinedParser):
+    """
+    A TrampolinedParser that follows ``receiver.currentRule``.
+
+    Rules with an entry in ``framers`` bypass the grammar interpreter
+    entirely; everything else is parsed by the grammar as usual.
+    """
+
+    _interp = None
+    _framer = None
+    _currentRule = None
+
+    def __init__(self, grammar, receiver, bindings, framers=None):
+        self.framers = dict(framers or {})
+        TrampolinedParser.__init__(self, grammar, receiver, bindings)
+
+
     def _setupInterp(self):
-        self._currentRule = self.receiver.currentRule
-        return TrampolinedParser._setupInterp(self)
+        if self._framer is not None and self._framer.pending:
+            # the rule can't change partway through a frame.
+            return
+        rule = self.receiver.currentRule
+        framerFactory = self.framers.get(rule)
+        if framerFactory is None:
+            self._framer = None
+            self._currentRule = rule
+            return TrampolinedParser._setupInterp(self)
+        if self._framer is None or rule != self._currentRule:
+            self._framer = framerFactory(self.receiver)
+            self._interp = _FramedRule(self._framer)
+        self._currentRule = rule
+
+
+    def _hasPendingInput(self):
+        if self._framer is not None:
+            return bool(self._framer.pending)
+        return bool(self._interp.input.data)
 
 
     def receive(self, data):
         if self.receiver.currentRule != self._currentRule:
-            if not self._interp.input.data:
+            if not self._hasPendingInput():
                 self._setupInterp()
-
-        return TrampolinedParser.receive(self, data)
+        TrampolinedParser.receive(self, data)
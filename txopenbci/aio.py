@@ -0,0 +1,530 @@
+# -*- coding: utf-8 -*-
+"""
+Samples for asyncio programs, from the board itself or from a txOpenBCI
+daemon, without running a reactor::
+
+    async with aio.DeviceSession('/dev/ttyUSB0') as session:
+        await session.start_stream()
+        async for block in session:
+            ...
+
+`DeviceSession` talks to the board over a serial port with
+pyserial-asyncio, and decodes its stream with `txopenbci.protocol` as
+`control.DeviceReceiver` does, running indices and timestamps included.
+`DaemonSession` reads the binary ``stream`` of a running daemon instead
+(see `web.BinaryBlockFeed`), so several programs can share one board.
+Either way, each step of the iteration is a `ring.SampleBlock`.
+
+This needs Python 3.5 or later. It's written with futures and asyncio's
+protocol callbacks rather than ``async def``, so that the rest of the
+package still compiles on Python 2, where this module imports but can't be
+used.
+"""
+import base64
+from collections import deque
+
+try:
+    import asyncio
+except ImportError as e:
+    asyncio = None
+    asyncio_reason = e
+else:
+    asyncio_reason = None
+
+try:
+    import serial_asyncio
+except ImportError as e:
+    serial_asyncio = None
+    serial_asyncio_reason = e
+else:
+    serial_asyncio_reason = None
+
+from . import protocol, wire
+from .ring import SampleBlock
+from .timing import ClockModel, CounterUnwrapper
+
+
+DAEMON_PORT = 8088
+
+
+class DaemonError(IOError):
+    """The daemon didn't answer a request as it should have."""
+
+
+
+def _runningLoop():
+    getLoop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+    return getLoop()
+
+
+def _resolved(loop, value=None):
+    future = loop.create_future()
+    future.set_result(value)
+    return future
+
+
+def _then(loop, awaitable, callback):
+    """
+    Call ``callback`` with the result of ``awaitable``, as a Deferred's
+    callback would be.
+
+    :returns: a future of what ``callback`` returns; if that's a future
+        itself, of its result in turn.
+    """
+    result = loop.create_future()
+
+    def passOn(future):
+        if result.cancelled():
+            return
+        if future.cancelled():
+            result.cancel()
+        elif future.exception() is not None:
+            result.set_exception(future.exception())
+        else:
+            result.set_result(future.result())
+
+    def done(future):
+        if result.cancelled():
+            return
+        if future.cancelled() or future.exception() is not None:
+            passOn(future)
+            return
+        try:
+            value = callback(future.result())
+        except Exception as e:
+            result.set_exception(e)
+            return
+        if asyncio.isfuture(value):
+            value.add_done_callback(passOn)
+        else:
+            result.set_result(value)
+
+    asyncio.ensure_future(awaitable, loop=loop).add_done_callback(done)
+    return result
+
+
+
+class _Session(object):
+    """
+    The asyncio protocol, async context manager and async iterator that the
+    sessions share.
+
+    Blocks that arrive while no one is waiting for them queue up. Past
+    ``maxQueuedBlocks``, the transport stops reading, so the queue doesn't
+    grow without bound, until the reader catches up to half that.
+
+    :ivar loop: the event loop; by default, the one running when the
+        session is entered.
+    :ivar transport: the connection, while there is one.
+    """
+
+    maxQueuedBlocks = 250
+    transport = None
+
+    def __init__(self, loop=None):
+        self.loop = loop
+        self._blocks = deque()
+        self._waiting = None
+        self._paused = False
+        # once the connection's gone, why: None if it was closed cleanly.
+        self._lost = False
+        self._reason = None
+
+
+    def _connect(self):
+        """
+        :returns: a future that's done when the session is ready to use.
+        """
+        raise NotImplementedError()
+
+
+    def __aenter__(self):
+        if self.loop is None:
+            self.loop = _runningLoop()
+        return _then(self.loop, self._connect(), lambda _: self)
+
+
+    def __aexit__(self, excType, excValue, traceback):
+        if self.transport is not None:
+            self.transport.close()
+        return _resolved(self.loop, False)
+
+
+    def __aiter__(self):
+        return self
+
+
+    def __anext__(self):
+        future = self.loop.create_future()
+        if self._blocks:
+            future.set_result(self._blocks.popleft())
+            if (self._paused and self.transport is not None and
+                    len(self._blocks) <= self.maxQueuedBlocks // 2):
+                self._paused = False
+                self.transport.resume_reading()
+        elif self._lost:
+            future.set_exception(self._reason or StopAsyncIteration())
+        else:
+            self._waiting = future
+        return future
+
+
+    def _deliver(self, block):
+        waiting, self._waiting = self._waiting, None
+        if waiting is not None and not waiting.done():
+            waiting.set_result(block)
+            return
+        self._blocks.append(block)
+        if (not self._paused and self.transport is not None and
+                len(self._blocks) >= self.maxQueuedBlocks):
+            self._paused = True
+            self.transport.pause_reading()
+
+
+    # == asyncio protocol ==
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+
+    def connection_lost(self, reason):
+        self.transport = None
+        self._lost = True
+        self._reason = reason
+        waiting, self._waiting = self._waiting, None
+        if waiting is not None and not waiting.done():
+            waiting.set_exception(reason or StopAsyncIteration())
+
+
+    def eof_received(self):
+        pass
+
+
+    def pause_writing(self):
+        pass
+
+
+    def resume_writing(self):
+        pass
+
+
+
+class DeviceSession(_Session):
+    """
+    A board on a serial port.
+
+    Entering the session opens the port and resets the board.
+
+    :ivar currentRule: ``idle`` while the board's answering a command,
+        ``sample`` once it's been asked to stream.
+    :ivar samplesReceived: how many samples have arrived.
+    :ivar samplesLost: how many samples the packet counter says went
+        missing.
+    :ivar gaps: how many times samples went missing.
+    """
+
+    currentRule = 'idle'
+
+    def __init__(self, port, baudrate=protocol.BAUD_RATE, loop=None):
+        """
+        :param port: the serial port's name, or a pySerial URL.
+        """
+        _Session.__init__(self, loop)
+        self.port = port
+        self.baudrate = baudrate
+        self.framer = protocol.ResynchronizingFramer(self)
+        self.unwrapper = CounterUnwrapper()
+        self.clockModel = ClockModel()
+        self.samplesReceived = 0
+        self.samplesLost = 0
+        self.gaps = 0
+        self._response = bytearray()
+        self._responseWaiting = None
+
+
+    @property
+    def corruptFrames(self):
+        return self.framer.corruptFrames
+
+
+    def _connect(self):
+        if serial_asyncio is None:
+            raise RuntimeError("could not load serial_asyncio: %s" %
+                               (serial_asyncio_reason,))
+        connecting = serial_asyncio.create_serial_connection(
+            self.loop, lambda: self, self.port, baudrate=self.baudrate)
+        return _then(self.loop, connecting, lambda _: self.reset())
+
+
+    def __aexit__(self, excType, excValue, traceback):
+        if self.transport is not None and self.currentRule == 'sample':
+            self.transport.write(protocol.CMD_STREAM_STOP)
+        return _Session.__aexit__(self, excType, excValue, traceback)
+
+
+    def reset(self):
+        """
+        Reset the board.
+
+        :returns: a future of its answer, up to the ``$$$`` it ends with.
+        """
+        self.currentRule = 'idle'
+        self._response = bytearray()
+        self._responseWaiting = self.loop.create_future()
+        self.transport.write(protocol.CMD_RESET)
+        return self._responseWaiting
+
+
+    def start_stream(self):
+        """
+        Ask the board to stream samples.
+
+        :returns: a future that's already done, for symmetry with
+            `DaemonSession`.
+        """
+        self.currentRule = 'sample'
+        self.unwrapper.forget()
+        self.transport.write(protocol.CMD_STREAM_START)
+        return _resolved(self.loop)
+
+
+    def stop_stream(self):
+        """
+        Ask the board to stop streaming. Samples already on their way still
+        arrive.
+
+        :returns: a future that's already done.
+        """
+        self.transport.write(protocol.CMD_STREAM_STOP)
+        return _resolved(self.loop)
+
+
+    def data_received(self, data):
+        if self.currentRule == 'sample':
+            self.framer.receive(data)
+            return
+        self._response += data
+        end = self._response.find(b'$$$')
+        if end == -1:
+            return
+        response = bytes(self._response[:end])
+        self._response = bytearray()
+        waiting, self._responseWaiting = self._responseWaiting, None
+        if waiting is not None and not waiting.done():
+            waiting.set_result(response)
+
+
+    def connection_lost(self, reason):
+        waiting, self._responseWaiting = self._responseWaiting, None
+        if waiting is not None and not waiting.done():
+            waiting.set_exception(reason or EOFError("Port closed."))
+        _Session.connection_lost(self, reason)
+
+
+    # == from the framer ==
+
+    def handleFrames(self, buf, count, offset=0):
+        counter, eeg, accelerometer = protocol.decodeSamples(
+            buf, count, offset)
+        self.samplesReceived += count
+        index, gaps = self.unwrapper.unwrap(counter)
+        for position, missing in gaps:
+            self.samplesLost += missing
+            self.gaps += 1
+        self._deliver(SampleBlock(counter, eeg, accelerometer,
+                                  self.clockModel.timestamps(index), index))
+
+
+    def handleCorruptData(self, discarded):
+        pass
+
+
+
+class _Response(object):
+    """Collect the whole of one HTTP/1.0 response, and its status."""
+
+    def __init__(self, request, done):
+        self.request = request
+        self.done = done
+        self.data = bytearray()
+
+
+    def connection_made(self, transport):
+        transport.write(self.request)
+
+
+    def data_received(self, data):
+        self.data += data
+
+
+    def eof_received(self):
+        pass
+
+
+    def connection_lost(self, reason):
+        if self.done.done():
+            return
+        if reason is not None:
+            self.done.set_exception(reason)
+        else:
+            self.done.set_result(_status(bytes(self.data)))
+
+
+    def pause_writing(self):
+        pass
+
+
+    def resume_writing(self):
+        pass
+
+
+
+def _status(response):
+    """
+    :returns: the status code of an HTTP response, or 0 if it hasn't one.
+    """
+    parts = response.split(b'\r\n', 1)[0].split()
+    try:
+        return int(parts[1])
+    except (IndexError, ValueError):
+        return 0
+
+
+
+class DaemonSession(_Session):
+    """
+    A board, by way of the daemon serving it.
+
+    Entering the session subscribes to the daemon's binary stream of the
+    board's samples. The blocks come ``fps`` times a second, without
+    timestamps.
+
+    Starting and stopping the stream starts and stops it for everyone
+    using the board; leaving the session leaves it as it was.
+    """
+
+    def __init__(self, host='localhost', port=DAEMON_PORT, device=None,
+                 fps=10, loop=None):
+        """
+        :param device: (optional) which of the daemon's boards; by default,
+            the one it serves at the top level.
+        :param fps: (optional) how many blocks to get a second.
+        """
+        _Session.__init__(self, loop)
+        self.host = host
+        self.port = port
+        self.fps = fps
+        if device is None:
+            self.prefix = '/'
+        else:
+            self.prefix = '/devices/%s/' % (device,)
+        self._headers = bytearray()
+        self._events = bytearray()
+        self._ready = None
+
+
+    def _request(self, method, path, body=b'', headers=()):
+        lines = ['%s %s%s HTTP/1.0' % (method, self.prefix, path),
+                 'Host: %s:%d' % (self.host, self.port)]
+        lines.extend(headers)
+        if body:
+            lines.append('Content-Length: %d' % (len(body),))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('ascii') + body
+
+
+    def _connect(self):
+        self._ready = self.loop.create_future()
+        connecting = self.loop.create_connection(lambda: self, self.host,
+                                                 self.port)
+        return _then(self.loop, connecting, lambda _: self._ready)
+
+
+    def connection_made(self, transport):
+        _Session.connection_made(self, transport)
+        transport.write(self._request(
+            'GET', 'stream?format=binary&fps=%d' % (self.fps,),
+            headers=['Accept: text/event-stream']))
+
+
+    def data_received(self, data):
+        if self._headers is not None:
+            self._headers += data
+            end = self._headers.find(b'\r\n\r\n')
+            if end == -1:
+                return
+            data = bytes(self._headers[end + 4:])
+            status = _status(bytes(self._headers[:end]))
+            self._headers = None
+            if status != 200:
+                self._ready.set_exception(DaemonError(
+                    "The daemon's stream answered %d" % (status,)))
+                self.transport.close()
+                return
+            self._ready.set_result(None)
+        self._events += data
+        while True:
+            end = self._events.find(b'\n\n')
+            if end == -1:
+                break
+            event = bytes(self._events[:end])
+            del self._events[:end + 2]
+            self._handleEvent(event)
+
+
+    def _handleEvent(self, event):
+        name = None
+        data = []
+        for line in event.split(b'\n'):
+            field, _, value = line.partition(b':')
+            if value.startswith(b' '):
+                value = value[1:]
+            if field == b'event':
+                name = value
+            elif field == b'data':
+                data.append(value)
+        if name == b'sensorBlock':
+            self._deliver(wire.unpackBlock(
+                base64.b64decode(b''.join(data))))
+
+
+    def connection_lost(self, reason):
+        if self._ready is not None and not self._ready.done():
+            self._ready.set_exception(
+                reason or DaemonError("The daemon hung up."))
+        _Session.connection_lost(self, reason)
+
+
+    def _command(self, command):
+        done = self.loop.create_future()
+        body = ('command=%s' % (command,)).encode('ascii')
+        request = self._request(
+            'POST', 'control', body,
+            headers=['Content-Type: application/x-www-form-urlencoded'])
+        connecting = self.loop.create_connection(
+            lambda: _Response(request, done), self.host, self.port)
+
+        def check(status):
+            if status != 202:
+                raise DaemonError("The daemon answered %d to %s" %
+                                  (status, command))
+
+        return _then(self.loop, _then(self.loop, connecting,
+                                      lambda _: done), check)
+
+
+    def start_stream(self):
+        """
+        Ask the daemon to have the board stream.
+
+        :returns: a future that's done once the daemon's taken the command.
+        """
+        return self._command('start')
+
+
+    def stop_stream(self):
+        """
+        Ask the daemon to have the board stop streaming.
+
+        :returns: a future that's done once the daemon's taken the command.
+        """
+        return self._command('stop')
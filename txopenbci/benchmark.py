@@ -0,0 +1,518 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput, latency and allocation measurements for the sample stream hot
+paths, with and without numpy.
+
+Run with ``python -m txopenbci.benchmark``; add ``--json results.json`` to
+keep the numbers for comparing releases.
+"""
+import argparse
+from array import array
+from cStringIO import StringIO
+import gc
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+from ometa.grammar import OMeta
+from twisted.internet.task import Clock
+from twisted.internet.defer import Deferred
+
+from . import dsp, metrics, protocol, recording, shm, spectral, wire
+from .compressed import CompressedWriter
+from ._sausage import SwitchingTrampolinedParser
+from .control import DeviceReceiver
+from .fixtures import fixture
+from .offload import slotSize, writeSlot
+from .ring import SampleBlock
+from .sink import SensorLog, BinarySensorLog, ThreadedLog, TimingWatchdog
+from .web import JSONFeed, BinaryBlockFeed
+
+
+IMPLEMENTATION = 'numpy' if protocol.numpy else 'python'
+
+
+class NullReceiver(object):
+    currentRule = 'sample'
+    count = 0
+
+    def handleSample(self, counter, sample):
+        self.count += 1
+
+    def handleFrames(self, buf, count, offset=0):
+        self.count += count
+
+    def handleCorruptData(self, discarded):
+        pass
+
+
+
+class NullSource(object):
+    """Somewhere for a feed to subscribe, that never sends anything."""
+
+    def subscribeToSampleBlocks(self, listener):
+        pass
+
+    def unsubscribeFromSampleBlocks(self, listener):
+        pass
+
+
+
+class _NullTransport(object):
+    disconnected = False
+
+
+
+class NullRequest(object):
+    """Just enough of a request for `web.EventFanOut`, to throw data away."""
+
+    def __init__(self):
+        self.transport = _NullTransport()
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def notifyFinish(self):
+        return Deferred()
+
+
+
+def replicatedStream(packets, name='stream_16samples'):
+    """
+    Repeat a fixture until it holds at least ``packets`` sample packets.
+    """
+    data = fixture(name)
+    perFixture = len(data) // protocol.SAMPLE_SIZE
+    return data * (-(-packets // perFixture))
+
+
+def chunked(data, chunkSize):
+    return [data[i:i + chunkSize] for i in range(0, len(data), chunkSize)]
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def measure(call, items):
+    """
+    Time ``call`` on each of ``items``.
+
+    :param items: ``(argument, samples)`` pairs, where ``samples`` is how
+        many samples the call handles.
+    :returns: a dict of ``samples``, ``seconds``, ``samplesPerSecond``,
+        ``latency`` and ``gcObjectsPerSample``.
+
+    The latency of a sample is the time taken by the call that handled it,
+    in microseconds. ``gcObjectsPerSample`` is the net growth in objects
+    tracked by the garbage collector, which is collected beforehand and
+    disabled meanwhile: near zero unless something is being kept. (Python 2
+    has no way to count short-lived allocations.)
+    """
+    timings = []
+    samples = 0
+    gc.collect()
+    gc.disable()
+    try:
+        objectsBefore = len(gc.get_objects())
+        start = default_timer()
+        for argument, count in items:
+            callStart = default_timer()
+            call(argument)
+            timings.append((default_timer() - callStart, count))
+            samples += count
+        elapsed = default_timer() - start
+        # less the timings themselves.
+        objects = len(gc.get_objects()) - objectsBefore - len(timings)
+    finally:
+        gc.enable()
+
+    latencies = []
+    for seconds, count in timings:
+        latencies.extend([seconds * 1e6] * count)
+    latencies.sort()
+    return {
+        'samples': samples,
+        'seconds': elapsed,
+        'samplesPerSecond': samples / elapsed if elapsed else None,
+        'latency': dict(
+            [(name, percentile(latencies, fraction) if latencies else None)
+             for name, fraction in [('p50', 0.5), ('p90', 0.9),
+                                    ('p99', 0.99), ('max', 1.0)]]),
+        'gcObjectsPerSample': float(objects) / samples if samples else None,
+    }
+
+
+def syntheticBlocks(settings):
+    """
+    Blocks of noisy rhythms, like EEG. The fixture repeats every 16
+    samples, which would flatter a compressor.
+    """
+    rng = random.Random(0)
+    packetsPerChunk = max(1, settings.chunk_size // protocol.SAMPLE_SIZE)
+    offsets = [rng.randint(-2 ** 20, 2 ** 20) for channel in range(8)]
+    items = []
+    for start in range(0, settings.packets, packetsPerChunk):
+        count = min(packetsPerChunk, settings.packets - start)
+        eeg = []
+        for i in range(start, start + count):
+            alpha = 2000 * math.sin(2 * math.pi * 10 * i / 250.0)
+            eeg.append(array('l', [int(offset + alpha + rng.gauss(0, 50))
+                                   for offset in offsets]))
+        block = SampleBlock(
+            array('B', [i % 256 for i in range(start, start + count)]), eeg,
+            [array('h', [0, 0, 0]) for i in range(count)],
+            array('d', [1.4e9 + i / 250.0 for i in range(start, start + count)]))
+        if protocol.numpy:
+            numpy = protocol.numpy
+            block = SampleBlock(numpy.array(block.counter, 'u1'),
+                                numpy.array(block.eeg, 'i4'),
+                                numpy.array(block.accelerometer, 'i2'),
+                                numpy.array(block.timestamp, 'f8'))
+        items.append((block, count))
+    return items
+
+
+# == Stages ==
+# Each takes the benchmark settings and returns a callable and the items
+# to feed it, as for `measure`; and optionally a callable returning more
+# results, to call after the measurement.
+
+def packetChunks(settings, packets=None):
+    """Chunks of the stream, each of whole packets."""
+    packetsPerChunk = max(1, settings.chunk_size // protocol.SAMPLE_SIZE)
+    data = replicatedStream(packets or settings.packets)
+    return [(chunk, len(chunk) // protocol.SAMPLE_SIZE)
+            for chunk in chunked(data, packetsPerChunk * protocol.SAMPLE_SIZE)]
+
+
+def byteChunks(settings, packets=None):
+    """Chunks of the stream as they might come from the serial port."""
+    data = replicatedStream(packets or settings.packets)
+    return [(chunk, len(chunk) // protocol.SAMPLE_SIZE)
+            for chunk in chunked(data, settings.chunk_size)]
+
+
+def blocks(settings):
+    return [(SampleBlock(*protocol.decodeSamples(chunk)), count)
+            for chunk, count in packetChunks(settings)]
+
+
+def stageGrammar(settings):
+    grammar = OMeta(protocol.grammar).parseGrammar("OpenBCIDevice")
+    parser = SwitchingTrampolinedParser(grammar, NullReceiver(), {})
+    return parser.receive, byteChunks(settings, settings.grammar_packets)
+
+
+def stageFramer(settings):
+    return (protocol.ResynchronizingFramer(NullReceiver()).receive,
+            byteChunks(settings))
+
+
+def stageDecodeSingle(settings):
+    def decode(chunk):
+        for offset in range(0, len(chunk), protocol.SAMPLE_SIZE):
+            protocol.int32From3Bytes(chunk, 8, offset + 2)
+            protocol.accelerometerFromBytes(chunk, offset + 26)
+    return decode, packetChunks(settings)
+
+
+def stageDecodeBatch(settings):
+    return protocol.decodeSamples, packetChunks(settings)
+
+
+def stageDecodeReference(settings):
+    """
+    The Python decoder from before it worked on whole buffers, to compare
+    decode-N with.
+    """
+    return protocol._reference_decodeSamples, packetChunks(settings)
+
+
+def stageReceiver(settings, metrics=metrics.REGISTRY):
+    """Decoding, the ring, and handing blocks to one subscriber."""
+    receiver = DeviceReceiver(None, metrics=metrics)
+    receiver.subscribeToSampleBlocks(lambda block: None)
+    def receive(chunk):
+        receiver.handleFrames(chunk, len(chunk) // protocol.SAMPLE_SIZE)
+    return receive, packetChunks(settings)
+
+
+def stageReceiverUnmetered(settings):
+    """The same, without metrics, to see what they cost."""
+    return stageReceiver(settings, metrics.DISABLED)
+
+
+def stageSensorLog(settings):
+    return SensorLog().handleBlock, blocks(settings)
+
+
+def stageBinarySensorLog(settings):
+    return BinarySensorLog().handleBlock, blocks(settings)
+
+
+def stageThreadedLog(settings):
+    """What the reactor thread does for a `ThreadedLog`: only queueing."""
+    threaded = ThreadedLog(SensorLog(), maxQueuedSamples=settings.packets)
+    return threaded.handleBlock, blocks(settings)
+
+
+def stageOffload(settings):
+    """
+    What the reactor thread does for an `OffloadedSubscriber`: packing each
+    block into shared memory for a worker.
+    """
+    items = blocks(settings)
+    largest = max(count for block, count in items)
+    buf = multiprocessing.RawArray('c', slotSize(largest))
+    return (lambda block: writeSlot(buf, 0, block)), items
+
+
+def stageSharedRing(settings):
+    """Publishing blocks in shared memory, for other processes to read."""
+    ring = shm.publish('benchmark-%d' % (os.getpid(),))
+    # it stays mapped; no one else needs to find it.
+    os.unlink(ring.path)
+    return ring.write, blocks(settings)
+
+
+def stageCompressed(settings):
+    """
+    Compressing samples, in memory. Also reports the size against a binary
+    recording of the same samples.
+    """
+    output = StringIO()
+    writer = CompressedWriter(output, 1.4e9, level=settings.zlib_level)
+    items = syntheticBlocks(settings)
+
+    def compressionRatio():
+        writer._compress()
+        samples = sum(count for block, count in items)
+        return {'compressionRatio':
+                float(samples * recording.RECORD_SIZE) / output.tell()}
+    return ((lambda block: writer.writeBlock(block, block.timestamp)), items,
+            compressionRatio)
+
+
+def stageWatchdog(settings):
+    return TimingWatchdog().handleBlock, blocks(settings)
+
+
+def _feedStage(feed, settings, send):
+    for i in range(settings.subscribers):
+        feed.add(NullRequest())
+    def handleBlock(block):
+        feed.handleBlock(block)
+        send()
+        feed.clock.advance(0)
+    return handleBlock, blocks(settings)
+
+
+def stageStreamJSON(settings):
+    feed = JSONFeed(NullSource(), Clock())
+    return _feedStage(feed, settings, lambda: None)
+
+
+def stageStreamBinary(settings):
+    feed = BinaryBlockFeed(NullSource(), Clock(), 10)
+    # send every block, rather than waiting on the clock.
+    return _feedStage(feed, settings, feed.sendFrame)
+
+
+def stageDownsample(settings):
+    return dsp.Downsampler(4, 'mean').process, blocks(settings)
+
+
+def stageFilter(settings):
+    return dsp.Pipeline(dsp.defaultFilters()).process, blocks(settings)
+
+
+def stageSpectrum(settings):
+    return spectral.SpectralEngine().handleBlock, blocks(settings)
+
+
+def stageWire(settings):
+    return (lambda block: wire.packBlocks([block])), blocks(settings)
+
+
+STAGES = [
+    ('grammar', stageGrammar),
+    ('framer', stageFramer),
+    ('decode-1', stageDecodeSingle),
+    ('decode-N', stageDecodeBatch),
+    ('decode-ref', stageDecodeReference),
+    ('receiver', stageReceiver),
+    ('receiver-bare', stageReceiverUnmetered),
+    ('sensorlog', stageSensorLog),
+    ('binarylog', stageBinarySensorLog),
+    ('threadedlog', stageThreadedLog),
+    ('offload', stageOffload),
+    ('sharedring', stageSharedRing),
+    ('compressed', stageCompressed),
+    ('watchdog', stageWatchdog),
+    ('wire', stageWire),
+    ('stream-json', stageStreamJSON),
+    ('stream-binary', stageStreamBinary),
+    ('downsample', stageDownsample),
+    ('filter', stageFilter),
+    ('spectrum', stageSpectrum),
+]
+
+
+def run(settings):
+    """
+    Run the stages in this process, with whichever implementation it has.
+
+    :returns: a list of result dicts, as from `measure` with ``stage`` and
+        ``implementation`` added.
+    """
+    results = []
+    # the logs write to the current directory.
+    workdir = tempfile.mkdtemp(prefix='txopenbci-benchmark-')
+    cwd = os.getcwd()
+    try:
+        for name, stage in STAGES:
+            if settings.stages and name not in settings.stages:
+                continue
+            stageResult = stage(settings)
+            os.chdir(workdir)
+            try:
+                result = measure(*stageResult[:2])
+                if len(stageResult) > 2:
+                    result.update(stageResult[2]())
+            finally:
+                os.chdir(cwd)
+            result['stage'] = name
+            result['implementation'] = IMPLEMENTATION
+            results.append(result)
+    finally:
+        shutil.rmtree(workdir)
+    return results
+
+
+# what the child process runs to benchmark the pure-Python paths.
+_WITHOUT_NUMPY = """
+import sys
+sys.modules['numpy'] = None
+from txopenbci.benchmark import main
+main(sys.argv[1:])
+"""
+
+
+def runWithoutNumpy(argv):
+    """
+    Run the stages in a child process that can't import numpy.
+    """
+    env = dict(os.environ)
+    packageParent = os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [packageParent] + filter(None, [env.get('PYTHONPATH')]))
+    output = subprocess.check_output(
+        [sys.executable, '-c', _WITHOUT_NUMPY] + argv +
+        ['--implementations', 'python', '--json', '-', '--quiet'], env=env)
+    return json.loads(output)['results']
+
+
+def report(result):
+    latency = result['latency']
+    line = ("%-14s %-6s %9d samples %11.0f samples/s  "
+            "p50 %8.1fus  p99 %8.1fus  %6.2f objects/sample" %
+            (result['stage'], result['implementation'], result['samples'],
+             result['samplesPerSecond'], latency['p50'], latency['p99'],
+             result['gcObjectsPerSample']))
+    if 'compressionRatio' in result:
+        line += "  %.2fx smaller" % (result['compressionRatio'],)
+    print(line)
+
+
+def makeParser():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--packets', type=int, default=200000,
+                        help="packets to feed to each stage")
+    parser.add_argument('--grammar-packets', type=int, default=20000,
+                        help="packets to feed to the grammar, which is "
+                             "much slower")
+    parser.add_argument('--chunk-size', type=int, default=1024,
+                        help="bytes per dataReceived call")
+    parser.add_argument('--zlib-level', type=int, default=1,
+                        help="compression level for the compressed stage")
+    parser.add_argument('--subscribers', type=int, default=10,
+                        help="clients of the stream stages")
+    parser.add_argument('--stages', type=lambda s: s.split(','),
+                        default=None,
+                        help="comma-separated stages to run, out of: " +
+                             ', '.join(name for name, stage in STAGES))
+    parser.add_argument('--implementations', type=lambda s: s.split(','),
+                        default=['numpy', 'python'],
+                        help="numpy, python, or both (the default)")
+    parser.add_argument('--json', metavar='FILE',
+                        help="write results as JSON to FILE ('-' for "
+                             "standard output)")
+    parser.add_argument('--quiet', action='store_true',
+                        help="don't print the table")
+    return parser
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    settings = makeParser().parse_args(argv)
+
+    results = []
+    if 'numpy' in settings.implementations and protocol.numpy:
+        results.extend(run(settings))
+    if 'python' in settings.implementations:
+        if IMPLEMENTATION == 'python':
+            results.extend(run(settings))
+        else:
+            # pass everything on, but the options the child sets itself.
+            childArgv = []
+            skip = False
+            for arg in argv:
+                if skip:
+                    skip = False
+                elif arg in ('--implementations', '--json'):
+                    skip = True
+                elif arg != '--quiet':
+                    childArgv.append(arg)
+            results.extend(runWithoutNumpy(childArgv))
+
+    if not settings.quiet:
+        for result in results:
+            report(result)
+
+    if settings.json:
+        document = {
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': getattr(protocol.numpy, '__version__', None),
+            'settings': vars(settings),
+            'results': results,
+        }
+        if settings.json == '-':
+            json.dump(document, sys.stdout, indent=1, sort_keys=True)
+        else:
+            with open(settings.json, 'w') as output:
+                json.dump(document, output, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
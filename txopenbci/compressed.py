@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*-
+"""
+Compressed sensor recordings, with an index for reading any stretch of time
+without decompressing the rest.
+
+Samples are gathered into blocks of about a second and each block is
+compressed separately with zlib. Within a block the columns are stored one
+after another: each EEG channel as its first value and then the
+differences between consecutive values, which are small; and every column
+byte-shuffled, all the values' first bytes, then all their second bytes,
+and so on, which puts the mostly-constant high bytes together for zlib::
+
+    MAGIC
+    uint32 header length
+    header: JSON, as for `txopenbci.recording`, with ``samplesPerBlock``
+        and ``level``
+    blocks, each:
+        uint32  compressed length
+        uint32  sample count
+        float64 first timestamp, last timestamp
+        zlib data:
+            uint8   counter[count]
+            int32   eeg[8][count], delta-encoded, shuffled
+            int16   accelerometer[3][count], shuffled
+            float64 timestamp[count], shuffled
+    index, written on closing:
+        per block: uint64 offset, uint32 count, float64 first, last
+    uint64 index offset
+    uint32 block count
+    INDEX_MAGIC
+
+All values are little-endian. A recording that was never closed has no
+index, but the block headers carry everything it would, so readers find
+the blocks by walking from one to the next.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+import json
+import os
+from struct import Struct
+import sys
+import zlib
+
+try:
+    import numpy
+except ImportError as e:
+    numpy = None
+    numpy_reason = e
+else:
+    numpy_reason = None
+
+from .recording import FIELDS, recordDtype
+from .ring import SampleBlock, EEG_CHANNELS, ACCELEROMETER_AXES
+
+
+MAGIC = b'txOBCIz\n'
+INDEX_MAGIC = b'txOBCIi\n'
+VERSION = 1
+
+_headerLength = Struct('<I')
+_blockHeader = Struct('<IIdd')
+_indexEntry = Struct('<QIdd')
+_trailer = Struct('<QI')
+_bigEndian = sys.byteorder == 'big'
+
+
+
+class BlockInfo(object):
+    """
+    Where a compressed block is, and what it covers.
+    """
+    __slots__ = ['offset', 'count', 'first', 'last']
+
+    def __init__(self, offset, count, first, last):
+        self.offset = offset
+        self.count = count
+        self.first = first
+        self.last = last
+
+
+    def __repr__(self):
+        return 'BlockInfo(%d, %d, %r, %r)' % (self.offset, self.count,
+                                              self.first, self.last)
+
+
+
+# == Encoding blocks ==
+
+def numpy_encodeBlock(pieces):
+    """
+    Lay out the samples of several ``(block, timestamps)`` pairs as one
+    block, ready to compress.
+
+    :rtype: bytes
+    """
+    counter = numpy.concatenate([numpy.asarray(block.counter, 'u1')
+                                 for block, timestamps in pieces])
+    eeg = numpy.concatenate([numpy.asarray(block.eeg, 'i4')
+                             for block, timestamps in pieces]).T
+    accelerometer = numpy.concatenate(
+        [numpy.asarray(block.accelerometer, 'i2')
+         for block, timestamps in pieces]).T
+    timestamp = numpy.concatenate([numpy.asarray(timestamps, 'f8')
+                                   for block, timestamps in pieces])
+    deltas = eeg.copy()
+    # wrapping round, as around the gap marker, and back again on reading.
+    deltas[:, 1:] = numpy.diff(eeg, axis=1)
+    return b''.join([counter.tobytes(),
+                     _numpyShuffle(deltas, '<i4'),
+                     _numpyShuffle(accelerometer, '<i2'),
+                     _numpyShuffle(timestamp, '<f8')])
+
+
+def _numpyShuffle(values, dtype):
+    dtype = numpy.dtype(dtype)
+    return (numpy.ascontiguousarray(values, dtype).view('u1')
+            .reshape(-1, dtype.itemsize).T.tobytes())
+
+
+def _numpyUnshuffle(data, dtype, count, offset):
+    dtype = numpy.dtype(dtype)
+    size = count * dtype.itemsize
+    planes = numpy.frombuffer(data, 'u1', size, offset)
+    values = planes.reshape(dtype.itemsize, count).T.copy().view(dtype)
+    return values.ravel(), offset + size
+
+
+def numpy_decodeBlock(data, count):
+    """
+    Decode the output of encodeBlock.
+
+    :rtype: SampleBlock
+    """
+    counter = numpy.frombuffer(data, 'u1', count).copy()
+    deltas, offset = _numpyUnshuffle(data, '<i4', count * EEG_CHANNELS,
+                                     count)
+    eeg = numpy.cumsum(deltas.reshape(EEG_CHANNELS, count), axis=1,
+                       dtype='i4').T.copy()
+    accelerometer, offset = _numpyUnshuffle(
+        data, '<i2', count * ACCELEROMETER_AXES, offset)
+    accelerometer = accelerometer.reshape(ACCELEROMETER_AXES, count).T.astype(
+        'i2')
+    timestamp, offset = _numpyUnshuffle(data, '<f8', count, offset)
+    return SampleBlock(counter, eeg, accelerometer, timestamp.astype('f8'))
+
+
+def _wrap32(value):
+    return ((value + 2 ** 31) & 0xFFFFFFFF) - 2 ** 31
+
+
+def _pythonShuffle(values):
+    if _bigEndian:
+        values.byteswap()
+    data = values.tostring()
+    size = values.itemsize
+    return b''.join([data[i::size] for i in range(size)])
+
+
+def _pythonUnshuffle(data, typecode, count, offset):
+    values = array(typecode)
+    size = values.itemsize
+    end = offset + count * size
+    interleaved = bytearray(count * size)
+    for i in range(size):
+        interleaved[i::size] = data[offset + i * count:offset +
+                                    (i + 1) * count]
+    values.fromstring(bytes(interleaved))
+    if _bigEndian:
+        values.byteswap()
+    return values, end
+
+
+def python_encodeBlock(pieces):
+    """
+    Lay out the samples of several ``(block, timestamps)`` pairs as one
+    block, ready to compress.
+
+    :rtype: bytes
+    """
+    counter = array('B')
+    eegRows = []
+    accelerometer = [array('h') for axis in range(ACCELEROMETER_AXES)]
+    timestamp = array('d')
+    for block, timestamps in pieces:
+        counter.extend(block.counter)
+        eegRows.extend(block.eeg)
+        for row in block.accelerometer:
+            for axis in range(ACCELEROMETER_AXES):
+                accelerometer[axis].append(row[axis])
+        timestamp.extend(timestamps)
+    deltas = array('i')
+    for column in zip(*eegRows):
+        deltas.append(column[0])
+        deltas.extend([_wrap32(b - a) for a, b in zip(column, column[1:])])
+    allAccelerometer = array('h')
+    for column in accelerometer:
+        allAccelerometer.extend(column)
+    return b''.join([counter.tostring(),
+                     _pythonShuffle(deltas),
+                     _pythonShuffle(allAccelerometer),
+                     _pythonShuffle(timestamp)])
+
+
+def python_decodeBlock(data, count):
+    """
+    Decode the output of encodeBlock.
+
+    :rtype: SampleBlock
+    """
+    counter = array('B', data[:count])
+    deltas, offset = _pythonUnshuffle(data, 'i', count * EEG_CHANNELS, count)
+    columns = []
+    for channel in range(EEG_CHANNELS):
+        column = []
+        value = 0
+        for delta in deltas[channel * count:(channel + 1) * count]:
+            value = _wrap32(value + delta)
+            column.append(value)
+        columns.append(column)
+    accelerometer, offset = _pythonUnshuffle(
+        data, 'h', count * ACCELEROMETER_AXES, offset)
+    timestamp, offset = _pythonUnshuffle(data, 'd', count, offset)
+    return SampleBlock(
+        counter,
+        [array('l', row) for row in zip(*columns)],
+        [array('h', accelerometer[i::count]) for i in range(count)],
+        timestamp)
+
+
+if numpy:
+    encodeBlock = numpy_encodeBlock
+    decodeBlock = numpy_decodeBlock
+else:
+    encodeBlock = python_encodeBlock
+    decodeBlock = python_decodeBlock
+
+
+
+# == Files ==
+
+class CompressedWriter(object):
+    """
+    Write samples to a compressed recording.
+
+    Samples are kept in memory until there are ``samplesPerBlock`` of them,
+    then compressed and written as a block. So a recording that's never
+    closed loses the last block's worth.
+    """
+
+    def __init__(self, fileobj, time0, samplesPerBlock=250, level=1):
+        """
+        :param fileobj: a file opened for binary writing.
+        :param time0: the time the recording began, seconds since the epoch.
+        :param level: how hard zlib should try, from 1 (fastest) to 9.
+        """
+        self.fileobj = fileobj
+        self.samplesPerBlock = samplesPerBlock
+        self.level = level
+        self.index = []
+        self._pieces = []
+        self._buffered = 0
+        header = json.dumps({
+            'version': VERSION,
+            'fields': FIELDS,
+            'time0': time0,
+            'samplesPerBlock': samplesPerBlock,
+            'level': level,
+        })
+        fileobj.write(MAGIC + _headerLength.pack(len(header)) + header)
+        self._offset = fileobj.tell()
+
+
+    def writeBlock(self, block, timestamps):
+        """
+        :type block: txopenbci.ring.SampleBlock
+        :param timestamps: a sequence with the time of each sample in the
+            block.
+        """
+        if not len(block):
+            return
+        if numpy and isinstance(block.eeg, numpy.ndarray):
+            timestamps = numpy.array(timestamps, 'f8')
+        else:
+            timestamps = array('d', timestamps)
+        self._pieces.append((block.copy(), timestamps))
+        self._buffered += len(block)
+        if self._buffered >= self.samplesPerBlock:
+            self._compress()
+
+
+    def _compress(self):
+        if not self._pieces:
+            return
+        data = zlib.compress(encodeBlock(self._pieces), self.level)
+        first = float(self._pieces[0][1][0])
+        last = float(self._pieces[-1][1][-1])
+        info = BlockInfo(self._offset, self._buffered, first, last)
+        self.fileobj.write(_blockHeader.pack(len(data), info.count, first,
+                                             last) + data)
+        self.index.append(info)
+        self._offset += _blockHeader.size + len(data)
+        self._pieces = []
+        self._buffered = 0
+
+
+    def flush(self):
+        """
+        Hand the blocks written so far to the operating system. Samples not
+        yet making up a block stay in memory.
+        """
+        self.fileobj.flush()
+
+
+    def close(self):
+        """
+        Write out what's left, and the index.
+        """
+        self._compress()
+        self.fileobj.write(b''.join(
+            [_indexEntry.pack(info.offset, info.count, info.first, info.last)
+             for info in self.index]))
+        self.fileobj.write(_trailer.pack(self._offset, len(self.index)) +
+                           INDEX_MAGIC)
+        self.fileobj.close()
+
+
+
+def readHeader(fileobj):
+    """
+    Read the header from the start of a compressed recording.
+
+    :returns: the header dict, with ``dataOffset`` added.
+    :raises ValueError: if this is not a recording we understand.
+    """
+    magic = fileobj.read(len(MAGIC))
+    if magic != MAGIC:
+        raise ValueError("Not a compressed txOpenBCI recording: %r" % (magic,))
+    (length,) = _headerLength.unpack(fileobj.read(_headerLength.size))
+    header = json.loads(fileobj.read(length))
+    if header['version'] > VERSION:
+        raise ValueError("Recording version %s is newer than %s" %
+                         (header['version'], VERSION))
+    header['dataOffset'] = len(MAGIC) + _headerLength.size + length
+    return header
+
+
+
+class CompressedRecording(object):
+    """
+    A compressed recording, open for reading.
+
+    :ivar header: the recording's header dict.
+    :ivar index: a list with a `BlockInfo` for each block.
+    """
+
+    def __init__(self, filename):
+        self.fileobj = open(filename, 'rb')
+        self.header = readHeader(self.fileobj)
+        self.index = self._readIndex()
+        self._firsts = [info.first for info in self.index]
+
+
+    def _readIndex(self):
+        fileobj = self.fileobj
+        size = os.fstat(fileobj.fileno()).st_size
+        tail = _trailer.size + len(INDEX_MAGIC)
+        if size - tail >= self.header['dataOffset']:
+            fileobj.seek(size - tail)
+            offset, count = _trailer.unpack(fileobj.read(_trailer.size))
+            if fileobj.read(len(INDEX_MAGIC)) == INDEX_MAGIC:
+                fileobj.seek(offset)
+                data = fileobj.read(count * _indexEntry.size)
+                return [BlockInfo(*_indexEntry.unpack_from(
+                    data, i * _indexEntry.size)) for i in range(count)]
+        return self._scan(size)
+
+
+    def _scan(self, size):
+        """
+        Find the blocks of a recording that has no index, leaving out any
+        partly-written block at the end.
+        """
+        index = []
+        offset = self.header['dataOffset']
+        while offset + _blockHeader.size <= size:
+            self.fileobj.seek(offset)
+            length, count, first, last = _blockHeader.unpack(
+                self.fileobj.read(_blockHeader.size))
+            end = offset + _blockHeader.size + length
+            if end > size:
+                break
+            index.append(BlockInfo(offset, count, first, last))
+            offset = end
+        return index
+
+
+    def __len__(self):
+        return sum(info.count for info in self.index)
+
+
+    def close(self):
+        self.fileobj.close()
+
+
+    def readBlock(self, info):
+        """
+        :type info: BlockInfo
+        :rtype: txopenbci.ring.SampleBlock
+        """
+        self.fileobj.seek(info.offset)
+        length, count, first, last = _blockHeader.unpack(
+            self.fileobj.read(_blockHeader.size))
+        return decodeBlock(zlib.decompress(self.fileobj.read(length)), count)
+
+
+    def blocks(self, start=None, stop=None):
+        """
+        The samples taken from ``start`` up to ``stop``, as blocks; only the
+        blocks covering that time are read.
+
+        :param start: (optional) seconds since the epoch.
+        :param stop: (optional) likewise.
+        :returns: an iterator of SampleBlocks, with timestamps.
+        """
+        # blocks are in time order, so bisect for the ones that could hold
+        # samples in range: from the last starting at or before ``start``,
+        # up to the first starting at or after ``stop``.
+        begin, end = 0, len(self.index)
+        if start is not None:
+            begin = max(0, bisect_right(self._firsts, start) - 1)
+        if stop is not None:
+            end = bisect_left(self._firsts, stop)
+        for number in range(begin, end):
+            info = self.index[number]
+            if start is not None and info.last < start:
+                continue
+            block = self.readBlock(info)
+            timestamp = block.timestamp
+            first, last = 0, len(block)
+            if start is not None and info.first < start:
+                while first < last and timestamp[first] < start:
+                    first += 1
+            if stop is not None and info.last >= stop:
+                while last > first and timestamp[last - 1] >= stop:
+                    last -= 1
+            if first or last < len(block):
+                block = block.slice(first, last)
+            if len(block):
+                yield block
+
+
+    def read(self, start=None, stop=None):
+        """
+        The samples taken from ``start`` up to ``stop``, as one numpy
+        structured array with the fields of `txopenbci.recording.FIELDS`.
+        """
+        if numpy is None:
+            raise RuntimeError("Reading recordings as arrays needs numpy: %s"
+                               % (numpy_reason,))
+        blocks = list(self.blocks(start, stop))
+        records = numpy.empty(sum(len(block) for block in blocks),
+                              recordDtype(self.header['fields']))
+        position = 0
+        for block in blocks:
+            end = position + len(block)
+            records['counter'][position:end] = block.counter
+            records['eeg'][position:end] = block.eeg
+            records['accelerometer'][position:end] = block.accelerometer
+            records['timestamp'][position:end] = block.timestamp
+            position = end
+        return records
@@ -12,20 +12,27 @@ Players:
 * those who listen, and record
 * those who listen, and display
 """
+from collections import OrderedDict
 import os
+import random
 
-from twisted.application.service import Service
+from twisted.application.service import Service, MultiService
 from twisted.internet.endpoints import connectProtocol
+from twisted.internet.task import LoopingCall
 from twisted.internet.error import ConnectionClosed
 from twisted.python import log
 
 from ._sausage import makeProtocol
 from . import protocol
+from .metrics import REGISTRY, timer
+from .ring import RawSample, SampleBlock, SampleRing
+from .spectral import SpectralSource
+from .timing import ClockModel, CounterUnwrapper
 
 
 try:
     import numpy
-except ImportError, e:
+except ImportError as e:
     numpy = None
     numpy_reason = e
 else:
@@ -63,28 +70,87 @@ class DeviceSender(object):
         self._write(protocol.CMD_STREAM_STOP)
 
 
-class RawSample(object):
-    __slots__ = ['counter', 'eeg', 'accelerometer']
+class Gap(object):
+    """
+    Some samples that never arrived.
 
-    def __init__(self, counter, eeg, accelerometer):
-        self.counter = counter
-        self.eeg = eeg
-        self.accelerometer = accelerometer
+    :ivar start: the running index of the first lost sample.
+    :ivar length: how many were lost.
+    """
+    __slots__ = ['start', 'length']
+
+    def __init__(self, start, length):
+        self.start = start
+        self.length = length
+
+    def __repr__(self):
+        return 'Gap(%d, %d)' % (self.start, self.length)
 
-    def __hash__(self):
-        return hash((self.counter, self.eeg, self.accelerometer))
 
 
 class DeviceReceiver(object):
+    """
+    :ivar samplesReceived: how many samples have arrived.
+    :ivar samplesLost: how many samples the packet counter says went
+        missing.
+    :ivar gaps: how many times samples went missing.
+    :ivar largestGap: the most samples lost at once.
+    :ivar corruptFrames: how many times the framing of the stream went wrong
+        and had to be found again.
+    :ivar bytesDiscarded: how many bytes were thrown away doing that.
+    """
     currentRule = 'idle'
 
-    def __init__(self, commander):
+    def __init__(self, commander, ringCapacity=None, fillGaps=False,
+                 metrics=None):
         """
         :type commander: DeviceCommander
+        :param ringCapacity: (optional) how many recent samples to keep.
+        :param fillGaps: (optional) whether to put a row in the ring for each
+            lost sample, so rows in the ring line up with sample indices.
+            See `SampleBlock.fillGaps`.
+        :param metrics: (optional) the `txopenbci.metrics.Registry` to keep
+            counts in; by default, the global one.
         """
         self.commander = commander
+        self.fillGaps = fillGaps
         self._debugLog = None
         self._sampleSubscribers = set()
+        self._blockSubscribers = {}
+        self._gapSubscribers = set()
+        if ringCapacity is None:
+            self.ring = SampleRing()
+        else:
+            self.ring = SampleRing(ringCapacity)
+        self.samplesReceived = 0
+        self.samplesLost = 0
+        self.gaps = 0
+        self.largestGap = 0
+        self.corruptFrames = 0
+        self.bytesDiscarded = 0
+        self.unwrapper = CounterUnwrapper()
+        self.clockModel = ClockModel()
+        if metrics is None:
+            metrics = REGISTRY
+        self._decodeSeconds = metrics.histogram(
+            'txopenbci_decode_seconds', "Seconds spent decoding, timestamping "
+            "and storing each batch of sample packets.")
+        self._samplesMetric = metrics.counter(
+            'txopenbci_samples_total', "Samples received.")
+        self._lostMetric = metrics.counter(
+            'txopenbci_samples_lost_total', "Samples the packet counter says "
+            "went missing.")
+        self._gapsMetric = metrics.counter(
+            'txopenbci_gaps_total', "Times samples went missing.")
+        self._corruptMetric = metrics.counter(
+            'txopenbci_corrupt_frames_total', "Times the framing of the stream "
+            "went wrong and had to be found again.")
+        self._discardedMetric = metrics.counter(
+            'txopenbci_discarded_bytes_total', "Bytes thrown away finding the "
+            "framing again.")
+        metrics.gauge(
+            'txopenbci_sample_rate_hz', "Samples per second, by the host "
+            "clock.", function=lambda: 1.0 / self.clockModel.samplePeriod)
 
 
     def logIncoming(self, data):
@@ -97,6 +163,8 @@ class DeviceReceiver(object):
     def handleResponse(self, content):
         log.msg("device response:")
         log.msg(content)
+        if self.commander is not None:
+            self.commander.deviceReady()
         # sw33t hacks to capture some debug data
         # log.msg("entering debug dump mode")
         # self.currentRule = 'debug'
@@ -106,13 +174,58 @@ class DeviceReceiver(object):
 
 
     def handleSample(self, counter, sample):
-        # TODO: handle wrapping counter
-        # TODO: handle skipped packets
-        if self._sampleSubscribers:
-            eeg = protocol.int32From3Bytes(sample, 8, 0)
-            accelerometer = protocol.accelerometerFromBytes(sample, 24)
-            sample = RawSample(counter, eeg, accelerometer)
-            self._publishSample(sample)
+        # A single packet from the grammar; put the framing back on so it
+        # can take the same path as everything from the framer.
+        frame = (protocol.SAMPLE_START + chr(counter) + sample +
+                 protocol.SAMPLE_END)
+        self.handleFrames(frame, 1)
+
+
+    def handleFrames(self, buf, count, offset=0):
+        """
+        Handle ``count`` whole sample packets at once, from the framer.
+        """
+        start = timer()
+        counter, eeg, accelerometer = protocol.decodeSamples(
+            buf, count, offset)
+        self.samplesReceived += count
+        self._samplesMetric.inc(count)
+        index, gaps = self.unwrapper.unwrap(counter)
+        block = SampleBlock(counter, eeg, accelerometer, None, index)
+        if gaps:
+            for position, missing in gaps:
+                self._noteGap(Gap(int(index[position]) - missing, missing))
+            if self.fillGaps:
+                block = block.fillGaps()
+        block.timestamp = self.clockModel.timestamps(block.index)
+        self.ring.write(block)
+        self._decodeSeconds.observe(timer() - start)
+        # listeners may unsubscribe as we go.
+        for deliver in list(self._blockSubscribers.values()):
+            deliver()
+
+
+    def handleCorruptData(self, discarded):
+        """
+        The framer has got past a bad frame, throwing ``discarded`` bytes
+        away.
+        """
+        self.corruptFrames += 1
+        self.bytesDiscarded += discarded
+        self._corruptMetric.inc()
+        self._discardedMetric.inc(discarded)
+        log.msg("Bad sample frame; skipped %d bytes to recover" %
+                (discarded,))
+
+
+    def _noteGap(self, gap):
+        self.samplesLost += gap.length
+        self.gaps += 1
+        self.largestGap = max(self.largestGap, gap.length)
+        self._lostMetric.inc(gap.length)
+        self._gapsMetric.inc()
+        for listener in list(self._gapSubscribers):
+            listener(gap)
 
 
     def _publishSample(self, sample):
@@ -124,13 +237,87 @@ class DeviceReceiver(object):
     # == Interfaces for subscribers ==
 
     def subscribeToSampleData(self, listener):
+        """
+        :param listener: called with each RawSample.
+        """
+        if not self._sampleSubscribers:
+            self.subscribeToSampleBlocks(self._publishBlockSamples)
         self._sampleSubscribers.add(listener)
 
 
+    def _publishBlockSamples(self, block):
+        for sample in block.samples():
+            self._publishSample(sample)
+
+
+    def subscribeToSampleBlocks(self, listener, backfill=0):
+        """
+        :param listener: called with each new SampleBlock. These are views
+            into ``self.ring``; copy anything you need to keep.
+        :param backfill: (optional) number of recent samples from the ring to
+            give the listener right away.
+        :returns: the RingCursor tracking this listener's position.
+        """
+        cursor = self.ring.cursor(backfill)
+
+        def deliver():
+            for block in cursor.read():
+                listener(block)
+
+        self._blockSubscribers[listener] = deliver
+        if cursor.pending():
+            deliver()
+        return cursor
+
+
+    def unsubscribeFromSampleBlocks(self, listener):
+        """
+        Stop sending blocks to a listener given to `subscribeToSampleBlocks`.
+        """
+        self._blockSubscribers.pop(listener, None)
+
+
+    def subscribeToGaps(self, listener):
+        """
+        :param listener: called with a `Gap` whenever samples go missing,
+            before the samples after the gap are delivered.
+        """
+        self._gapSubscribers.add(listener)
+
+
+    def unsubscribeFromGaps(self, listener):
+        self._gapSubscribers.discard(listener)
+
+
+    def stats(self):
+        """
+        :returns: a dict of ``samples`` (received), ``samplesLost``,
+            ``gaps``, ``largestGap``, ``lossRatio`` (lost out of all that
+            were sent), ``corruptFrames``, ``bytesDiscarded``,
+            ``nextIndex`` and ``samplePeriod`` (as estimated by the clock
+            model).
+        """
+        sent = self.samplesReceived + self.samplesLost
+        return {
+            'samples': self.samplesReceived,
+            'samplesLost': self.samplesLost,
+            'gaps': self.gaps,
+            'largestGap': self.largestGap,
+            'lossRatio': float(self.samplesLost) / sent if sent else 0.0,
+            'corruptFrames': self.corruptFrames,
+            'bytesDiscarded': self.bytesDiscarded,
+            'nextIndex': self.unwrapper.nextIndex,
+            'samplePeriod': self.clockModel.samplePeriod,
+        }
+
+
     # prepareParsing and finishParsing are not called from the grammar, but
     # from the ParserProtocol, as connection-related events.
 
     def prepareParsing(self, parser):
+        # a new stream; its counter won't follow on from the last one's.
+        self.unwrapper.forget()
+        self.clockModel.reset()
         self.commander.deviceOpen()
 
 
@@ -140,33 +327,74 @@ class DeviceReceiver(object):
 
 
 class DeviceCommander(object):
+    """
+    :ivar streaming: whether we've asked the board to stream, so that it
+        can be asked again after a reconnect.
+    """
 
     _senderFactory = DeviceSender
     _connecting = None
+    streaming = False
 
-    def __init__(self):
+    def __init__(self, metrics=None):
+        """
+        :param metrics: (optional) the `txopenbci.metrics.Registry` for the
+            receiver and protocol to keep counts in.
+        """
         self.client = None
         self.sender = DeviceSender()
-        self.receiver = DeviceReceiver(self)
+        self.receiver = DeviceReceiver(self, metrics=metrics)
+        self._lostListeners = set()
         self._protocolClass = makeProtocol(
             protocol.grammar, self.sender, self.receiver,
-            name="OpenBCIDevice")
+            name="OpenBCIDevice",
+            framers={'sample': protocol.ResynchronizingFramer},
+            metrics=metrics)
 
     def connect(self, endpoint):
+        """
+        Connect to the device. If it can't be done, that is only logged.
+
+        :returns: a Deferred that fires with the protocol once connected, or
+            with None if the connection can't be made.
+        """
+        d = self.attemptConnection(endpoint)
+        # already logged by _connectFailed.
+        d.addErrback(lambda reason: None)
+        return d
+
+    def attemptConnection(self, endpoint):
+        """
+        Connect to the device, for callers who want to know when it fails,
+        as `DeviceService` does to try again.
+
+        :returns: a Deferred that fires with the protocol once connected, or
+            fails if the connection can't be made.
+        """
         if self.client:
             raise RuntimeError("Already connected to %s" % (self.client,))
         if self._connecting:
             raise RuntimeError("Connection already in progress.")
-        self._connecting = connectProtocol(endpoint, self._protocolClass())
-        self._connecting.addCallbacks(self._setClient, self._connectFailed)
+        d = self._connecting = connectProtocol(endpoint, self._protocolClass())
+        d.addCallbacks(self._setClient, self._connectFailed)
+        return d
 
     def _setClient(self, client):
         self.client = client
         self._connecting = None
+        return client
 
     def _connectFailed(self, reason):
         log.msg(reason.getErrorMessage())
         self._connecting = None
+        return reason
+
+    def subscribeToDeviceLost(self, listener):
+        """
+        :param listener: called with the reason whenever the connection to
+            the device is lost.
+        """
+        self._lostListeners.add(listener)
 
 
     # == Events we get from DeviceReceiver ==
@@ -177,6 +405,14 @@ class DeviceCommander(object):
         self.sender.reset()
 
 
+    def deviceReady(self):
+        # The board has answered the reset. If it was streaming before a
+        # reconnect, pick up where it left off.
+        if self.streaming and self.receiver.currentRule != 'sample':
+            log.msg("Resuming stream.")
+            self.startStream()
+
+
     def deviceLost(self, reason):
         if not reason.check(ConnectionClosed):
             log.msg("Parser error: %s" % (reason.getErrorMessage(),))
@@ -185,6 +421,10 @@ class DeviceCommander(object):
             log.msg("Receiver finished: %s" % (reason.getErrorMessage(),))
 
         self.client = None
+        # a new connection starts with the reset response.
+        self.receiver.currentRule = 'idle'
+        for listener in list(self._lostListeners):
+            listener(reason)
 
 
     # == Outward-facing commands: ==
@@ -202,11 +442,13 @@ class DeviceCommander(object):
 
 
     def startStream(self):
+        self.streaming = True
         self.receiver.currentRule = 'sample'
         self.sender.start_stream()
 
 
     def stopStream(self):
+        self.streaming = False
         self.sender.stop_stream()
         # TODO: set currentRule back once stream actually ends
 
@@ -216,18 +458,223 @@ class DeviceCommander(object):
 
 
 class DeviceService(Service):
-
-    def __init__(self, endpoint):
+    """
+    Keep a device connected for as long as the service runs.
+
+    When the connection can't be made or is lost, it's tried again after a
+    delay that grows by ``factor`` with each failure, up to ``maxDelay``,
+    with some random ``jitter`` so many devices don't all retry at once.
+    The new connection resets the board as the first did, and the stream is
+    restarted if it was running.
+
+    :ivar connections: how many times the device has been connected.
+    :ivar retries: how many times in a row connecting has failed.
+    :ivar downtime: the total seconds spent disconnected after having been
+        connected.
+    :ivar lastDowntime: the seconds the latest reconnect took.
+    :ivar metrics: the `txopenbci.metrics.Registry` for everything to do
+        with this device.
+    :ivar spectra: the device's `txopenbci.spectral.SpectralSource`, for
+        everyone who wants its spectra to share.
+    """
+
+    initialDelay = 0.5
+    maxDelay = 30.0
+    factor = 2.0
+    # as a fraction of the delay: the standard deviation of its spread.
+    jitter = 0.1
+
+    def __init__(self, endpoint, clock=None, metrics=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        if metrics is None:
+            metrics = REGISTRY
         self.endpoint = endpoint
-        self.commander = DeviceCommander()
+        self.clock = clock
+        self.metrics = metrics
+        self.commander = DeviceCommander(metrics)
+        self.commander.subscribeToDeviceLost(self._deviceLost)
+        self.spectra = SpectralSource(self.commander.receiver, clock)
+        self.connections = 0
+        self.retries = 0
+        self.downtime = 0.0
+        self.lastDowntime = None
+        self._downSince = None
+        self._retryCall = None
+        self._delay = self.initialDelay
+        self._connectionsMetric = metrics.counter(
+            'txopenbci_connections_total', "Times the device was connected.")
+        self._downtimeMetric = metrics.counter(
+            'txopenbci_downtime_seconds_total', "Seconds spent reconnecting "
+            "after losing the device.")
 
     def startService(self):
         log.msg("Starting service.")
         if numpy_reason:
             log.msg("Note: numpy is not available: %s" % (numpy_reason,))
         Service.startService(self)
-        self.commander.connect(self.endpoint)
+        self._connect()
 
     def stopService(self):
-        self.commander.destroy()
         Service.stopService(self)
+        if self._retryCall is not None and self._retryCall.active():
+            self._retryCall.cancel()
+        self._retryCall = None
+        self.commander.destroy()
+
+    def stats(self):
+        """
+        :returns: a dict of ``connections``, ``retries``, ``downtime``,
+            ``lastDowntime`` and ``downFor`` (seconds since the connection
+            was lost, if it is down now).
+        """
+        downFor = None
+        if self._downSince is not None and self.connections:
+            downFor = self.clock.seconds() - self._downSince
+        return {
+            'connections': self.connections,
+            'retries': self.retries,
+            'downtime': self.downtime,
+            'lastDowntime': self.lastDowntime,
+            'downFor': downFor,
+        }
+
+    def _connect(self):
+        self._retryCall = None
+        if self._downSince is None:
+            self._downSince = self.clock.seconds()
+        d = self.commander.attemptConnection(self.endpoint)
+        d.addCallbacks(self._connected, self._connectFailed)
+
+    def _connected(self, client):
+        if self.connections:
+            self.lastDowntime = self.clock.seconds() - self._downSince
+            self.downtime += self.lastDowntime
+            self._downtimeMetric.inc(self.lastDowntime)
+            log.msg("Reconnected after %.1f seconds." % (self.lastDowntime,))
+        self._downSince = None
+        self.connections += 1
+        self._connectionsMetric.inc()
+        self.retries = 0
+        self._delay = self.initialDelay
+
+    def _connectFailed(self, reason):
+        if self.running:
+            self.retries += 1
+            self._retryLater()
+
+    def _deviceLost(self, reason):
+        if self.running:
+            self._downSince = self.clock.seconds()
+            self._retryLater()
+
+    def _retryLater(self):
+        delay = self._delay
+        self._delay = min(self._delay * self.factor, self.maxDelay)
+        if self.jitter:
+            delay = max(0, random.normalvariate(delay, delay * self.jitter))
+        log.msg("Connecting again in %.1f seconds." % (delay,))
+        self._retryCall = self.clock.callLater(delay, self._connect)
+
+
+
+class DeviceRegistry(MultiService):
+    """
+    Look after any number of devices in one process.
+
+    Each device gets a `DeviceService`, named by its ID.
+
+    :ivar devices: an ordered dict of DeviceService by device ID.
+    """
+
+    statsInterval = 1.0
+
+    def __init__(self, clock=None):
+        MultiService.__init__(self)
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.devices = OrderedDict()
+        self._deviceListeners = set()
+        self._stats = {}
+        self._lastCounts = {}
+        self._lastStatsTime = None
+        self._statsLoop = LoopingCall(self._updateStats)
+        self._statsLoop.clock = clock
+
+
+    def addDevice(self, deviceId, endpoint):
+        """
+        Add a device, connecting to it right away if the registry is running.
+
+        :rtype: DeviceService
+        """
+        if deviceId in self.devices:
+            raise KeyError("Already have a device %r" % (deviceId,))
+        device = DeviceService(endpoint, self.clock,
+                               REGISTRY.labelled(device=deviceId))
+        device.setName(deviceId)
+        device.setServiceParent(self)
+        self.devices[deviceId] = device
+        for listener in list(self._deviceListeners):
+            listener(deviceId, device)
+        return device
+
+
+    def getDevice(self, deviceId):
+        """
+        :rtype: DeviceService
+        :raises KeyError: if there's no such device.
+        """
+        return self.devices[deviceId]
+
+
+    def subscribeToDevices(self, listener):
+        """
+        :param listener: called with the ID and DeviceService of every device,
+            now for those already here and later for any that are added.
+        """
+        self._deviceListeners.add(listener)
+        for deviceId, device in self.devices.items():
+            listener(deviceId, device)
+
+
+    def stats(self):
+        """
+        Throughput of each device, as of the last update.
+
+        :returns: a dict by device ID of dicts with ``connected`` and
+            ``samplesPerSecond``, the loss statistics from
+            `DeviceReceiver.stats`, and the connection statistics from
+            `DeviceService.stats`.
+        """
+        stats = {}
+        for deviceId, device in self.devices.items():
+            stats[deviceId] = deviceStats = device.commander.receiver.stats()
+            deviceStats.update(device.stats())
+            deviceStats['connected'] = device.commander.client is not None
+            deviceStats['samplesPerSecond'] = self._stats.get(deviceId, 0.0)
+        return stats
+
+
+    def _updateStats(self):
+        now = self.clock.seconds()
+        for deviceId, device in self.devices.items():
+            count = device.commander.receiver.samplesReceived
+            lastCount = self._lastCounts.get(deviceId)
+            if lastCount is not None and now > self._lastStatsTime:
+                self._stats[deviceId] = (
+                    (count - lastCount) / (now - self._lastStatsTime))
+            self._lastCounts[deviceId] = count
+        self._lastStatsTime = now
+
+
+    def startService(self):
+        MultiService.startService(self)
+        self._statsLoop.start(self.statsInterval)
+
+
+    def stopService(self):
+        if self._statsLoop.running:
+            self._statsLoop.stop()
+        return MultiService.stopService(self)
@@ -0,0 +1,589 @@
+# -*- coding: utf-8 -*-
+"""
+Processing of sample blocks on their way from the receiver to consumers.
+
+Everything here keeps whatever state it needs between blocks, so a stream
+can be fed through in pieces of any size and come out the same as if it had
+been processed all at once.
+"""
+from array import array
+import math
+
+try:
+    import numpy
+except ImportError as e:
+    numpy = None
+    numpy_reason = e
+else:
+    numpy_reason = None
+
+from .protocol import SAMPLE_RATE
+from .ring import SampleBlock
+
+
+DOWNSAMPLE_MODES = ('decimate', 'mean', 'minmax')
+
+
+class _Downsampler(object):
+    """
+    Reduce the sample rate of a stream by ``factor``.
+
+    The stream is cut into buckets of ``factor`` samples, and each bucket
+    becomes:
+
+    * ``decimate``: its first sample.
+    * ``mean``: the mean of its samples, rounded to the nearest count if the
+      samples are counts.
+    * ``minmax``: two rows, holding the minimum and maximum of each
+      channel, for drawing an envelope.
+
+    Output rows carry the counter and timestamp of the first sample of their
+    bucket.
+    Samples that don't fill a bucket are held for the next block. Output
+    blocks may share memory with the input, like blocks from a ring.
+    """
+
+    def __init__(self, factor, mode='decimate'):
+        if mode not in DOWNSAMPLE_MODES:
+            raise ValueError("Unknown downsampling mode %r" % (mode,))
+        if factor < 1:
+            raise ValueError("Downsampling factor must be at least 1")
+        self.factor = factor
+        self.mode = mode
+        self._held = None
+
+
+    def process(self, block):
+        """
+        :type block: SampleBlock
+        :returns: the downsampled samples, which may be none at all.
+        :rtype: SampleBlock
+        """
+        if self._held is not None:
+            block = self._join(self._held, block)
+        buckets = len(block) // self.factor
+        used = buckets * self.factor
+        if used < len(block):
+            self._held = block.slice(used, len(block)).copy()
+        else:
+            self._held = None
+        return self._reduce(block, buckets)
+
+
+    def _joinOptional(self, first, second):
+        """
+        Join a column that blocks may not have, like ``timestamp``.
+        """
+        if first is None or second is None:
+            return None
+        return self._joinColumn(first, second)
+
+
+    def _firsts(self, column, buckets, typecode='d'):
+        """
+        Take the first of each bucket from a column like ``timestamp``, for
+        each output row.
+        """
+        if column is None:
+            return None
+        firsts = column[:buckets * self.factor:self.factor]
+        if self.mode == 'minmax':
+            return self._repeat(firsts, typecode)
+        return self._copyColumn(firsts, typecode)
+
+
+
+class NumpyDownsampler(_Downsampler):
+
+    def _join(self, first, second):
+        return SampleBlock(
+            numpy.concatenate([first.counter, second.counter]),
+            numpy.concatenate([first.eeg, second.eeg]),
+            numpy.concatenate([first.accelerometer, second.accelerometer]),
+            self._joinOptional(first.timestamp, second.timestamp),
+            self._joinOptional(first.index, second.index))
+
+
+    def _joinColumn(self, first, second):
+        return numpy.concatenate([first, second])
+
+
+    def _copyColumn(self, column, typecode):
+        return column.copy()
+
+
+    def _repeat(self, column, typecode):
+        return column.repeat(2)
+
+
+    def _reduce(self, block, buckets):
+        factor = self.factor
+        used = buckets * factor
+        timestamp = self._firsts(block.timestamp, buckets)
+        index = self._firsts(block.index, buckets)
+        counter = self._firsts(block.counter, buckets)
+        eeg = block.eeg[:used].reshape(buckets, factor, block.eeg.shape[1])
+        accelerometer = block.accelerometer[:used].reshape(
+            buckets, factor, block.accelerometer.shape[1])
+        if self.mode == 'decimate':
+            return SampleBlock(counter, eeg[:, 0], accelerometer[:, 0],
+                               timestamp, index)
+        if self.mode == 'mean':
+            return SampleBlock(counter, self._mean(eeg),
+                               self._mean(accelerometer), timestamp, index)
+        return SampleBlock(counter,
+                           self._envelope(eeg), self._envelope(accelerometer),
+                           timestamp, index)
+
+
+    def _mean(self, values):
+        mean = values.mean(axis=1)
+        if values.dtype.kind != 'f':
+            mean = numpy.floor(mean + 0.5)
+        return mean.astype(values.dtype)
+
+
+    def _envelope(self, values):
+        buckets, factor, channels = values.shape
+        out = numpy.empty((buckets * 2, channels), values.dtype)
+        out[0::2] = values.min(axis=1)
+        out[1::2] = values.max(axis=1)
+        return out
+
+
+
+class PythonDownsampler(_Downsampler):
+
+    def _join(self, first, second):
+        return SampleBlock(
+            array('B', first.counter) + array('B', second.counter),
+            list(first.eeg) + list(second.eeg),
+            list(first.accelerometer) + list(second.accelerometer),
+            self._joinOptional(first.timestamp, second.timestamp),
+            self._joinOptional(first.index, second.index))
+
+
+    def _joinColumn(self, first, second):
+        return array('d', first) + array('d', second)
+
+
+    def _copyColumn(self, column, typecode):
+        return array(typecode, column)
+
+
+    def _repeat(self, column, typecode):
+        return array(typecode, [value for value in column for twice in (0, 1)])
+
+
+    def _reduce(self, block, buckets):
+        factor = self.factor
+        eeg = []
+        accelerometer = []
+        for b in range(buckets):
+            start = b * factor
+            stop = start + factor
+            if self.mode == 'decimate':
+                eeg.append(self._copy(block.eeg[start], 'l'))
+                accelerometer.append(
+                    self._copy(block.accelerometer[start], 'h'))
+            elif self.mode == 'mean':
+                eeg.append(self._mean(block.eeg[start:stop], 'l'))
+                accelerometer.append(
+                    self._mean(block.accelerometer[start:stop], 'h'))
+            else:
+                eeg.extend(self._envelope(block.eeg[start:stop], 'l'))
+                accelerometer.extend(
+                    self._envelope(block.accelerometer[start:stop], 'h'))
+        return SampleBlock(self._firsts(block.counter, buckets, 'B'),
+                           eeg, accelerometer,
+                           self._firsts(block.timestamp, buckets),
+                           self._firsts(block.index, buckets))
+
+
+    def _copy(self, row, typecode):
+        return array(getattr(row, 'typecode', typecode), row)
+
+
+    def _mean(self, rows, typecode):
+        typecode = getattr(rows[0], 'typecode', typecode)
+        count = float(len(rows))
+        if typecode in 'fd':
+            return array(typecode, [sum(column) / count
+                                    for column in zip(*rows)])
+        return array(typecode, [int(math.floor(sum(column) / count + 0.5))
+                                for column in zip(*rows)])
+
+
+    def _envelope(self, rows, typecode):
+        typecode = getattr(rows[0], 'typecode', typecode)
+        columns = zip(*rows)
+        return [array(typecode, [min(column) for column in columns]),
+                array(typecode, [max(column) for column in columns])]
+
+
+
+if numpy:
+    Downsampler = NumpyDownsampler
+else:
+    Downsampler = PythonDownsampler
+
+
+
+# The ADS1299 full scale is +/-VREF/gain over a signed 24-bit count.
+ADS1299_VREF = 4.5
+ADS1299_GAIN = 24
+
+# Q of a second-order Butterworth section.
+BUTTERWORTH_Q = 1 / math.sqrt(2)
+
+
+def microvoltsPerCount(gain=ADS1299_GAIN, vref=ADS1299_VREF):
+    return vref / gain / (2 ** 23 - 1) * 1e6
+
+
+def _isNumpy(block):
+    return numpy is not None and isinstance(block.eeg, numpy.ndarray)
+
+
+
+class ScaleToMicrovolts(object):
+    """
+    Convert EEG values from ADS1299 counts to microvolts.
+
+    The output is floating point; the accelerometer is passed through.
+    """
+
+    def __init__(self, gain=ADS1299_GAIN, vref=ADS1299_VREF):
+        """
+        :param gain: the programmable gain the channels are set to.
+        """
+        self.scale = microvoltsPerCount(gain, vref)
+
+
+    def process(self, block):
+        scale = self.scale
+        if _isNumpy(block):
+            eeg = block.eeg * scale
+        else:
+            eeg = [array('d', [value * scale for value in row])
+                   for row in block.eeg]
+        return block.withEEG(eeg)
+
+
+
+class CommonAverageReference(object):
+    """
+    Re-reference each sample to the mean of its EEG channels.
+
+    Only use this when every channel is connected to something; a floating
+    channel will pollute all the others.
+    """
+
+    def process(self, block):
+        if _isNumpy(block):
+            eeg = block.eeg - block.eeg.mean(axis=1)[:, numpy.newaxis]
+        else:
+            eeg = []
+            for row in block.eeg:
+                mean = sum(row) / float(len(row))
+                eeg.append(array('d', [value - mean for value in row]))
+        return block.withEEG(eeg)
+
+
+
+def _section(b, a):
+    """
+    Normalize biquad coefficients to ``(b0, b1, b2, a1, a2)``, with a0 = 1.
+    """
+    a0 = float(a[0])
+    return (b[0] / a0, b[1] / a0, b[2] / a0, a[1] / a0, a[2] / a0)
+
+
+def _prewarp(frequency, sampleRate, quality):
+    w0 = 2 * math.pi * frequency / sampleRate
+    return math.cos(w0), math.sin(w0) / (2 * quality)
+
+
+def notchSection(frequency, sampleRate=SAMPLE_RATE, quality=30.0):
+    """
+    A second-order notch, as for removing mains interference.
+
+    :param quality: the centre frequency over the width of the notch.
+    """
+    cos, alpha = _prewarp(frequency, sampleRate, quality)
+    return _section((1, -2 * cos, 1), (1 + alpha, -2 * cos, 1 - alpha))
+
+
+def highpassSection(frequency, sampleRate=SAMPLE_RATE, quality=BUTTERWORTH_Q):
+    cos, alpha = _prewarp(frequency, sampleRate, quality)
+    return _section(((1 + cos) / 2, -(1 + cos), (1 + cos) / 2),
+                    (1 + alpha, -2 * cos, 1 - alpha))
+
+
+def lowpassSection(frequency, sampleRate=SAMPLE_RATE, quality=BUTTERWORTH_Q):
+    cos, alpha = _prewarp(frequency, sampleRate, quality)
+    return _section(((1 - cos) / 2, 1 - cos, (1 - cos) / 2),
+                    (1 + alpha, -2 * cos, 1 - alpha))
+
+
+def bandpassSections(low, high, sampleRate=SAMPLE_RATE):
+    """
+    A second-order Butterworth highpass at ``low`` and lowpass at ``high``.
+    """
+    return [highpassSection(low, sampleRate),
+            lowpassSection(high, sampleRate)]
+
+
+
+class _IIRFilter(object):
+    """
+    Run each EEG channel through a cascade of second-order IIR sections,
+    in transposed direct form II.
+
+    Filter state is kept between blocks. It starts out as if the first
+    sample had been the input forever, so the DC offset of the electrodes
+    doesn't ring through the output when the filter starts.
+    """
+
+    def __init__(self, sections):
+        """
+        :param sections: ``(b0, b1, b2, a1, a2)`` tuples, as made by
+            `notchSection` and friends.
+        """
+        self.sections = list(sections)
+        self._state = None
+
+
+
+class NumpyIIRFilter(_IIRFilter):
+    """
+    The cascade is run as one state-space system, a whole chunk of samples
+    at a time: for a chunk ``X`` and starting state ``s``, the output is
+    ``O.s + T.X`` and the final state ``P.s + R.X``, with the matrices
+    worked out once, up front.
+    """
+
+    chunkSize = 64
+
+    def __init__(self, sections):
+        _IIRFilter.__init__(self, sections)
+        A, B, C, D = self._stateSpace(self.sections)
+        n = self.chunkSize
+        powers = [numpy.identity(len(A))]
+        for i in range(n):
+            powers.append(A.dot(powers[-1]))
+        markov = [C.dot(power).dot(B) for power in powers]
+        self._toeplitz = numpy.zeros((n, n))
+        for i in range(n):
+            self._toeplitz[i, i] = D
+            for j in range(i):
+                self._toeplitz[i, j] = markov[i - 1 - j]
+        self._observe = numpy.array([C.dot(power) for power in powers[:n]])
+        self._powers = powers
+        # column j drives the state from sample j to the end of a full chunk.
+        self._reach = numpy.array([powers[n - 1 - j].dot(B)
+                                   for j in range(n)]).T
+        self._steady = numpy.linalg.solve(numpy.identity(len(A)) - A, B)
+
+
+    @staticmethod
+    def _stateSpace(sections):
+        A = numpy.zeros((0, 0))
+        B = numpy.zeros(0)
+        C = numpy.zeros(0)
+        D = 1.0
+        for b0, b1, b2, a1, a2 in sections:
+            sectionA = numpy.array([[-a1, 1.0], [-a2, 0.0]])
+            sectionB = numpy.array([b1 - a1 * b0, b2 - a2 * b0])
+            size = len(A)
+            cascaded = numpy.zeros((size + 2, size + 2))
+            cascaded[:size, :size] = A
+            cascaded[size:, :size] = numpy.outer(sectionB, C)
+            cascaded[size:, size:] = sectionA
+            A = cascaded
+            B = numpy.concatenate([B, sectionB * D])
+            C = numpy.concatenate([b0 * C, [1.0, 0.0]])
+            D = b0 * D
+        return A, B, C, D
+
+
+    def process(self, block):
+        eeg = numpy.array(block.eeg, dtype='f8')
+        if not len(eeg):
+            return block.withEEG(eeg)
+        if self._state is None:
+            self._state = numpy.outer(self._steady, eeg[0])
+        state = self._state
+        n = self.chunkSize
+        for start in range(0, len(eeg), n):
+            chunk = eeg[start:start + n]
+            length = len(chunk)
+            output = (self._observe[:length].dot(state) +
+                      self._toeplitz[:length, :length].dot(chunk))
+            state = (self._powers[length].dot(state) +
+                     self._reach[:, n - length:].dot(chunk))
+            chunk[:] = output
+        self._state = state
+        return block.withEEG(eeg)
+
+
+
+class PythonIIRFilter(_IIRFilter):
+
+    def _initialState(self, x):
+        state = []
+        for b0, b1, b2, a1, a2 in self.sections:
+            gain = (b0 + b1 + b2) / (1 + a1 + a2)
+            y = [value * gain for value in x]
+            state.append([[out - b0 * value for value, out in zip(x, y)],
+                          [b2 * value - a2 * out for value, out in zip(x, y)]])
+            x = y
+        return state
+
+
+    def process(self, block):
+        eeg = [[float(value) for value in row] for row in block.eeg]
+        if eeg and self._state is None:
+            self._state = self._initialState(eeg[0])
+        for (b0, b1, b2, a1, a2), (z1, z2) in zip(self.sections,
+                                                  self._state or []):
+            channels = range(len(z1))
+            for row in eeg:
+                for c in channels:
+                    x = row[c]
+                    y = b0 * x + z1[c]
+                    z1[c] = b1 * x - a1 * y + z2[c]
+                    z2[c] = b2 * x - a2 * y
+                    row[c] = y
+        return block.withEEG([array('d', row) for row in eeg])
+
+
+
+if numpy:
+    IIRFilter = NumpyIIRFilter
+else:
+    IIRFilter = PythonIIRFilter
+
+
+
+class Pipeline(object):
+    """
+    Stages applied in order, each a thing with a ``process(block)`` method
+    returning a new block.
+    """
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+
+
+    def process(self, block):
+        for stage in self.stages:
+            block = stage.process(block)
+        return block
+
+
+
+def defaultFilters(sampleRate=SAMPLE_RATE, mains=60, low=1.0, high=50.0,
+                   reference=False):
+    """
+    Stages for a clean look at EEG: microvolts, a mains notch, and a
+    bandpass.
+
+    :param mains: the mains frequency to notch out, 50 or 60 Hz.
+    :param reference: whether to re-reference to the common average.
+    """
+    stages = [ScaleToMicrovolts()]
+    if reference:
+        stages.append(CommonAverageReference())
+    stages.append(IIRFilter([notchSection(mains, sampleRate)] +
+                            bandpassSections(low, high, sampleRate)))
+    return stages
+
+
+
+class _ProcessedSource(object):
+    """
+    A receiver's samples, processed once for any number of listeners.
+
+    This has the same subscription interface as
+    `txopenbci.control.DeviceReceiver`, and only listens to the receiver
+    while it has listeners of its own. Processing starts from fresh state
+    each time it does.
+    """
+
+    def __init__(self, receiver):
+        """
+        :param receiver: a DeviceReceiver, or another source.
+        """
+        self.receiver = receiver
+        self._processor = None
+        self._listeners = set()
+
+
+    def _makeProcessor(self):
+        """
+        :returns: something with a ``process(block)`` method.
+        """
+        raise NotImplementedError()
+
+
+    def subscribeToSampleBlocks(self, listener):
+        if not self._listeners:
+            self._processor = self._makeProcessor()
+            self.receiver.subscribeToSampleBlocks(self.handleBlock)
+        self._listeners.add(listener)
+
+
+    def unsubscribeFromSampleBlocks(self, listener):
+        self._listeners.discard(listener)
+        if not self._listeners:
+            self.receiver.unsubscribeFromSampleBlocks(self.handleBlock)
+            self._processor = None
+
+
+    def handleBlock(self, block):
+        if self._processor is None:
+            # unsubscribed while the receiver was delivering this block.
+            return
+        block = self._processor.process(block)
+        if len(block):
+            # listeners may unsubscribe as we go.
+            for listener in list(self._listeners):
+                listener(block)
+
+
+
+class DownsampledSource(_ProcessedSource):
+    """
+    A receiver's samples at a lower rate. See `Downsampler`.
+    """
+
+    def __init__(self, receiver, factor, mode='decimate'):
+        _ProcessedSource.__init__(self, receiver)
+        self.factor = factor
+        self.mode = mode
+
+
+    def _makeProcessor(self):
+        return Downsampler(self.factor, self.mode)
+
+
+
+class FilteredSource(_ProcessedSource):
+    """
+    A receiver's samples run through a `Pipeline` of filters.
+    """
+
+    def __init__(self, receiver, makeStages=None):
+        """
+        :param makeStages: a callable returning a new list of stages, as
+            `defaultFilters` does, which is the default.
+        """
+        _ProcessedSource.__init__(self, receiver)
+        if makeStages is None:
+            makeStages = defaultFilters
+        self.makeStages = makeStages
+
+
+    def _makeProcessor(self):
+        return Pipeline(self.makeStages())
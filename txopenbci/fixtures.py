@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Recorded streams from a board, in ``txopenbci/test/``, for the tests and
+`txopenbci.benchmark` to feed to the code; and the tests' helpers for
+making blocks of them and comparing blocks.
+"""
+from array import array
+import gzip
+from os import path
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .protocol import decodeSamples
+from .ring import SampleBlock
+
+
+# when the recordings made in the tests start.
+TIME0 = 1422057600.0
+
+
+def fixture(name):
+    """
+    :returns: the bytes of the recording ``name``.
+    """
+    filename = path.join(path.dirname(__file__), 'test', name + '.raw')
+    if path.exists(filename + '.gz'):
+        # some fixtures are gzipped to prevent git and other tools from
+        # messing with their line endings.
+        with gzip.open(filename + '.gz') as datafile:
+            return datafile.read()
+    with open(filename, 'rb') as datafile:
+        return datafile.read()
+
+
+def times(start, count):
+    """
+    :returns: the timestamps of ``count`` samples from sample ``start`` of a
+        recording started at ``TIME0``.
+    """
+    return array('d', [TIME0 + (start + i) / 250.0 for i in range(count)])
+
+
+def makeBlock(start=0, count=16):
+    """
+    :returns: the first ``count`` samples of ``stream_16samples``, indexed
+        and timestamped as samples ``start`` on of a recording started at
+        ``TIME0``.
+    :rtype: SampleBlock
+    """
+    block = SampleBlock(*decodeSamples(fixture('stream_16samples'), count))
+    index = [float(start + i) for i in range(count)]
+    floats = numpy.array if numpy else lambda values: array('d', values)
+    block.index = floats(index)
+    block.timestamp = floats(times(start, count))
+    return block
+
+
+def rows(blocks, timestamps=False):
+    """
+    The samples of some blocks, as ``(counter, eeg, accelerometer)`` tuples
+    of lists that compare equal whatever the blocks are made of.
+
+    :param timestamps: whether to add each sample's timestamp.
+    """
+    return [(sample.counter, list(sample.eeg), list(sample.accelerometer)) +
+            ((sample.timestamp,) if timestamps else ())
+            for block in blocks for sample in block.samples()]
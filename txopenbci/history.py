@@ -0,0 +1,597 @@
+# -*- coding: utf-8 -*-
+"""
+Reading stretches of recordings back, for looking over a session after the
+fact.
+
+A recording is read a block of samples at a time. Each kind of recording
+has a source that knows where its blocks start: a binary recording
+(`txopenbci.recording`) by arithmetic, a compressed one
+(`txopenbci.compressed`) from its block index, and a CSV log
+(`sink.SensorLog`) from an index of line offsets built by reading it once.
+Decoded blocks are kept in an `LRUCache` shared by all recordings, so
+scrolling back and forth over a session decodes each block once.
+
+Where a recording has summaries (`txopenbci.pyramid`) kept while it was
+written, queries for buckets of a second or more are answered from those,
+without reading the samples at all.
+
+Times here are seconds since the recording began.
+"""
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+import csv
+import itertools
+import os
+
+try:
+    import numpy
+except ImportError as e:
+    numpy = None
+    numpy_reason = e
+else:
+    numpy_reason = None
+
+from . import compressed, pyramid, recording
+from .protocol import SAMPLE_RATE
+from .ring import SampleBlock, EEG_CHANNELS, GAP_EEG
+
+
+FORMATS = {
+    '.csv': 'csv',
+    '.rec': 'binary',
+    '.recz': 'compressed',
+}
+
+
+
+class LRUCache(object):
+    """
+    Keep the ``maxSize`` most recently used values.
+    """
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self._values = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def __len__(self):
+        return len(self._values)
+
+
+    def get(self, key, make):
+        """
+        :param make: called to make the value, if it isn't kept.
+        """
+        try:
+            value = self._values.pop(key)
+        except KeyError:
+            self.misses += 1
+            value = make()
+        else:
+            self.hits += 1
+        self._values[key] = value
+        while len(self._values) > self.maxSize:
+            self._values.popitem(last=False)
+        return value
+
+
+
+# == Sources ==
+# Each has ``time0``, the time the recording began, seconds since the
+# epoch; ``blockStarts``, the index of the first sample of each block;
+# ``__len__``, the number of samples; ``blockTime(number)``, the time of a
+# block's first sample; and ``readBlock(number)``, which returns the block
+# as a SampleBlock with timestamps, in the same terms as ``time0``.
+
+class BinarySource(object):
+    """
+    A binary recording, read in blocks of ``blockSize`` records.
+    """
+
+    def __init__(self, filename, blockSize=SAMPLE_RATE):
+        self.fileobj = open(filename, 'rb')
+        self.header = recording.readHeader(self.fileobj)
+        self.time0 = self.header['time0']
+        self.blockSize = blockSize
+        self._recordSize = self.header['recordSize']
+        self._struct = recording.recordStruct(self.header['fields'])
+        size = os.fstat(self.fileobj.fileno()).st_size
+        self._length = max(0, size - self.header['dataOffset']) // \
+            self._recordSize
+        self.blockStarts = range(0, self._length, blockSize)
+
+
+    def __len__(self):
+        return self._length
+
+
+    def close(self):
+        self.fileobj.close()
+
+
+    def _read(self, start, count):
+        self.fileobj.seek(self.header['dataOffset'] + start * self._recordSize)
+        return self.fileobj.read(count * self._recordSize)
+
+
+    def blockTime(self, number):
+        record = self._struct.unpack(self._read(self.blockStarts[number], 1))
+        return record[-1]
+
+
+    def readBlock(self, number):
+        start = self.blockStarts[number]
+        count = min(self.blockSize, self._length - start)
+        data = self._read(start, count)
+        if numpy:
+            records = numpy.frombuffer(
+                data, recording.recordDtype(self.header['fields']), count)
+            return SampleBlock(records['counter'].copy(),
+                               records['eeg'].astype('i4'),
+                               records['accelerometer'].astype('i2'),
+                               records['timestamp'].astype('f8'))
+        records = [self._struct.unpack_from(data, i * self._recordSize)
+                   for i in range(count)]
+        return SampleBlock(
+            array('B', [record[0] for record in records]),
+            [array('l', record[1:1 + EEG_CHANNELS]) for record in records],
+            [array('h', record[1 + EEG_CHANNELS:-1]) for record in records],
+            array('d', [record[-1] for record in records]))
+
+
+
+class CompressedSource(object):
+    """
+    A compressed recording, read a compressed block at a time.
+    """
+
+    def __init__(self, filename):
+        self.recording = compressed.CompressedRecording(filename)
+        self.time0 = self.recording.header['time0']
+        self.blockStarts = []
+        start = 0
+        for info in self.recording.index:
+            self.blockStarts.append(start)
+            start += info.count
+        self._length = start
+
+
+    def __len__(self):
+        return self._length
+
+
+    def close(self):
+        self.recording.close()
+
+
+    def blockTime(self, number):
+        return self.recording.index[number].first
+
+
+    def readBlock(self, number):
+        return self.recording.readBlock(self.recording.index[number])
+
+
+
+class CSVSource(object):
+    """
+    A CSV log, read in blocks of ``blockSize`` rows.
+
+    The log doesn't say when it began, only the time of each row since then,
+    so ``time0`` is zero and the times are those of the log.
+    """
+
+    time0 = 0.0
+
+    def __init__(self, filename, blockSize=SAMPLE_RATE):
+        self.fileobj = open(filename, 'rb')
+        self.blockSize = blockSize
+        self.blockStarts = []
+        self._offsets = []
+        self._times = []
+        self._length = 0
+        self._buildIndex()
+
+
+    def _buildIndex(self):
+        """
+        Note where every ``blockSize`` rows start, and the time of their
+        first row. A row that isn't finished, from a log still being
+        written, is left out.
+        """
+        fileobj = self.fileobj
+        fileobj.seek(0)
+        offset = len(fileobj.readline())
+        for line in iter(fileobj.readline, b''):
+            if not line.endswith(b'\n'):
+                break
+            if self._length % self.blockSize == 0:
+                self.blockStarts.append(self._length)
+                self._offsets.append(offset)
+                self._times.append(float(line.rsplit(b',', 1)[1]))
+            self._length += 1
+            offset += len(line)
+
+
+    def __len__(self):
+        return self._length
+
+
+    def close(self):
+        self.fileobj.close()
+
+
+    def blockTime(self, number):
+        return self._times[number]
+
+
+    def readBlock(self, number):
+        count = min(self.blockSize,
+                    self._length - self.blockStarts[number])
+        self.fileobj.seek(self._offsets[number])
+        rows = list(itertools.islice(csv.reader(self.fileobj), count))
+        block = SampleBlock(
+            array('B', [int(row[0]) for row in rows]),
+            [array('l', [int(value) for value in row[1:9]]) for row in rows],
+            [array('h', [int(value) for value in row[9:12]]) for row in rows],
+            array('d', [float(row[12]) for row in rows]))
+        if numpy:
+            block = SampleBlock(
+                numpy.array(block.counter, 'u1'), numpy.array(block.eeg, 'i4'),
+                numpy.array(block.accelerometer, 'i2'),
+                numpy.array(block.timestamp, 'f8'))
+        return block
+
+
+_sourceTypes = {
+    'binary': BinarySource,
+    'compressed': CompressedSource,
+    'csv': CSVSource,
+}
+
+
+
+class _BlockTimes(object):
+    """The times of a source's blocks, as a sequence for bisecting."""
+
+    def __init__(self, source):
+        self.source = source
+
+    def __len__(self):
+        return len(self.source.blockStarts)
+
+    def __getitem__(self, number):
+        return self.source.blockTime(number)
+
+
+
+# == Aggregates ==
+
+def numpy_aggregate(eeg, bucketSize):
+    """
+    The minimum, maximum and mean of each channel over buckets of
+    ``bucketSize`` samples; the last bucket may be short.
+
+    Gaps (see `ring.GAP_EEG`) are left out, as they are from a
+    recording's summaries: a bucket of nothing but gaps has a minimum and
+    maximum of 0, and a mean of NaN.
+
+    :param eeg: one row per channel.
+    :returns: ``(minimum, maximum, mean)``, each a row per channel.
+    """
+    eeg = numpy.asarray(eeg)
+    starts = numpy.arange(0, eeg.shape[1], bucketSize)
+    if not len(starts):
+        empty = numpy.zeros((eeg.shape[0], 0))
+        return empty, empty, empty
+    valid = eeg != GAP_EEG
+    counts = numpy.add.reduceat(valid.astype('i8'), starts, axis=1)
+    gaps = counts == 0
+    minimum = numpy.minimum.reduceat(
+        numpy.where(valid, eeg, numpy.iinfo(eeg.dtype).max), starts, axis=1)
+    # gaps are already smaller than any sample.
+    maximum = numpy.maximum.reduceat(eeg, starts, axis=1)
+    minimum[gaps] = 0
+    maximum[gaps] = 0
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = numpy.add.reduceat(numpy.where(valid, eeg, 0), starts,
+                                  axis=1, dtype='f8') / counts
+    return minimum, maximum, mean
+
+
+def python_aggregate(eeg, bucketSize):
+    """
+    The minimum, maximum and mean of each channel over buckets of
+    ``bucketSize`` samples; the last bucket may be short.
+
+    Gaps (see `ring.GAP_EEG`) are left out, as they are from a
+    recording's summaries: a bucket of nothing but gaps has a minimum and
+    maximum of 0, and a mean of NaN.
+
+    :param eeg: one row per channel.
+    :returns: ``(minimum, maximum, mean)``, each a row per channel.
+    """
+    minimum, maximum, mean = [], [], []
+    for column in eeg:
+        buckets = [[value for value in column[i:i + bucketSize]
+                    if value != GAP_EEG]
+                   for i in range(0, len(column), bucketSize)]
+        minimum.append([min(bucket) if bucket else 0 for bucket in buckets])
+        maximum.append([max(bucket) if bucket else 0 for bucket in buckets])
+        mean.append([float(sum(bucket)) / len(bucket) if bucket
+                     else float('nan') for bucket in buckets])
+    return minimum, maximum, mean
+
+
+if numpy:
+    aggregate = numpy_aggregate
+else:
+    aggregate = python_aggregate
+
+
+
+class RecordingLibrary(object):
+    """
+    The recordings in a directory, and a cache of blocks decoded from them.
+
+    :ivar cache: the `LRUCache` of decoded blocks.
+    """
+
+    def __init__(self, directory, cacheBlocks=256):
+        self.directory = directory
+        self.cache = LRUCache(cacheBlocks)
+        # filename: (size, source)
+        self._sources = {}
+        # filename: (size of the sidecar, pyramid)
+        self._pyramids = {}
+
+
+    def list(self):
+        """
+        :returns: a list of dicts of ``name``, ``format``, ``size`` in bytes
+            and ``modified`` time, for each recording.
+        """
+        recordings = []
+        for name in sorted(os.listdir(self.directory)):
+            extension = os.path.splitext(name)[1]
+            if extension not in FORMATS:
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            recordings.append({
+                'name': name,
+                'format': FORMATS[extension],
+                'size': stat.st_size,
+                'modified': stat.st_mtime,
+            })
+        return recordings
+
+
+    def open(self, name):
+        """
+        A source for the recording called ``name``. The same one is given
+        out until the file grows.
+
+        :raises KeyError: if there's no such recording.
+        """
+        extension = os.path.splitext(name)[1]
+        if (extension not in FORMATS or os.path.basename(name) != name or
+                name not in os.listdir(self.directory)):
+            raise KeyError(name)
+        filename = os.path.join(self.directory, name)
+        size = os.path.getsize(filename)
+        known = self._sources.get(name)
+        if known is not None:
+            if known[0] == size:
+                return known[1]
+            known[1].close()
+        source = _sourceTypes[FORMATS[extension]](filename)
+        self._sources[name] = (size, source)
+        return source
+
+
+    def info(self, name):
+        """
+        :returns: a dict of ``samples``, ``blocks``, ``time0`` and
+            ``duration``: the time of the last sample.
+        """
+        source = self.open(name)
+        blocks = len(source.blockStarts)
+        duration = 0.0
+        if blocks:
+            last = self._block(name, source, blocks - 1)
+            duration = last.timestamp[-1] - source.time0
+        return {
+            'samples': len(source),
+            'blocks': blocks,
+            'time0': source.time0,
+            'duration': duration,
+        }
+
+
+    def summaries(self, name):
+        """
+        :returns: the `pyramid.Pyramid` of summaries of the recording
+            ``name``, or None if it has none. The same one is given out
+            until the sidecar file grows.
+        """
+        self.open(name)
+        filename = pyramid.sidecarName(os.path.join(self.directory, name))
+        if not os.path.exists(filename):
+            return None
+        size = os.path.getsize(filename)
+        known = self._pyramids.get(name)
+        if known is None or known[0] != size:
+            known = self._pyramids[name] = (size, pyramid.Pyramid(filename))
+        return known[1]
+
+
+    def _block(self, name, source, number):
+        return self.cache.get((name, len(source), number),
+                              lambda: source.readBlock(number))
+
+
+    def sampleAt(self, name, seconds):
+        """
+        :returns: the index of the first sample taken at or after
+            ``seconds`` into the recording.
+        """
+        source = self.open(name)
+        when = source.time0 + seconds
+        number = bisect_right(_BlockTimes(source), when) - 1
+        if number < 0:
+            return 0
+        block = self._block(name, source, number)
+        timestamp = block.timestamp
+        position = 0
+        while position < len(block) and timestamp[position] < when:
+            position += 1
+        return source.blockStarts[number] + position
+
+
+    def read(self, name, start, stop):
+        """
+        The samples from index ``start`` up to ``stop``, reading only the
+        blocks that hold them.
+
+        :returns: a list of SampleBlocks.
+        """
+        source = self.open(name)
+        stop = min(stop, len(source))
+        starts = source.blockStarts
+        blocks = []
+        number = max(0, bisect_right(starts, start) - 1)
+        while number < len(starts) and starts[number] < stop:
+            block = self._block(name, source, number)
+            first = max(0, start - starts[number])
+            last = min(len(block), stop - starts[number])
+            if first or last < len(block):
+                block = block.slice(first, last)
+            blocks.append(block)
+            number += 1
+        return blocks
+
+
+    def query(self, name, start=None, stop=None, byTime=False, channels=None,
+              buckets=None, maxSamples=None, maxRead=None):
+        """
+        A slice of a recording, for JSON.
+
+        :param start: (optional) the first sample index, or time if
+            ``byTime``.
+        :param stop: (optional) the sample index or time to stop before.
+        :param channels: (optional) a list of the EEG channels wanted, from
+            0; all of them by default.
+        :param buckets: (optional) how many buckets to reduce the slice to,
+            giving the minimum, maximum and mean of each.
+        :param maxSamples: (optional) the most samples to give without
+            ``buckets``, and the most buckets.
+        :param maxRead: (optional) the most samples to read to make
+            buckets, when the recording has no summaries to make them
+            from.
+        :raises ValueError: if the slice has more than ``maxSamples``, or
+            more than ``maxRead`` to be read for buckets, or there are more
+            than ``maxSamples`` buckets.
+        :returns: a dict of ``start`` and ``stop`` indices, ``channels``,
+            ``time`` (of each sample or bucket, since the recording began)
+            and, per channel, ``eeg`` values; or with ``buckets``,
+            ``bucketSize`` and ``min``, ``max`` and ``mean``. Buckets taken
+            from the recording's summaries start and stop on the edges of
+            the summaries'. Gaps are left out of buckets, and those that are
+            all gaps have no ``mean``.
+        """
+        source = self.open(name)
+        if channels is None:
+            channels = range(EEG_CHANNELS)
+        if byTime:
+            start = 0 if start is None else self.sampleAt(name, start)
+            stop = (len(source) if stop is None
+                    else self.sampleAt(name, stop))
+        else:
+            start = 0 if start is None else max(0, start)
+            stop = len(source) if stop is None else min(stop, len(source))
+        stop = max(start, stop)
+        if not buckets and maxSamples is not None and \
+                stop - start > maxSamples:
+            raise ValueError("%d samples is more than %d; ask for buckets" %
+                             (stop - start, maxSamples))
+        if buckets and maxSamples is not None and buckets > maxSamples:
+            raise ValueError("%d buckets is more than %d" %
+                             (buckets, maxSamples))
+        if buckets:
+            bucketSize = max(1, -(-(stop - start) // buckets))
+            summaries = self.summaries(name)
+            if summaries is not None:
+                level = summaries.levelFor(bucketSize)
+                if level is not None:
+                    return _fromSummaries(summaries, level, start, stop,
+                                          bucketSize, channels)
+            if maxRead is not None and stop - start > maxRead:
+                raise ValueError("%d samples is more than %d to read for "
+                                 "buckets; ask for a shorter slice" %
+                                 (stop - start, maxRead))
+
+        blocks = self.read(name, start, stop)
+        if numpy:
+            if blocks:
+                eeg = numpy.concatenate([block.eeg for block in blocks])
+                times = numpy.concatenate([block.timestamp
+                                           for block in blocks])
+            else:
+                eeg = numpy.zeros((0, EEG_CHANNELS), 'i4')
+                times = numpy.zeros(0)
+            eeg = eeg[:, channels].T
+            times = times - source.time0
+        else:
+            rows = [row for block in blocks for row in block.eeg]
+            eeg = [[row[channel] for row in rows] for channel in channels]
+            times = [t - source.time0 for block in blocks
+                     for t in block.timestamp]
+
+        result = {'start': start, 'stop': stop, 'channels': channels}
+        if buckets:
+            minimum, maximum, mean = aggregate(eeg, bucketSize)
+            result.update({
+                'bucketSize': bucketSize,
+                'time': times[::bucketSize],
+                'min': minimum,
+                'max': maximum,
+                'mean': [[None if value != value else float(value)
+                          for value in channel] for channel in mean],
+            })
+        else:
+            result.update({'time': times, 'eeg': eeg})
+        return result
+
+
+def _fromSummaries(summaries, level, start, stop, bucketSize, channels):
+    """
+    `RecordingLibrary.query` buckets from a level of a recording's
+    summaries, with each of ``bucketSize`` rounded down to a whole number of
+    the level's.
+    """
+    size = summaries.levels[level]
+    perBucket = bucketSize // size
+    found = summaries.summaries[level][start // size:-(-stop // size)]
+    groups = [pyramid.Summary.combine(found[i:i + perBucket])
+              for i in range(0, len(found), perBucket)]
+    if groups:
+        start = groups[0].start
+        stop = groups[-1].start + groups[-1].count
+    else:
+        stop = start
+    return {
+        'start': start,
+        'stop': stop,
+        'channels': channels,
+        'bucketSize': perBucket * size,
+        'time': [group.time for group in groups],
+        'min': [[group.min[channel] for group in groups]
+                for channel in channels],
+        'max': [[group.max[channel] for group in groups]
+                for channel in channels],
+        'mean': [[group.mean[channel] if group.valid else None
+                  for group in groups] for channel in channels],
+    }
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+Counters, gauges and histograms for watching the sample stream at run time,
+shown in the Prometheus text format by `txopenbci.web.MetricsResource`.
+
+They're meant for the hot paths, so updating one is a few attribute
+operations; all the formatting happens when they're read. Instruments are
+got from a `Registry` by name (and labels), and the same name and labels
+always give the same instrument, so any number of objects can share one.
+
+`REGISTRY` is the one the web server shows. `DISABLED` gives instruments
+that do nothing, for measuring what the others cost.
+"""
+from bisect import bisect_left
+from collections import OrderedDict
+from timeit import default_timer as timer
+
+
+# seconds, for the time taken by a call on the sample path.
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# bytes, for reads from the serial port and the like.
+SIZE_BUCKETS = (33, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 65536)
+
+
+
+class Counter(object):
+    """A number that only goes up."""
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name):
+        return [(name, (), self.value)]
+
+
+
+class Gauge(object):
+    """
+    A number that goes up and down; or, with ``function``, whatever that
+    returns when the gauge is read.
+    """
+    kind = 'gauge'
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def samples(self, name):
+        if self.function is not None:
+            return [(name, (), self.function())]
+        return [(name, (), self.value)]
+
+
+
+class Histogram(object):
+    """
+    How many observations fell at or below each of ``buckets``, with their
+    count and sum.
+    """
+    kind = 'histogram'
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # one more for those above the last bucket.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def samples(self, name):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            samples.append((name + '_bucket', (('le', _formatValue(bound)),),
+                            cumulative))
+        samples.append((name + '_sum', (), self.sum))
+        samples.append((name + '_count', (), self.count))
+        return samples
+
+
+
+class _NullInstrument(object):
+    """Every instrument, doing nothing."""
+    value = 0
+
+    def inc(self, amount=1):
+        pass
+
+    dec = set = observe = inc
+
+
+
+class Registry(object):
+    """
+    Instruments by name and labels.
+    """
+
+    def __init__(self):
+        # name: [kind, help, OrderedDict of labels: instrument]
+        self._families = OrderedDict()
+
+
+    def _get(self, cls, name, help, labels, *args):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = [cls.kind, help, OrderedDict()]
+        elif family[0] != cls.kind:
+            raise ValueError("%s is a %s, not a %s" %
+                             (name, family[0], cls.kind))
+        key = tuple(sorted((labels or {}).items()))
+        instrument = family[2].get(key)
+        if instrument is None:
+            instrument = family[2][key] = cls(*args)
+        return instrument
+
+
+    def counter(self, name, help, labels=None):
+        """
+        :rtype: Counter
+        """
+        return self._get(Counter, name, help, labels)
+
+
+    def gauge(self, name, help, labels=None, function=None):
+        """
+        :param function: (optional) to call for the gauge's value when it's
+            read. It replaces any function the gauge already had.
+        :rtype: Gauge
+        """
+        gauge = self._get(Gauge, name, help, labels)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, labels=None):
+        """
+        :param buckets: the upper bounds of the buckets. Only the first
+            instrument of a name and labels sets them.
+        :rtype: Histogram
+        """
+        return self._get(Histogram, name, help, labels, buckets)
+
+
+    def labelled(self, **labels):
+        """
+        A view of this registry that adds ``labels`` to every instrument got
+        from it, as for everything to do with one device.
+        """
+        return LabelledRegistry(self, labels)
+
+
+    def exposition(self):
+        """
+        Everything in the registry, in the Prometheus text format.
+        """
+        lines = []
+        for name, (kind, help, instruments) in self._families.items():
+            lines.append('# HELP %s %s' % (name, _escapeHelp(help)))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, instrument in instruments.items():
+                for sampleName, extra, value in instrument.samples(name):
+                    lines.append('%s%s %s' % (sampleName,
+                                              _formatLabels(labels + extra),
+                                              _formatValue(value)))
+        return '\n'.join(lines) + '\n'
+
+
+
+class LabelledRegistry(object):
+    """
+    A `Registry` that adds some labels to every instrument.
+    """
+
+    def __init__(self, registry, labels):
+        self.registry = registry
+        self.labels = labels
+
+
+    def _labels(self, labels):
+        merged = dict(self.labels)
+        merged.update(labels or {})
+        return merged
+
+
+    def counter(self, name, help, labels=None):
+        return self.registry.counter(name, help, self._labels(labels))
+
+
+    def gauge(self, name, help, labels=None, function=None):
+        return self.registry.gauge(name, help, self._labels(labels),
+                                   function)
+
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, labels=None):
+        return self.registry.histogram(name, help, buckets,
+                                       self._labels(labels))
+
+
+    def labelled(self, **labels):
+        return LabelledRegistry(self.registry, self._labels(labels))
+
+
+    def exposition(self):
+        return self.registry.exposition()
+
+
+
+class DisabledRegistry(object):
+    """
+    Hands out instruments that do nothing and show nowhere.
+    """
+    _instrument = _NullInstrument()
+
+    def counter(self, name, help, labels=None):
+        return self._instrument
+
+
+    def gauge(self, name, help, labels=None, function=None):
+        return self._instrument
+
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, labels=None):
+        return self._instrument
+
+
+    def labelled(self, **labels):
+        return self
+
+
+    def exposition(self):
+        return ''
+
+
+
+def _escapeHelp(text):
+    return text.replace('\\', r'\\').replace('\n', r'\n')
+
+
+def _formatLabels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % (','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                     .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels),)
+
+
+def _formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    if value != value:
+        return 'NaN'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+REGISTRY = Registry()
+DISABLED = DisabledRegistry()
@@ -0,0 +1,479 @@
+# -*- coding: utf-8 -*-
+"""
+Analysis of the samples in worker processes, so that it can use every core
+and never holds up the reactor reading from the board.
+
+An `OffloadedSubscriber` stands in for an expensive listener on
+`control.DeviceReceiver.subscribeToSampleBlocks`. On the reactor thread,
+each block is only packed (with `txopenbci.wire`, and its timestamps and
+indices after) into a slot of a buffer shared with the workers, and the
+slot's number put on the worker's queue. The worker unpacks the block from
+the slot, calls the function with it, and sends back what it returns, which
+is handed to the callback on the reactor thread. So samples are never
+pickled; only slot numbers and results are.
+
+Each worker has a few slots of its own, and a slot is busy from when a
+block goes in until its result comes back. While all of them are busy, the
+workers are behind: blocks wait on the reactor thread, to no more than
+``maxPendingSamples``, and past that are dropped according to the policy.
+
+A function that keeps state from one block to the next sees only the
+blocks its worker gets; with more than one worker, those aren't all of
+them.
+"""
+from array import array
+from collections import deque
+import ctypes
+import multiprocessing
+import Queue
+import signal
+from struct import Struct
+import threading
+import traceback
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import numpy
+except ImportError as e:
+    numpy = None
+    numpy_reason = e
+else:
+    numpy_reason = None
+
+from twisted.application.service import Service
+from twisted.internet.defer import Deferred
+from twisted.python import log
+
+from . import wire
+from .metrics import REGISTRY, timer
+from .protocol import SAMPLE_RATE
+from .ring import EEG_CHANNELS, ACCELEROMETER_AXES
+
+
+# bytes of packed samples, number of timestamps and number of indices.
+_slotHeader = Struct('<III')
+_FLOAT_SIZE = 8
+
+
+def slotSize(samples):
+    """
+    :returns: the bytes a slot needs to hold a block of ``samples``.
+    """
+    perSample = (4 * EEG_CHANNELS + 2 * ACCELEROMETER_AXES + 1 +
+                 2 * _FLOAT_SIZE)
+    return _slotHeader.size + 4 + samples * perSample
+
+
+def _floatsToBytes(values):
+    if values is None:
+        return b''
+    if numpy and isinstance(values, numpy.ndarray):
+        return values.astype('f8').tobytes()
+    return Struct('%dd' % (len(values),)).pack(*values)
+
+
+def _floatsFromBytes(data, offset, count):
+    if not count:
+        return None
+    if numpy:
+        return numpy.frombuffer(data, 'f8', count, offset).copy()
+    return array('d', Struct('%dd' % (count,)).unpack_from(data, offset))
+
+
+def writeSlot(buf, offset, block):
+    """
+    Pack ``block`` into the shared buffer ``buf`` at ``offset``.
+    """
+    packed = wire.packBlocks([block])
+    timestamps = _floatsToBytes(block.timestamp)
+    indices = _floatsToBytes(block.index)
+    data = b''.join([
+        _slotHeader.pack(len(packed), len(timestamps) // _FLOAT_SIZE,
+                         len(indices) // _FLOAT_SIZE),
+        packed, timestamps, indices])
+    ctypes.memmove(ctypes.addressof(buf) + offset, data, len(data))
+
+
+def readSlot(buf, offset):
+    """
+    Unpack the block that `writeSlot` put in ``buf`` at ``offset``.
+
+    :rtype: txopenbci.ring.SampleBlock
+    """
+    address = ctypes.addressof(buf) + offset
+    packedSize, timestamps, indices = _slotHeader.unpack(
+        ctypes.string_at(address, _slotHeader.size))
+    data = ctypes.string_at(address + _slotHeader.size,
+                            packedSize + _FLOAT_SIZE * (timestamps + indices))
+    block = wire.unpackBlock(data)
+    block.timestamp = _floatsFromBytes(data, packedSize, timestamps)
+    block.index = _floatsFromBytes(
+        data, packedSize + _FLOAT_SIZE * timestamps, indices)
+    return block
+
+
+def _work(function, buf, size, worker, tasks, results):
+    """
+    A worker process: run ``function`` on the block in each slot named on
+    ``tasks``, until told to stop.
+    """
+    # Ctrl-C is for the parent to deal with.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        task = tasks.get()
+        if task is None:
+            results.put((None, worker, True, None))
+            return
+        sequence, slot = task
+        try:
+            payload = pickle.dumps(function(readSlot(buf, slot * size)),
+                                   pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            results.put((sequence, slot, False, traceback.format_exc()))
+        else:
+            results.put((sequence, slot, True, payload))
+
+
+
+class OffloadedSubscriber(Service):
+    """
+    Run ``function`` on each block of samples in worker processes, and
+    ``callback`` with each result on the reactor thread.
+
+    Give `handleBlock` to `control.DeviceReceiver.subscribeToSampleBlocks`.
+    Blocks of more than ``slotSamples`` are split to fit in slots.
+
+    :ivar policy: what to drop when too many samples are waiting for the
+        workers: the ``'oldest'`` waiting, so that the workers catch up with
+        the latest samples, or the ``'newest'``, so that they see an
+        unbroken run of samples for as long as possible.
+    :ivar ordered: whether results are handed to the callback in the order
+        the blocks came in, rather than as they finish.
+    :ivar highWaterMark: the most samples there have been waiting.
+    :ivar droppedSamples: how many samples were dropped with the workers
+        behind.
+    :ivar errors: how many blocks the function failed on, or were lost
+        with a worker that died.
+    :ivar restarts: how many workers have been started again after dying.
+    """
+
+    workers = 2
+    slotsPerWorker = 2
+    slotSamples = SAMPLE_RATE
+    maxPendingSamples = SAMPLE_RATE * 2
+    policy = 'oldest'
+    ordered = True
+    # seconds between the collector thread's checks that the workers are
+    # still alive.
+    pollInterval = 1.0
+
+    def __init__(self, function, callback, workers=None,
+                 slotsPerWorker=None, slotSamples=None,
+                 maxPendingSamples=None, policy=None, ordered=None,
+                 reactor=None, metrics=None):
+        """
+        :param function: called in a worker with each `ring.SampleBlock`.
+            It's inherited by the workers, not pickled, but what it returns
+            is pickled to send back.
+        :param callback: called on the reactor thread with each result.
+        :param metrics: (optional) the `txopenbci.metrics.Registry` to keep
+            counts in; by default, the global one.
+        """
+        if workers is not None:
+            self.workers = workers
+        if slotsPerWorker is not None:
+            self.slotsPerWorker = slotsPerWorker
+        if slotSamples is not None:
+            self.slotSamples = slotSamples
+        if maxPendingSamples is not None:
+            self.maxPendingSamples = maxPendingSamples
+        if policy is not None:
+            self.policy = policy
+        if ordered is not None:
+            self.ordered = ordered
+        if self.policy not in ('oldest', 'newest'):
+            raise ValueError("Unknown policy %r" % (self.policy,))
+        if reactor is None:
+            from twisted.internet import reactor
+        if metrics is None:
+            metrics = REGISTRY
+        self.function = function
+        self.callback = callback
+        self.reactor = reactor
+        self.slotSize = slotSize(self.slotSamples)
+        # made now, so every worker inherits the same one.
+        self.buffer = multiprocessing.RawArray(
+            ctypes.c_char, self.workers * self.slotsPerWorker * self.slotSize)
+        self.results = multiprocessing.Queue()
+        self._tasks = [None] * self.workers
+        self._processes = [None] * self.workers
+        self._free = [deque(range(worker * self.slotsPerWorker,
+                                  (worker + 1) * self.slotsPerWorker))
+                      for worker in range(self.workers)]
+        self._pending = deque()
+        self.pendingSamples = 0
+        self.highWaterMark = 0
+        self.droppedSamples = 0
+        self.errors = 0
+        self.restarts = 0
+        self._sequence = 0
+        # sequence: (slot, when it was sent), for blocks at the workers.
+        self._inFlight = {}
+        # sequence: (ok, payload), for results waiting on earlier ones.
+        self._finished = {}
+        self._nextResult = 0
+        self._collector = None
+        self._stopped = None
+        # reporting only while running, so a stopped processor isn't kept
+        # alive by it.
+        self._pendingGauge = metrics.gauge(
+            'txopenbci_offload_pending_samples',
+            "Samples waiting for a worker.")
+        self._pendingFunction = lambda: self.pendingSamples
+        self._droppedMetric = metrics.counter(
+            'txopenbci_offload_dropped_samples_total',
+            "Samples not analysed because the workers were behind.")
+        self._errorsMetric = metrics.counter(
+            'txopenbci_offload_errors_total',
+            "Blocks that offloaded analysis failed on.")
+        self._latency = metrics.histogram(
+            'txopenbci_offload_seconds',
+            "Seconds from sending a block to a worker to getting its result.")
+
+
+    @property
+    def busySlots(self):
+        return len(self._inFlight)
+
+
+    def stats(self):
+        """
+        :returns: a dict of ``pendingSamples``, ``highWaterMark``,
+            ``busySlots``, ``droppedSamples``, ``errors`` and ``restarts``.
+        """
+        return {
+            'pendingSamples': self.pendingSamples,
+            'highWaterMark': self.highWaterMark,
+            'busySlots': self.busySlots,
+            'droppedSamples': self.droppedSamples,
+            'errors': self.errors,
+            'restarts': self.restarts,
+        }
+
+
+    def handleBlock(self, block):
+        """
+        :type block: txopenbci.ring.SampleBlock
+        """
+        count = len(block)
+        if count > self.slotSamples:
+            for start in range(0, count, self.slotSamples):
+                self.handleBlock(block.slice(
+                    start, min(count, start + self.slotSamples)))
+            return
+        if not self._pending:
+            worker = self._freestWorker()
+            if worker is not None:
+                self._send(worker, block)
+                return
+        if (self.policy == 'newest' and
+                self.pendingSamples + count > self.maxPendingSamples):
+            self._drop(count)
+            return
+        # the block is a view into a ring that will be written over.
+        self._pending.append(block.copy())
+        self.pendingSamples += count
+        while self.pendingSamples > self.maxPendingSamples:
+            dropped = len(self._pending.popleft())
+            self.pendingSamples -= dropped
+            self._drop(dropped)
+        self.highWaterMark = max(self.highWaterMark, self.pendingSamples)
+
+
+    def _drop(self, count):
+        self.droppedSamples += count
+        self._droppedMetric.inc(count)
+
+
+    def _freestWorker(self):
+        """
+        :returns: the running worker with the most free slots, or None if
+            they're all busy.
+        """
+        best = None
+        for worker, free in enumerate(self._free):
+            if self._tasks[worker] is None or not free:
+                continue
+            if best is None or len(free) > len(self._free[best]):
+                best = worker
+        return best
+
+
+    def _send(self, worker, block):
+        slot = self._free[worker].popleft()
+        writeSlot(self.buffer, slot * self.slotSize, block)
+        sequence = self._sequence
+        self._sequence += 1
+        self._inFlight[sequence] = (slot, timer())
+        self._tasks[worker].put((sequence, slot))
+
+
+    def _sendPending(self):
+        while self._pending:
+            worker = self._freestWorker()
+            if worker is None:
+                return
+            block = self._pending.popleft()
+            self.pendingSamples -= len(block)
+            self._send(worker, block)
+
+
+    def _handleResult(self, sequence, slot, ok, payload):
+        """
+        A worker has finished with a slot.
+        """
+        sentAt = self._inFlight.pop(sequence, (None, None))[1]
+        if sentAt is None:
+            # from a worker given up for dead.
+            return
+        self._latency.observe(timer() - sentAt)
+        self._free[slot // self.slotsPerWorker].append(slot)
+        self._finished[sequence] = (ok, payload)
+        self._deliver()
+        self._sendPending()
+
+
+    def _deliver(self):
+        if not self.ordered:
+            sequences = sorted(self._finished)
+        else:
+            # up to the first block still at a worker. Any before it that
+            # haven't finished were lost with a worker, and won't.
+            sequences = []
+            sequence = self._nextResult
+            while sequence < self._sequence and \
+                    sequence not in self._inFlight:
+                if sequence in self._finished:
+                    sequences.append(sequence)
+                sequence += 1
+            self._nextResult = sequence
+        for sequence in sequences:
+            ok, payload = self._finished.pop(sequence)
+            if not ok:
+                self.errors += 1
+                self._errorsMetric.inc()
+                log.msg("Offloaded analysis failed:\n%s" % (payload,))
+                continue
+            try:
+                self.callback(pickle.loads(payload))
+            except Exception:
+                log.err(None, "Offloaded analysis callback failed")
+
+
+    def _workerDied(self, worker, process):
+        """
+        A worker has gone without being told to; what it was working on is
+        lost.
+        """
+        if self._processes[worker] is not process:
+            return
+        log.msg("Offload worker %d died with exit code %s" %
+                (worker, process.exitcode))
+        slots = set(range(worker * self.slotsPerWorker,
+                          (worker + 1) * self.slotsPerWorker))
+        for sequence, (slot, sentAt) in self._inFlight.items():
+            if slot in slots:
+                del self._inFlight[sequence]
+                self.errors += 1
+                self._errorsMetric.inc()
+        self._free[worker] = deque(sorted(slots))
+        self._tasks[worker] = None
+        self._processes[worker] = None
+        if self.running:
+            self.restarts += 1
+            self._startWorker(worker)
+        self._deliver()
+        self._sendPending()
+
+
+    def _startWorker(self, worker):
+        # a new queue, so that nothing meant for a dead worker is left on it.
+        tasks = self._tasks[worker] = multiprocessing.Queue()
+        process = self._processes[worker] = multiprocessing.Process(
+            target=_work, name='txopenbci-offload-%d' % (worker,),
+            args=(self.function, self.buffer, self.slotSize, worker, tasks,
+                  self.results))
+        process.daemon = True
+        process.start()
+
+
+    def startService(self):
+        Service.startService(self)
+        self._pendingGauge.function = self._pendingFunction
+        self._stopped = Deferred()
+        for worker in range(self.workers):
+            self._startWorker(worker)
+        self._collector = threading.Thread(target=self._collect,
+                                           name='txopenbci-offload')
+        self._collector.daemon = True
+        self._collector.start()
+        self._sendPending()
+
+
+    def stopService(self):
+        """
+        :returns: a Deferred that fires once the workers have finished what
+            they were given and exited. Blocks still waiting for them are
+            dropped.
+        """
+        Service.stopService(self)
+        # unless another processor has taken it over since.
+        if self._pendingGauge.function is self._pendingFunction:
+            self._pendingGauge.function = None
+        if self._collector is None:
+            return None
+        self._collector = None
+        while self._pending:
+            self._drop(len(self._pending.popleft()))
+        self.pendingSamples = 0
+        for tasks in self._tasks:
+            if tasks is not None:
+                tasks.put(None)
+        return self._stopped
+
+
+    # == On the collector thread ==
+
+    def _collect(self):
+        callFromThread = self.reactor.callFromThread
+        # the processes that have exited, and those reported dead.
+        done = set()
+        while True:
+            try:
+                sequence, slot, ok, payload = self.results.get(
+                    timeout=self.pollInterval)
+            except Queue.Empty:
+                pass
+            else:
+                if sequence is None:
+                    done.add(self._processes[slot])
+                else:
+                    callFromThread(self._handleResult, sequence, slot, ok,
+                                   payload)
+            processes = [process for process in self._processes
+                         if process is not None]
+            for worker, process in enumerate(self._processes):
+                if process is not None and process not in done and \
+                        not process.is_alive():
+                    done.add(process)
+                    callFromThread(self._workerDied, worker, process)
+            if not self.running and all(process in done
+                                        for process in processes):
+                break
+        for process in processes:
+            process.join()
+        callFromThread(self._stopped.callback, None)
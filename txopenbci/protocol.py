@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
 from array import array
 from struct import Struct
+import sys
 
 try:
     import numpy
-except ImportError, e:
+except ImportError as e:
     numpy = None
     numpy_reason = e
 else:
@@ -12,6 +13,8 @@ else:
 
 
 BAUD_RATE = 115200
+# samples per second, in the board's default configuration.
+SAMPLE_RATE = 250
 
 CMD_RESET = b'v'
 CMD_STREAM_START = b'b'
@@ -34,16 +37,217 @@ SAMPLE_END = '\xC0'
 debug = anything:x -> receiver.logIncoming(x)
 uint8 = anything:x -> ord(x)
 """
+
+SAMPLE_START = b'\xA0'
+SAMPLE_END = b'\xC0'
+SAMPLE_SIZE = 33
+
+
+class FramingError(ValueError):
+    """The sample stream did not have the framing we expected."""
+
+
+# start byte, counter, 30 bytes of payload, end byte.
+_frameStruct = Struct('>BB30sB')
+_SAMPLE_START_VALUE = ord(SAMPLE_START)
+_SAMPLE_END_VALUE = ord(SAMPLE_END)
+
+
+class SampleFramer(object):
+    """
+    Split a stream of sample packets into frames without going through
+    the grammar.
+
+    This does the same job as the ``sample`` rule, but packets have a fixed
+    size, so we can check the markers of every frame in the buffer at once
+    and hand the whole run of frames to the receiver in one call.
+    """
+
+    def __init__(self, receiver):
+        self.receiver = receiver
+        self.pending = b''
+
+
+    def receive(self, data):
+        """
+        Hand every complete frame in ``data`` to ``receiver.handleFrames``.
+
+        Any trailing partial frame is held until the next call.
+
+        :raises FramingError: if a frame does not start and end with the
+            expected marker bytes.
+        """
+        if self.pending:
+            data = self.pending + data
+        count = len(data) // SAMPLE_SIZE
+        end = count * SAMPLE_SIZE
+        good = _countGoodFrames(data, count)
+        if good:
+            self.receiver.handleFrames(data, good, 0)
+        if good < count:
+            self.pending = b''
+            offset = good * SAMPLE_SIZE
+            raise FramingError(
+                "Bad sample frame at offset %d: %r" %
+                (offset, data[offset:offset + SAMPLE_SIZE]))
+        self.pending = data[end:]
+
+
+class ResynchronizingFramer(SampleFramer):
+    """
+    A `SampleFramer` that gets past a bad frame instead of giving up.
+
+    From the bad frame, it scans forward for the next start marker that
+    begins ``confirmFrames`` whole frames in a row, with the right markers
+    and counters that go up by one. Everything before that is thrown away,
+    and framing carries on from there. Each byte is looked at no more than
+    a few times, however long the scan.
+
+    :ivar corruptFrames: how many times the framing has gone wrong.
+    :ivar bytesDiscarded: how many bytes were skipped getting it right again.
+    """
+
+    confirmFrames = 2
+
+    def __init__(self, receiver):
+        SampleFramer.__init__(self, receiver)
+        self.corruptFrames = 0
+        self.bytesDiscarded = 0
+        self._scanning = False
+        # bytes skipped so far in the current scan.
+        self._skipped = 0
+
+
+    def receive(self, data):
+        """
+        Hand every complete frame in ``data`` to ``receiver.handleFrames``,
+        skipping over any garbage between them.
+
+        Whenever framing is recovered after a bad frame,
+        ``receiver.handleCorruptData`` is called with the number of bytes
+        that were thrown away.
+        """
+        if self.pending:
+            data = self.pending + data
+        offset = 0
+        while True:
+            if self._scanning:
+                offset = self._scan(data, offset)
+                if self._scanning:
+                    break
+            count = (len(data) - offset) // SAMPLE_SIZE
+            good = _countGoodFrames(data, count, offset)
+            if good:
+                self.receiver.handleFrames(data, good, offset)
+                offset += good * SAMPLE_SIZE
+            if good == count:
+                break
+            self.corruptFrames += 1
+            self._scanning = True
+            self._skipped = 1
+            offset += 1
+        self.pending = data[offset:]
+
+
+    def _scan(self, data, offset):
+        """
+        Look for where the frames start again.
+
+        :returns: the offset to carry on from: the new frame boundary if
+            there is one, or else where the scan should pick up when there's
+            more data.
+        """
+        needed = self.confirmFrames * SAMPLE_SIZE
+        while True:
+            candidate = data.find(SAMPLE_START, offset)
+            if candidate == -1:
+                self._skipped += len(data) - offset
+                return len(data)
+            self._skipped += candidate - offset
+            if len(data) - candidate < needed:
+                # can't tell yet.
+                return candidate
+            if _confirmFrames(data, candidate, self.confirmFrames):
+                self._scanning = False
+                self.bytesDiscarded += self._skipped
+                self.receiver.handleCorruptData(self._skipped)
+                return candidate
+            self._skipped += 1
+            offset = candidate + 1
+
+
+
+def _confirmFrames(data, offset, count):
+    """
+    Do ``count`` frames from ``offset`` have the right markers and
+    consecutive counters?
+    """
+    if _countGoodFrames(data, count, offset) < count:
+        return False
+    counters = bytearray(data[offset + 1:offset + count * SAMPLE_SIZE:
+                              SAMPLE_SIZE])
+    return all((counters[i + 1] - counters[i]) % 256 == 1
+               for i in range(count - 1))
+
+
+def _countGoodFrames(data, count, offset=0):
+    """
+    How many of the first ``count`` frames in ``data`` from ``offset`` have
+    the right markers?
+    """
+    end = offset + count * SAMPLE_SIZE
+    # Extended slices pick out every start and end marker without a Python
+    # loop. In the common case they all match and we're done.
+    starts = data[offset:end:SAMPLE_SIZE]
+    ends = data[offset + SAMPLE_SIZE - 1:end:SAMPLE_SIZE]
+    if starts == SAMPLE_START * count and ends == SAMPLE_END * count:
+        return count
+    unpack_from = _frameStruct.unpack_from
+    for i in range(count):
+        start, _, _, end = unpack_from(data, offset + i * SAMPLE_SIZE)
+        if start != _SAMPLE_START_VALUE or end != _SAMPLE_END_VALUE:
+            return i
+    return count
+
+
 # The ADS1299 outputs 24 bits of data per channel in binary twos complement
 # format, MSB first [data sheet SBAS499A]. OpenBCI passes it through in that
 # format to us, but most platforms do not have a 24-bit integer type, and
 # we're probably not using that big-endian byte order.
 
 # 24-bit integer is unusual enough that struct and numpy don't have tools
-# to unpack them, but we can treat it as a signed 8-bit part followed by
-# unsigned 16 bits and then reassemble.
+# to unpack them. Without numpy, we widen them to the size of a C long
+# instead: a bytearray gets the top bytes of each value from its sign
+# (through a translation table) and the bottom three from the value itself,
+# all by extended slice assignment, so there is no Python-level work per
+# value. Then array can read the result as native integers.
 
-_i3Struct = [Struct('>' + ('bH' * (n + 1))) for n in range(8)]
+# the high byte of a 24-bit value, to the byte that sign-extends it.
+_signExtension = bytes(bytearray([0xFF if i & 0x80 else 0
+                                  for i in range(256)]))
+_littleEndian = sys.byteorder == 'little'
+# array's fromstring is frombytes in Python 3.
+_arrayFromBytes = getattr(array, 'frombytes', None) or array.fromstring
+
+
+def _widen24(data, count):
+    """
+    Sign-extend ``count`` big-endian 24-bit values to an ``array('l')``.
+    """
+    output = array('l')
+    size = output.itemsize
+    wide = bytearray(size * count)
+    high = data[0::3]
+    sign = high.translate(_signExtension)
+    for i in range(size - 3):
+        wide[i::size] = sign
+    wide[size - 3::size] = high
+    wide[size - 2::size] = data[1::3]
+    wide[size - 1::size] = data[2::3]
+    _arrayFromBytes(output, bytes(wide))
+    if _littleEndian:
+        output.byteswap()
+    return output
 
 
 def python_int32From3Bytes(buf, count=-1, offset=0):
@@ -52,7 +256,25 @@ def python_int32From3Bytes(buf, count=-1, offset=0):
     an array of python integers.
     """
     if count == -1:
-        count = len(buf) / 3
+        count = (len(buf) - offset) // 3
+    data = buf[offset:offset + 3 * count]
+    return _widen24(data, count)
+
+
+# The decoders from before _widen24, which handle one value at a time: a
+# signed 8-bit part followed by unsigned 16 bits, then reassembled. They're
+# kept as a reference for the tests, and for the benchmark to compare.
+
+_i3Struct = [Struct('>' + ('bH' * (n + 1))) for n in range(8)]
+
+
+def _reference_int32From3Bytes(buf, count=-1, offset=0):
+    """
+    `python_int32From3Bytes`, as it was: no more than 8 values, each
+    reassembled in Python.
+    """
+    if count == -1:
+        count = (len(buf) - offset) // 3
     sizedStruct = _i3Struct[count - 1]
     # this unpacks to an alternating sequence of high bytes and lower 16-bits
     parts = sizedStruct.unpack_from(buf, offset=offset)
@@ -64,6 +286,25 @@ def python_int32From3Bytes(buf, count=-1, offset=0):
     return output
 
 
+def _reference_decodeSamples(buf, count=-1, offset=0):
+    """
+    `python_decodeSamples`, as it was: each packet decoded on its own.
+    """
+    if count == -1:
+        count = (len(buf) - offset) // SAMPLE_SIZE
+    counters = array('B')
+    eeg = []
+    accelerometer = []
+    unpack_from = _frameStruct.unpack_from
+    for i in range(count):
+        frameOffset = offset + i * SAMPLE_SIZE
+        counters.append(unpack_from(buf, frameOffset)[1])
+        eeg.append(_reference_int32From3Bytes(buf, 8, frameOffset + 2))
+        accelerometer.append(
+            python_accelerometerFromBytes(buf, frameOffset + 26))
+    return counters, eeg, accelerometer
+
+
 _accelerometerStruct = Struct('>hhh')
 
 
@@ -74,6 +315,14 @@ def python_accelerometerFromBytes(buf, offset=0):
 
 if numpy:
     _i1u2 = numpy.dtype([('high', 'i1'), ('low', '>u2')])
+    # One whole sample packet, so a buffer of them can be viewed as an array.
+    _frameDtype = numpy.dtype([
+        ('start', 'u1'),
+        ('counter', 'u1'),
+        ('eeg', _i1u2, (8,)),
+        ('accelerometer', '>i2', (3,)),
+        ('end', 'u1'),
+    ])
 
 
 def numpy_int32From3Bytes(buf, count=-1, offset=0):
@@ -94,10 +343,64 @@ def numpy_accelerometerFromBytes(buf, offset=0):
     return in_array.astype('i2')
 
 
+def python_decodeSamples(buf, count=-1, offset=0):
+    """
+    Decode ``count`` contiguous sample packets.
+
+    The EEG and accelerometer bytes of all the packets are gathered up and
+    converted in one go each, so the only Python-level work per packet is
+    slicing.
+
+    :returns: a tuple of counters (an ``array('B')``), EEG values (a list of
+        ``array('l')`` rows) and accelerometer values (a list of
+        ``array('h')`` rows).
+    """
+    if count == -1:
+        count = (len(buf) - offset) // SAMPLE_SIZE
+    end = offset + count * SAMPLE_SIZE
+    counters = array('B', buf[offset + 1:end:SAMPLE_SIZE])
+
+    channels = 8
+    eeg = _widen24(b''.join([buf[i:i + 3 * channels]
+                             for i in range(offset + 2, end, SAMPLE_SIZE)]),
+                   count * channels)
+
+    axes = 3
+    accelerometerValues = array('h')
+    _arrayFromBytes(accelerometerValues, b''.join([
+        buf[i:i + 2 * axes] for i in range(offset + 26, end, SAMPLE_SIZE)]))
+    if _littleEndian:
+        accelerometerValues.byteswap()
+
+    return (counters,
+            [eeg[i:i + channels] for i in range(0, count * channels, channels)],
+            [accelerometerValues[i:i + axes]
+             for i in range(0, count * axes, axes)])
+
+
+def numpy_decodeSamples(buf, count=-1, offset=0):
+    """
+    Decode ``count`` contiguous sample packets.
+
+    :returns: a tuple of counters (uint8, shape ``(count,)``), EEG values
+        (int32, shape ``(count, 8)``) and accelerometer values (int16, shape
+        ``(count, 3)``).
+    """
+    frames = numpy.frombuffer(buf, _frameDtype, count=count, offset=offset)
+    eeg = frames['eeg']['high'].astype('i4')
+    eeg <<= 16
+    eeg |= frames['eeg']['low']
+    accelerometer = frames['accelerometer'].astype('i2')
+    counters = frames['counter'].copy()
+    return counters, eeg, accelerometer
+
+
 if numpy:
     int32From3Bytes = numpy_int32From3Bytes
     accelerometerFromBytes = numpy_accelerometerFromBytes
+    decodeSamples = numpy_decodeSamples
 else:
     int32From3Bytes = python_int32From3Bytes
     accelerometerFromBytes = python_accelerometerFromBytes
+    decodeSamples = python_decodeSamples
 
@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+"""
+Summaries of a recording at several resolutions, kept as it's written, for
+looking over a long session without reading every sample.
+
+Each level cuts the recording into buckets of a fixed number of samples,
+each bucket a multiple of the level below's, and keeps the minimum, maximum
+and mean of each EEG channel over every bucket. Buckets of the finest level
+are summarized from samples as they arrive; when one fills, it's written
+out and folded into the bucket of the next level up, and so on. So the
+pyramid costs a little per block, and nothing after the recording ends.
+
+The summaries go in a sidecar file next to the recording, one fixed-size
+record per bucket, appended as buckets fill::
+
+    MAGIC
+    uint32 header length
+    header: JSON, with ``levels`` (samples per bucket) and ``time0``
+    records, each:
+        uint8   level
+        uint32  count: samples in the bucket
+        uint32  valid: samples in the bucket that aren't gaps
+        uint64  start: the index of its first sample in the recording
+        float64 time: of its first sample, seconds since ``time0``
+        int32   min[8]
+        int32   max[8]
+        float64 mean[8]
+
+Buckets still filling are written, short, when the recording is closed. If
+it never is, `Pyramid` makes up the coarser levels' last buckets from the
+finer ones, so all that's lost is the last, partly-filled finest bucket.
+"""
+import json
+import os
+from struct import Struct
+
+try:
+    import numpy
+except ImportError as e:
+    numpy = None
+    numpy_reason = e
+else:
+    numpy_reason = None
+
+from .protocol import SAMPLE_RATE
+from .ring import EEG_CHANNELS, GAP_EEG
+
+
+MAGIC = b'txOBCIp\n'
+VERSION = 1
+EXTENSION = '.pyr'
+
+# one second, ten seconds, a minute and ten minutes.
+LEVELS = (SAMPLE_RATE, SAMPLE_RATE * 10, SAMPLE_RATE * 60,
+          SAMPLE_RATE * 600)
+
+_headerLength = Struct('<I')
+_record = Struct('<BIIQd%di%di%dd' % ((EEG_CHANNELS,) * 3))
+
+
+
+class Summary(object):
+    """
+    The minimum, maximum and mean of each channel over a bucket of samples.
+    """
+    __slots__ = ['level', 'count', 'valid', 'start', 'time', 'min', 'max',
+                 'mean']
+
+    def __init__(self, level, count, valid, start, time, min, max, mean):
+        self.level = level
+        self.count = count
+        self.valid = valid
+        self.start = start
+        self.time = time
+        self.min = min
+        self.max = max
+        self.mean = mean
+
+
+    def __repr__(self):
+        return 'Summary(%d, %d, %d, %d, %r)' % (
+            self.level, self.count, self.valid, self.start, self.time)
+
+
+    @classmethod
+    def combine(cls, summaries, level=None):
+        """
+        Summarize several consecutive summaries as one.
+        """
+        first = summaries[0]
+        valid = sum(summary.valid for summary in summaries)
+        counted = [summary for summary in summaries if summary.valid]
+        if counted:
+            minimum = [min(values) for values in
+                       zip(*[summary.min for summary in counted])]
+            maximum = [max(values) for values in
+                       zip(*[summary.max for summary in counted])]
+            mean = [sum(values) / valid for values in zip(
+                *[[m * summary.valid for m in summary.mean]
+                  for summary in counted])]
+        else:
+            minimum = maximum = [0] * EEG_CHANNELS
+            mean = [float('nan')] * EEG_CHANNELS
+        return cls(first.level if level is None else level,
+                   sum(summary.count for summary in summaries), valid,
+                   first.start, first.time, minimum, maximum, mean)
+
+
+
+class _Bucket(object):
+    """A bucket still filling, with sums rather than means."""
+
+    def __init__(self, start, time):
+        self.start = start
+        self.time = time
+        self.count = 0
+        self.valid = 0
+        self.min = [0] * EEG_CHANNELS
+        self.max = [0] * EEG_CHANNELS
+        self.sum = [0.0] * EEG_CHANNELS
+
+
+    def add(self, count, valid, minimum, maximum, sums):
+        if valid:
+            if self.valid:
+                self.min = map(min, self.min, minimum)
+                self.max = map(max, self.max, maximum)
+                self.sum = map(float.__add__, self.sum, sums)
+            else:
+                self.min, self.max = list(minimum), list(maximum)
+                self.sum = [float(s) for s in sums]
+        self.count += count
+        self.valid += valid
+
+
+    def summary(self, level):
+        if self.valid:
+            mean = [s / self.valid for s in self.sum]
+        else:
+            mean = [float('nan')] * EEG_CHANNELS
+        return Summary(level, self.count, self.valid, self.start, self.time,
+                       self.min, self.max, mean)
+
+
+
+def _summarizeRows(eeg, start, stop):
+    """
+    :returns: the number of rows from ``start`` to ``stop`` that aren't
+        gaps, and their minimum, maximum and sum for each channel.
+    """
+    if numpy and isinstance(eeg, numpy.ndarray):
+        rows = eeg[start:stop]
+        rows = rows[rows[:, 0] != GAP_EEG]
+        if not len(rows):
+            return 0, None, None, None
+        return (len(rows), rows.min(axis=0).tolist(),
+                rows.max(axis=0).tolist(),
+                rows.sum(axis=0, dtype='f8').tolist())
+    rows = [row for row in eeg[start:stop] if row[0] != GAP_EEG]
+    if not rows:
+        return 0, None, None, None
+    columns = zip(*rows)
+    return (len(rows), [min(column) for column in columns],
+            [max(column) for column in columns],
+            [float(sum(column)) for column in columns])
+
+
+
+class PyramidWriter(object):
+    """
+    Keep the summaries of a recording as its samples are written.
+    """
+
+    def __init__(self, fileobj, time0, levels=LEVELS):
+        """
+        :param fileobj: a file opened for binary writing.
+        :param time0: the time the recording began, seconds since the epoch.
+        :param levels: the samples in each level's buckets, finest first.
+            Each must be a multiple of the one before.
+        """
+        for finer, coarser in zip(levels, levels[1:]):
+            if coarser % finer:
+                raise ValueError("Level of %d samples is not a multiple of "
+                                 "%d" % (coarser, finer))
+        self.fileobj = fileobj
+        self.time0 = time0
+        self.levels = tuple(levels)
+        self.samples = 0
+        self._buckets = [None] * len(levels)
+        header = json.dumps({
+            'version': VERSION,
+            'levels': self.levels,
+            'time0': time0,
+        })
+        fileobj.write(MAGIC + _headerLength.pack(len(header)) + header)
+
+
+    def writeBlock(self, block, timestamps):
+        """
+        :type block: txopenbci.ring.SampleBlock
+        :param timestamps: a sequence with the time of each sample in the
+            block.
+        """
+        position = 0
+        size = self.levels[0]
+        while position < len(block):
+            bucket = self._buckets[0]
+            if bucket is None:
+                bucket = self._buckets[0] = _Bucket(
+                    self.samples, float(timestamps[position]) - self.time0)
+            stop = min(len(block), position + size - bucket.count)
+            valid, minimum, maximum, sums = _summarizeRows(
+                block.eeg, position, stop)
+            bucket.add(stop - position, valid, minimum, maximum, sums)
+            self.samples += stop - position
+            position = stop
+            if bucket.count == size:
+                self._finish(0)
+
+
+    def _finish(self, level):
+        """
+        Write out a level's bucket, and fold it into the next.
+        """
+        summary = self._buckets[level].summary(level)
+        self._buckets[level] = None
+        self._write(summary)
+        if level + 1 < len(self.levels):
+            bucket = self._buckets[level + 1]
+            if bucket is None:
+                bucket = self._buckets[level + 1] = _Bucket(summary.start,
+                                                            summary.time)
+            bucket.add(summary.count, summary.valid, summary.min,
+                       summary.max,
+                       [m * summary.valid for m in summary.mean])
+            if bucket.count == self.levels[level + 1]:
+                self._finish(level + 1)
+
+
+    def _write(self, summary):
+        self.fileobj.write(_record.pack(
+            summary.level, summary.count, summary.valid, summary.start,
+            summary.time, *(list(summary.min) + list(summary.max) +
+                            list(summary.mean))))
+
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+    def close(self):
+        """
+        Write out the buckets still filling, short.
+        """
+        for level in range(len(self.levels)):
+            if self._buckets[level] is not None:
+                self._finish(level)
+        self.fileobj.close()
+
+
+
+class Pyramid(object):
+    """
+    The summaries of a recording, read from its sidecar file.
+
+    :ivar levels: the samples in each level's buckets.
+    :ivar time0: when the recording began, seconds since the epoch.
+    :ivar summaries: a list for each level of its `Summary` objects, in
+        order.
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as fileobj:
+            magic = fileobj.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError("Not a txOpenBCI summary: %r" % (magic,))
+            (length,) = _headerLength.unpack(
+                fileobj.read(_headerLength.size))
+            header = json.loads(fileobj.read(length))
+            if header['version'] > VERSION:
+                raise ValueError("Summary version %s is newer than %s" %
+                                 (header['version'], VERSION))
+            data = fileobj.read()
+        self.levels = tuple(header['levels'])
+        self.time0 = header['time0']
+        self.summaries = [[] for level in self.levels]
+        # a partly-written record at the end is left out.
+        for offset in range(0, len(data) - _record.size + 1, _record.size):
+            values = _record.unpack_from(data, offset)
+            channels = EEG_CHANNELS
+            self.summaries[values[0]].append(Summary(
+                *(values[:5] + (values[5:5 + channels],
+                                values[5 + channels:5 + 2 * channels],
+                                values[5 + 2 * channels:]))))
+        self._recover()
+
+
+    def _recover(self):
+        """
+        Make up the last bucket of each level from the level below, where
+        the recording wasn't closed and there's more below than above.
+        """
+        for level in range(1, len(self.levels)):
+            above = self.summaries[level]
+            end = above[-1].start + above[-1].count if above else 0
+            below = [summary for summary in self.summaries[level - 1]
+                     if summary.start >= end]
+            if below:
+                above.append(Summary.combine(below, level))
+
+
+    def levelFor(self, bucketSize):
+        """
+        :returns: the coarsest level whose buckets are no bigger than
+            ``bucketSize`` samples, or None if even the finest are.
+        """
+        found = None
+        for level, size in enumerate(self.levels):
+            if size <= bucketSize:
+                found = level
+        return found
+
+
+def sidecarName(filename):
+    """
+    :returns: the name of the summaries of the recording ``filename``.
+    """
+    return filename + EXTENSION
+
+
+def openSidecar(filename, time0, levels=LEVELS):
+    """
+    Start the summaries of a recording being written to ``filename``.
+
+    :rtype: PyramidWriter
+    """
+    return PyramidWriter(open(sidecarName(filename), 'wb'), time0, levels)
+
+
+def loadSidecar(filename):
+    """
+    :returns: the summaries of the recording ``filename`` as a `Pyramid`,
+        or None if it has none.
+    """
+    if not os.path.exists(sidecarName(filename)):
+        return None
+    return Pyramid(sidecarName(filename))
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+A compact binary format for sensor recordings.
+
+A recording is a short header followed by fixed-size little-endian records,
+one per sample::
+
+    MAGIC
+    uint32 header length
+    header: JSON, describing the record fields and when recording began
+    records...
+
+Because every record is the same size, a reader can map the file and treat
+it as an array without parsing anything.
+
+To convert a recording to the CSV layout written by `sink.SensorLog`::
+
+    python -m txopenbci.recording sensor.1234.54c3a1f0.rec sensor.csv
+"""
+import csv
+import json
+import mmap
+import os
+import sys
+from struct import Struct
+
+try:
+    import numpy
+except ImportError as e:
+    numpy = None
+    numpy_reason = e
+else:
+    numpy_reason = None
+
+
+MAGIC = b'txOBCIr\n'
+VERSION = 1
+
+FIELDS = [
+    ['counter', '<u1'],
+    ['eeg', '<i4', [8]],
+    ['accelerometer', '<i2', [3]],
+    ['timestamp', '<f8'],
+]
+
+CSV_HEADER = [
+    'count',
+    's1', 's2', 's3', 's4', 's5', 's6', 's7', 's8',
+    'x', 'y', 'z',
+    'clock'
+]
+
+_headerLength = Struct('<I')
+
+# struct codes for the numpy type strings we use in FIELDS.
+_structCodes = {
+    '<u1': 'B',
+    '<i2': 'h',
+    '<i4': 'i',
+    '<f8': 'd',
+}
+
+
+def recordStruct(fields):
+    """
+    Make a Struct that packs one record with the given fields.
+    """
+    codes = ['<']
+    for field in fields:
+        count = field[2][0] if len(field) > 2 else 1
+        codes.append('%d%s' % (count, _structCodes[field[1]]))
+    return Struct(''.join(codes))
+
+
+def recordDtype(fields):
+    """
+    Make the numpy dtype of one record with the given fields.
+    """
+    return numpy.dtype([tuple(field[:2]) + tuple(tuple(f) for f in field[2:])
+                        for field in fields])
+
+
+_recordStruct = recordStruct(FIELDS)
+RECORD_SIZE = _recordStruct.size
+
+if numpy:
+    _recordDtype = recordDtype(FIELDS)
+
+
+
+class RecordingWriter(object):
+    """
+    Write samples to a binary recording.
+
+    Records are collected in memory and written in chunks of at least
+    ``chunkSize`` bytes.
+    """
+
+    def __init__(self, fileobj, time0, chunkSize=64 * 1024):
+        """
+        :param fileobj: a file opened for binary writing.
+        :param time0: the time the recording began, seconds since the epoch.
+        """
+        self.fileobj = fileobj
+        self.chunkSize = chunkSize
+        self._chunks = []
+        self._buffered = 0
+        header = json.dumps({
+            'version': VERSION,
+            'fields': FIELDS,
+            'recordSize': RECORD_SIZE,
+            'time0': time0,
+        })
+        fileobj.write(MAGIC + _headerLength.pack(len(header)) + header)
+
+
+    def writeBlock(self, block, timestamps):
+        """
+        :type block: txopenbci.ring.SampleBlock
+        :param timestamps: a sequence with the time of each sample in the block.
+        """
+        if numpy and isinstance(block.eeg, numpy.ndarray):
+            records = numpy.empty(len(block), _recordDtype)
+            records['counter'] = block.counter
+            records['eeg'] = block.eeg
+            records['accelerometer'] = block.accelerometer
+            records['timestamp'] = timestamps
+            data = records.tobytes()
+        else:
+            pack = _recordStruct.pack
+            data = b''.join([
+                pack(block.counter[i], *(tuple(block.eeg[i]) +
+                                         tuple(block.accelerometer[i]) +
+                                         (timestamps[i],)))
+                for i in range(len(block))])
+        self._chunks.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.chunkSize:
+            self.flush()
+
+
+    def flush(self):
+        self.fileobj.write(b''.join(self._chunks))
+        self.fileobj.flush()
+        self._chunks = []
+        self._buffered = 0
+
+
+    def close(self):
+        self.flush()
+        self.fileobj.close()
+
+
+
+def readHeader(fileobj):
+    """
+    Read the header from the start of a recording.
+
+    :returns: the header dict, with ``dataOffset`` added.
+    :raises ValueError: if this is not a recording we understand.
+    """
+    magic = fileobj.read(len(MAGIC))
+    if magic != MAGIC:
+        raise ValueError("Not a txOpenBCI recording: %r" % (magic,))
+    (length,) = _headerLength.unpack(fileobj.read(_headerLength.size))
+    header = json.loads(fileobj.read(length))
+    if header['version'] > VERSION:
+        raise ValueError("Recording version %s is newer than %s" %
+                         (header['version'], VERSION))
+    header['dataOffset'] = len(MAGIC) + _headerLength.size + length
+    return header
+
+
+
+class Recording(object):
+    """
+    A recording file, mapped into memory.
+
+    :ivar header: the recording's header dict.
+    :ivar records: a read-only numpy structured array with one element per
+        sample. A partly-written record at the end of the file (say, from a
+        crash) is left out.
+    """
+
+    def __init__(self, filename):
+        if numpy is None:
+            raise RuntimeError("Reading recordings as arrays needs numpy: %s"
+                               % (numpy_reason,))
+        with open(filename, 'rb') as fileobj:
+            self.header = readHeader(fileobj)
+        size = os.path.getsize(filename)
+        offset = self.header['dataOffset']
+        count = (size - offset) // self.header['recordSize']
+        dtype = recordDtype(self.header['fields'])
+        if count:
+            self.records = numpy.memmap(filename, dtype, mode='r',
+                                        offset=offset, shape=(count,))
+        else:
+            # mmap refuses to map zero bytes.
+            self.records = numpy.zeros(0, dtype)
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+
+def iterRecords(filename):
+    """
+    Read a recording without numpy.
+
+    The file is only open while the records are being iterated over; if
+    you stop before the end, ``close`` the iterator to let it go.
+
+    :returns: the header, and an iterator of records as flat tuples.
+    """
+    with open(filename, 'rb') as fileobj:
+        header = readHeader(fileobj)
+    struct = recordStruct(header['fields'])
+
+    def records():
+        fileobj = open(filename, 'rb')
+        try:
+            if os.fstat(fileobj.fileno()).st_size <= header['dataOffset']:
+                return
+            data = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                end = len(data) - struct.size
+                offset = header['dataOffset']
+                while offset <= end:
+                    yield struct.unpack_from(data, offset)
+                    offset += struct.size
+            finally:
+                data.close()
+        finally:
+            fileobj.close()
+
+    return header, records()
+
+
+def recordingToCSV(source, destination):
+    """
+    Convert a binary recording to the CSV layout of `sink.SensorLog`.
+    """
+    header, records = iterRecords(source)
+    time0 = header['time0']
+    try:
+        with open(destination, 'wb') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(CSV_HEADER)
+            for record in records:
+                row = list(record)
+                row[-1] -= time0
+                writer.writerow(row)
+    finally:
+        records.close()
+
+
+if __name__ == '__main__':
+    recordingToCSV(*sys.argv[1:3])
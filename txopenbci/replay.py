@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-ins for the OpenBCI hardware, and a tap to record what the real thing
+says.
+
+`ReplayEndpoint` can be used anywhere `control.serialOpenBCI` is. It answers
+the reset command the way a board does, and once streaming is started it
+plays back a captured raw stream (or one made by `synthesizeStream`) at real
+time, some multiple of real time, or as fast as the reactor will take it.
+
+`CaptureEndpoint` wraps another endpoint and saves every byte received from
+it, to make captures for replay.
+"""
+import math
+from struct import Struct
+
+from twisted.application.service import Service
+from twisted.internet import defer
+from twisted.internet.error import ConnectionDone
+from twisted.internet.interfaces import IStreamClientEndpoint, ITransport
+from twisted.protocols.policies import ProtocolWrapper, WrappingFactory
+from twisted.python.failure import Failure
+from zope.interface import implementer
+
+from . import protocol
+from .serial_endpoint import SerialAddress
+
+
+SAMPLE_RATE = protocol.SAMPLE_RATE
+
+RESET_RESPONSE = (
+    b'OpenBCI V3 32bit Board\n'
+    b'Setting ADS1299 Channel Values\n'
+    b'ADS1299 Device ID: 0x3E\r\n'
+    b'LIS3DH Device ID: 0x33\r\n'
+    b'$$$'
+)
+
+_int32Struct = Struct('>i')
+_headStruct = Struct('>BB')
+_accelerometerStruct = Struct('>hhh')
+
+
+def synthesizeStream(packets, sampleRate=SAMPLE_RATE):
+    """
+    Make a raw sample stream of ``packets`` packets.
+
+    Each channel carries a sine wave of a different frequency, so the result
+    is easy to recognize on a plot.
+    """
+    frames = []
+    head = _headStruct.pack
+    int32 = _int32Struct.pack
+    accelerometer = _accelerometerStruct.pack(0, 0, 0x1000)
+    for n in range(packets):
+        # channel 1 at 2 Hz, channel 2 at 4 Hz, and so on.
+        phase = 2 * math.pi * 2 * float(n) / sampleRate
+        eeg = b''.join([
+            int32(int(100000 * math.sin(phase * (channel + 1))))[1:]
+            for channel in range(8)])
+        frames.append(head(ord(protocol.SAMPLE_START), n % 256) + eeg +
+                      accelerometer + protocol.SAMPLE_END)
+    return b''.join(frames)
+
+
+
+@implementer(ITransport)
+class ReplayTransport(object):
+    """
+    A transport that behaves like an OpenBCI board, as far as the commands
+    from `control.DeviceSender` are concerned.
+
+    :ivar bytesSent: how much of the stream has been delivered.
+    """
+
+    disconnecting = False
+    disconnected = False
+
+    def __init__(self, proto, reactor, data, speed=1.0, loop=True,
+                 tick=0.01, chunkSize=64 * 1024, address=None):
+        """
+        :param data: the raw bytes to play back when streaming.
+        :param speed: how many times faster than real time to play back, or
+            None to go as fast as possible.
+        :param loop: whether to start over at the end of ``data``.
+        :param tick: seconds between deliveries when playing back at a
+            finite speed.
+        :param chunkSize: bytes per delivery when going as fast as possible.
+        """
+        self.protocol = proto
+        self.reactor = reactor
+        self.data = data
+        self.speed = speed
+        self.loop = loop
+        self.tick = tick
+        self.chunkSize = chunkSize
+        self.address = address
+        self.bytesSent = 0
+        self._position = 0
+        self._call = None
+        self._started = None
+        self._startPosition = 0
+
+
+    # == What the board does ==
+
+    def write(self, data):
+        for command in data:
+            if command == protocol.CMD_RESET:
+                self._stop()
+                self.reactor.callLater(0, self._deliver, RESET_RESPONSE)
+            elif command == protocol.CMD_STREAM_START:
+                self._start()
+            elif command == protocol.CMD_STREAM_STOP:
+                self._stop()
+
+
+    def writeSequence(self, data):
+        self.write(b''.join(data))
+
+
+    def _deliver(self, data):
+        if not self.disconnected:
+            self.protocol.dataReceived(data)
+
+
+    def _start(self):
+        if self._call is None:
+            self._started = self.reactor.seconds()
+            self._startPosition = self.bytesSent
+            self._schedule()
+
+
+    def _stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+
+    def _schedule(self):
+        delay = 0 if self.speed is None else self.tick
+        self._call = self.reactor.callLater(delay, self._play)
+
+
+    def _play(self):
+        if self.speed is None:
+            length = self.chunkSize
+        else:
+            elapsed = self.reactor.seconds() - self._started
+            due = int(elapsed * self.speed * SAMPLE_RATE) * protocol.SAMPLE_SIZE
+            length = due - (self.bytesSent - self._startPosition)
+
+        chunks = []
+        while length > 0:
+            if self._position >= len(self.data):
+                if not self.loop:
+                    break
+                self._position = 0
+            chunk = self.data[self._position:self._position + length]
+            self._position += len(chunk)
+            length -= len(chunk)
+            chunks.append(chunk)
+
+        data = b''.join(chunks)
+        self.bytesSent += len(data)
+        self._call = None
+        if data:
+            self._deliver(data)
+        if self._call is None and not self.disconnected and (
+                self.loop or self._position < len(self.data)):
+            self._schedule()
+
+
+    # == The rest of ITransport ==
+
+    def loseConnection(self):
+        if self.disconnecting:
+            return
+        self.disconnecting = True
+        self._stop()
+        self.reactor.callLater(0, self._connectionLost)
+
+
+    abortConnection = loseConnection
+
+
+    def _connectionLost(self):
+        self.disconnected = True
+        self.protocol.connectionLost(Failure(ConnectionDone()))
+
+
+    def getPeer(self):
+        return self.address
+
+
+    def getHost(self):
+        return self.address
+
+
+
+@implementer(IStreamClientEndpoint)
+class ReplayEndpoint(object):
+    """
+    An endpoint that connects to a pretend OpenBCI board.
+
+    See `ReplayTransport` for the arguments.
+    """
+
+    def __init__(self, reactor, data, **kwargs):
+        self.reactor = reactor
+        self.data = data
+        self.kwargs = kwargs
+        self.transports = []
+
+
+    def connect(self, protocolFactory):
+        address = SerialAddress('replay')
+        try:
+            proto = protocolFactory.buildProtocol(address)
+            transport = ReplayTransport(proto, self.reactor, self.data,
+                                        address=address, **self.kwargs)
+            proto.makeConnection(transport)
+        except Exception:
+            return defer.fail()
+        self.transports.append(transport)
+        return defer.succeed(proto)
+
+
+def replayOpenBCI(filename, reactor, speed=1.0, loop=True):
+    """
+    Make an endpoint that replays a raw capture, as from `CaptureEndpoint`
+    or `control.DeviceReceiver.logIncoming`.
+
+    :param speed: how many times faster than real time to play back, or
+        None to go as fast as possible.
+    """
+    with open(filename, 'rb') as capture:
+        data = capture.read()
+    return ReplayEndpoint(reactor, data, speed=speed, loop=loop)
+
+
+
+class _CaptureProtocol(ProtocolWrapper):
+
+    def dataReceived(self, data):
+        if not self.factory.capture.closed:
+            self.factory.capture.write(data)
+        ProtocolWrapper.dataReceived(self, data)
+
+
+    def connectionLost(self, reason):
+        if not self.factory.capture.closed:
+            self.factory.capture.flush()
+        ProtocolWrapper.connectionLost(self, reason)
+
+
+
+class _CaptureFactory(WrappingFactory):
+    protocol = _CaptureProtocol
+
+    def __init__(self, wrappedFactory, capture):
+        WrappingFactory.__init__(self, wrappedFactory)
+        self.capture = capture
+
+
+
+@implementer(IStreamClientEndpoint)
+class CaptureEndpoint(Service):
+    """
+    Wrap another endpoint and save everything received from it.
+
+    The endpoint owns the capture file, and closes it when stopped as a
+    service; stop it after the device, so the capture isn't cut short.
+    """
+
+    def __init__(self, wrappedEndpoint, capture):
+        """
+        :param capture: a file opened for binary writing.
+        """
+        self.wrappedEndpoint = wrappedEndpoint
+        self.capture = capture
+
+
+    def stopService(self):
+        Service.stopService(self)
+        self.capture.close()
+
+
+    def connect(self, protocolFactory):
+        d = self.wrappedEndpoint.connect(
+            _CaptureFactory(protocolFactory, self.capture))
+        # hand back the protocol that was asked for, not our wrapper.
+        d.addCallback(lambda wrapper: wrapper.wrappedProtocol)
+        return d
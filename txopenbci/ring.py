@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+"""
+A fixed-size history of recent samples, shared by everyone who reads them.
+
+The receiver writes each decoded block into the ring once. Readers hold a
+`RingCursor` and get views of the rows written since they last looked, so
+no one allocates per-sample objects and memory use doesn't grow with the
+length of the recording.
+"""
+from array import array
+
+try:
+    import numpy
+except ImportError as e:
+    numpy = None
+    numpy_reason = e
+else:
+    numpy_reason = None
+
+
+EEG_CHANNELS = 8
+ACCELEROMETER_AXES = 3
+
+# one minute at the board's default 250 Hz.
+DEFAULT_CAPACITY = 250 * 60
+
+# what SampleBlock.fillGaps puts in the rows of lost samples. The ADC only
+# gives 24 bits, so no real sample has this EEG value.
+GAP_EEG = -2 ** 31
+GAP_ACCELEROMETER = -2 ** 15
+
+
+class RawSample(object):
+    __slots__ = ['counter', 'eeg', 'accelerometer', 'timestamp', 'index']
+
+    def __init__(self, counter, eeg, accelerometer, timestamp=None,
+                 index=None):
+        self.counter = counter
+        self.eeg = eeg
+        self.accelerometer = accelerometer
+        self.timestamp = timestamp
+        self.index = index
+
+    def __hash__(self):
+        return hash((self.counter, self.eeg, self.accelerometer))
+
+
+
+class SampleBlock(object):
+    """
+    Several consecutive samples, decoded together.
+
+    ``eeg`` and ``accelerometer`` have one row per sample; with numpy they are
+    2-d arrays, otherwise lists of arrays.
+
+    ``timestamp``, if known, has the time each sample was taken, in seconds
+    since the epoch. See `txopenbci.timing.ClockModel`.
+
+    ``index``, if known, has the running index of each sample in the
+    stream, which unlike the counter doesn't wrap, and skips over any
+    samples that were lost. See `txopenbci.timing.CounterUnwrapper`.
+    """
+    __slots__ = ['counter', 'eeg', 'accelerometer', 'timestamp', 'index']
+
+    def __init__(self, counter, eeg, accelerometer, timestamp=None,
+                 index=None):
+        self.counter = counter
+        self.eeg = eeg
+        self.accelerometer = accelerometer
+        self.timestamp = timestamp
+        self.index = index
+
+    def __len__(self):
+        return len(self.counter)
+
+    def copy(self):
+        """
+        Make a copy of this block that doesn't share memory with it, as for
+        keeping a block from a ring.
+        """
+        if numpy and isinstance(self.eeg, numpy.ndarray):
+            return SampleBlock(
+                self.counter.copy(), self.eeg.copy(),
+                self.accelerometer.copy(),
+                None if self.timestamp is None else self.timestamp.copy(),
+                None if self.index is None else self.index.copy())
+        return SampleBlock(
+            array('B', self.counter),
+            [array('l', row) for row in self.eeg],
+            [array('h', row) for row in self.accelerometer],
+            None if self.timestamp is None else array('d', self.timestamp),
+            None if self.index is None else array('d', self.index))
+
+    def slice(self, start, stop):
+        """
+        Get some of the rows of this block, as a view where that's possible.
+        """
+        return SampleBlock(
+            self.counter[start:stop], self.eeg[start:stop],
+            self.accelerometer[start:stop],
+            None if self.timestamp is None else self.timestamp[start:stop],
+            None if self.index is None else self.index[start:stop])
+
+    def withEEG(self, eeg):
+        """
+        Make a block of the same samples with different EEG values, as from a
+        filter.
+        """
+        return SampleBlock(self.counter, eeg, self.accelerometer,
+                           self.timestamp, self.index)
+
+    def fillGaps(self):
+        """
+        Make a block with a row for every index from the first of this one to
+        the last, as for consumers that need a fixed stride.
+
+        The rows of lost samples have `GAP_EEG` and `GAP_ACCELEROMETER` for
+        values, the counter they should have had, and timestamps
+        interpolated from their neighbours. The block must have ``index``.
+        """
+        index = self.index
+        total = int(index[-1] - index[0]) + 1 if len(self) else 0
+        if total == len(self):
+            return self
+        start = int(index[0])
+        if numpy and isinstance(self.eeg, numpy.ndarray):
+            positions = numpy.asarray(index, 'i8') - start
+            filledIndex = numpy.arange(start, start + total, dtype='i8')
+            counter = ((filledIndex - start + int(self.counter[0])) %
+                       256).astype('u1')
+            eeg = numpy.empty((total, self.eeg.shape[1]), self.eeg.dtype)
+            eeg.fill(GAP_EEG)
+            eeg[positions] = self.eeg
+            accelerometer = numpy.empty(
+                (total, self.accelerometer.shape[1]), self.accelerometer.dtype)
+            accelerometer.fill(GAP_ACCELEROMETER)
+            accelerometer[positions] = self.accelerometer
+            timestamp = self.timestamp
+            if timestamp is not None:
+                timestamp = numpy.interp(filledIndex, index, timestamp)
+            return SampleBlock(counter, eeg, accelerometer, timestamp,
+                               filledIndex)
+
+        first = int(self.counter[0])
+        counter = array('B', [(first + i) % 256 for i in range(total)])
+        eeg = [None] * total
+        accelerometer = [None] * total
+        timestamp = None if self.timestamp is None else array('d', [0]) * total
+        for row in range(len(self)):
+            position = int(index[row]) - start
+            eeg[position] = self.eeg[row]
+            accelerometer[position] = self.accelerometer[row]
+            if timestamp is not None:
+                timestamp[position] = self.timestamp[row]
+        channels = len(self.eeg[0])
+        axes = len(self.accelerometer[0])
+        before = 0
+        for position in range(total):
+            if eeg[position] is not None:
+                before = position
+                continue
+            eeg[position] = array('l', [GAP_EEG]) * channels
+            accelerometer[position] = array('h', [GAP_ACCELEROMETER]) * axes
+            if timestamp is not None:
+                # the next real row is after the gap, wherever that ends.
+                after = position + 1
+                while eeg[after] is None:
+                    after += 1
+                step = ((timestamp[after] - timestamp[before]) /
+                        (after - before))
+                timestamp[position] = timestamp[before] + step * (
+                    position - before)
+        return SampleBlock(counter, eeg, accelerometer, timestamp,
+                           array('d', range(start, start + total)))
+
+    def samples(self):
+        """
+        Iterate over the block as individual samples.
+
+        :rtype: iterator of RawSample
+        """
+        timestamp = self.timestamp
+        index = self.index
+        for i in range(len(self.counter)):
+            yield RawSample(int(self.counter[i]), self.eeg[i],
+                            self.accelerometer[i],
+                            None if timestamp is None else timestamp[i],
+                            None if index is None else int(index[i]))
+
+
+
+class _SampleRing(object):
+    """
+    Rows are addressed by their index in the stream: the first row ever
+    written is 0, and ``written`` is one past the newest. Only the last
+    ``capacity`` of them are still available.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.written = 0
+        self._allocate(capacity)
+
+
+    @property
+    def oldest(self):
+        """The index of the oldest row still in the ring."""
+        return max(0, self.written - self.capacity)
+
+
+    def write(self, block):
+        """
+        Copy the rows of a SampleBlock into the ring, overwriting the oldest.
+        """
+        count = len(block)
+        skip = max(0, count - self.capacity)
+        position = (self.written + skip) % self.capacity
+        row = skip
+        while row < count:
+            length = min(count - row, self.capacity - position)
+            self._store(block, row, position, length)
+            row += length
+            position = 0
+        self.written += count
+
+
+    def read(self, start, stop=None):
+        """
+        Get rows ``start`` up to ``stop`` (default: the newest).
+
+        The rows come back as a list of no more than two SampleBlocks, as the
+        range may wrap around the end of the ring. They're only good until the
+        ring is written over them, so copy anything you want to keep.
+
+        :raises IndexError: if ``start`` has already been overwritten.
+        """
+        if stop is None:
+            stop = self.written
+        if start < self.oldest or stop > self.written:
+            raise IndexError("rows %d..%d not in ring (holding %d..%d)" %
+                             (start, stop, self.oldest, self.written))
+        blocks = []
+        while start < stop:
+            position = start % self.capacity
+            length = min(stop - start, self.capacity - position)
+            blocks.append(self._view(position, length))
+            start += length
+        return blocks
+
+
+    def cursor(self, backfill=0):
+        """
+        Make a new reader for this ring.
+
+        :param backfill: how many rows of existing history the cursor should
+            start with, if the ring has that many.
+        :rtype: RingCursor
+        """
+        return RingCursor(self, max(self.oldest, self.written - backfill))
+
+
+
+class NumpySampleRing(_SampleRing):
+    """A sample ring backed by numpy arrays. Reads are views, not copies."""
+
+    def _allocate(self, capacity):
+        self.counter = numpy.zeros(capacity, 'u1')
+        self.eeg = numpy.zeros((capacity, EEG_CHANNELS), 'i4')
+        self.accelerometer = numpy.zeros((capacity, ACCELEROMETER_AXES), 'i2')
+        self.timestamp = numpy.zeros(capacity, 'f8')
+        self.index = numpy.zeros(capacity, 'i8')
+
+
+    def _store(self, block, row, position, length):
+        end = position + length
+        self.counter[position:end] = block.counter[row:row + length]
+        self.eeg[position:end] = block.eeg[row:row + length]
+        self.accelerometer[position:end] = \
+            block.accelerometer[row:row + length]
+        if block.timestamp is None:
+            self.timestamp[position:end] = numpy.nan
+        else:
+            self.timestamp[position:end] = block.timestamp[row:row + length]
+        if block.index is None:
+            self.index[position:end] = -1
+        else:
+            self.index[position:end] = block.index[row:row + length]
+
+
+    def _view(self, position, length):
+        end = position + length
+        return SampleBlock(self.counter[position:end],
+                           self.eeg[position:end],
+                           self.accelerometer[position:end],
+                           self.timestamp[position:end],
+                           self.index[position:end])
+
+
+
+class PythonSampleRing(_SampleRing):
+    """
+    A sample ring backed by flat ``array.array``s.
+
+    Slicing an ``array`` copies it, so reads from this one are copies.
+    """
+
+    def _allocate(self, capacity):
+        self.counter = array('B', [0]) * capacity
+        self.eeg = array('l', [0]) * (capacity * EEG_CHANNELS)
+        self.accelerometer = array('h', [0]) * (capacity * ACCELEROMETER_AXES)
+        self.timestamp = array('d', [0]) * capacity
+        self.index = array('d', [0]) * capacity
+
+
+    def _store(self, block, row, position, length):
+        self.counter[position:position + length] = array(
+            'B', block.counter[row:row + length])
+        if block.timestamp is None:
+            self.timestamp[position:position + length] = array(
+                'd', [float('nan')]) * length
+        else:
+            self.timestamp[position:position + length] = array(
+                'd', block.timestamp[row:row + length])
+        if block.index is None:
+            self.index[position:position + length] = array(
+                'd', [-1]) * length
+        else:
+            self.index[position:position + length] = array(
+                'd', block.index[row:row + length])
+        for i in range(length):
+            p = position + i
+            self.eeg[p * EEG_CHANNELS:(p + 1) * EEG_CHANNELS] = array(
+                'l', block.eeg[row + i])
+            self.accelerometer[
+                p * ACCELEROMETER_AXES:(p + 1) * ACCELEROMETER_AXES] = array(
+                'h', block.accelerometer[row + i])
+
+
+    def _view(self, position, length):
+        rows = range(position, position + length)
+        eeg = self.eeg
+        accelerometer = self.accelerometer
+        return SampleBlock(
+            self.counter[position:position + length],
+            [eeg[p * EEG_CHANNELS:(p + 1) * EEG_CHANNELS] for p in rows],
+            [accelerometer[p * ACCELEROMETER_AXES:(p + 1) * ACCELEROMETER_AXES]
+             for p in rows],
+            self.timestamp[position:position + length],
+            self.index[position:position + length])
+
+
+
+if numpy:
+    SampleRing = NumpySampleRing
+else:
+    SampleRing = PythonSampleRing
+
+
+
+class RingCursor(object):
+    """
+    One reader's position in a SampleRing.
+
+    :ivar position: index of the next row this cursor will read.
+    :ivar overruns: how many rows were overwritten before this cursor got to
+        them.
+    """
+
+    def __init__(self, ring, position):
+        self.ring = ring
+        self.position = position
+        self.overruns = 0
+
+
+    def pending(self):
+        """How many rows are waiting to be read."""
+        return self.ring.written - self.position
+
+
+    def read(self):
+        """
+        Get the rows written since the last read.
+
+        If the reader fell so far behind that some rows were overwritten,
+        those are counted in ``overruns`` and skipped.
+
+        :rtype: list of SampleBlock
+        """
+        ring = self.ring
+        if self.position < ring.oldest:
+            self.overruns += ring.oldest - self.position
+            self.position = ring.oldest
+        # look at written once: a shared ring's can move on as we read.
+        stop = ring.written
+        blocks = ring.read(self.position, stop)
+        self.position = stop
+        return blocks
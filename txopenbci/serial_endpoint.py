@@ -72,5 +72,5 @@ class SerialPortEndpoint(object):
                 self._serialport(proto, self._deviceNameOrPortNumber,
                         self._reactor, *self._args, **self._kwargs)
                 return defer.succeed(proto)
-        except Exception, e:
+        except Exception as e:
             return defer.fail(getConnectError(e))
\ No newline at end of file
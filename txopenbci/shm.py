@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+"""
+The live samples of a device in shared memory, for other processes on the
+same host to read without going through the web server.
+
+The daemon keeps a `ring.SampleRing` in a file in ``/dev/shm`` (see
+`publish`), written as the receiver's ring is. A reader maps the same file
+(see `attach`) and gets views of its rows, as numpy arrays when it has
+numpy, with a `ring.RingCursor` to keep its place. Nothing is serialized
+and nothing is copied: a new block costs the daemon one copy into the
+ring, and a reader nothing until it looks at the rows.
+
+There is no lock. The writer is the only one to change the ring, and it
+keeps two counters in the header: ``claimed``, moved on before rows are
+stored, and ``written``, once they are. Readers only read rows up to
+``written``, and take rows from before ``claimed - capacity`` to be gone, as
+they are being written over, so they never see a half-written row. A
+reader that keeps rows around while it works on them can check that they
+weren't written over meanwhile with `SharedRingMixin.intact`.
+
+The file's layout, all in the host's byte order::
+
+    MAGIC
+    uint32  version
+    uint32  offset of the first column
+    uint64  capacity: rows
+    uint32  EEG channels
+    uint32  accelerometer axes
+    uint32  closed: set when the writer is done
+    ...
+    at 64:
+    uint64  written
+    uint64  claimed
+    ...
+    then each column, for every row, each starting on a 64 byte boundary:
+    uint8   counter
+    int32   eeg[8]
+    int16   accelerometer[3]
+    float64 timestamp (NaN if not known)
+    int64   index (-1 if not known)
+
+This module doesn't need Twisted, so readers can use it from Python 3.
+"""
+from array import array
+import mmap
+import os
+from struct import Struct
+import tempfile
+
+try:
+    import numpy
+except ImportError as e:
+    numpy = None
+    numpy_reason = e
+else:
+    numpy_reason = None
+
+from .ring import (NumpySampleRing, PythonSampleRing, RingCursor,
+                   SampleBlock, EEG_CHANNELS, ACCELEROMETER_AXES, DEFAULT_CAPACITY)
+
+
+MAGIC = b'txOBCIr\n'
+VERSION = 1
+
+# where rings are kept, if they're named without a directory.
+DIRECTORY = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+PREFIX = 'txopenbci-'
+
+_header = Struct('=8sIIQIII')
+_counters = Struct('=QQ')
+_COUNTERS_OFFSET = 64
+_CLOSED_OFFSET = 32
+_closed = Struct('=I')
+_ALIGNMENT = 64
+
+# name, numpy type, struct code and values per row, in the order they're
+# laid out.
+_COLUMNS = [
+    ('counter', 'u1', 'B', 1),
+    ('eeg', 'i4', 'i', EEG_CHANNELS),
+    ('accelerometer', 'i2', 'h', ACCELEROMETER_AXES),
+    ('timestamp', 'f8', 'd', 1),
+    ('index', 'i8', 'q', 1),
+]
+_FORMATS = dict((name, (code, width))
+                for name, dtype, code, width in _COLUMNS)
+
+
+def ringPath(name):
+    """
+    :returns: the filename of the ring called ``name``, which is a path if
+        it has a directory in it.
+    """
+    if os.sep in name:
+        return name
+    return os.path.join(DIRECTORY, PREFIX + name)
+
+
+def _align(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def _layout(capacity):
+    """
+    :returns: the offset of each column, by name, and the size of the file.
+    """
+    offsets = {}
+    offset = _align(_COUNTERS_OFFSET + _counters.size)
+    for name, dtype, code, width in _COLUMNS:
+        offsets[name] = offset
+        offset = _align(offset + capacity * width * Struct(code).size)
+    return offsets, offset
+
+
+
+class SharedRingMixin(object):
+    """
+    What a ring in shared memory has on top of a `ring.SampleRing`, which
+    it is mixed into.
+
+    ``written`` is kept in the file, so a reader sees it move.
+
+    :ivar path: the ring's filename.
+    :ivar writable: whether this is the writer's ring.
+    """
+
+    def __init__(self, path, fileobj, writable):
+        self.path = path
+        self.writable = writable
+        self._file = fileobj
+        fileobj.seek(0)
+        header = fileobj.read(_header.size)
+        if len(header) < _header.size:
+            raise ValueError("%s is not a sample ring" % (path,))
+        (magic, version, start, capacity, channels, axes,
+         closed) = _header.unpack(header)
+        if magic != MAGIC:
+            raise ValueError("%s is not a sample ring" % (path,))
+        if version != VERSION:
+            raise ValueError("%s is a version %d sample ring; we only read "
+                             "version %d" % (path, version, VERSION))
+        if (channels, axes) != (EEG_CHANNELS, ACCELEROMETER_AXES):
+            raise ValueError("%s has samples of %d channels and %d axes" %
+                             (path, channels, axes))
+        self._offsets, size = _layout(capacity)
+        if self._offsets[_COLUMNS[0][0]] != start:
+            raise ValueError("%s has an unexpected layout" % (path,))
+        if writable:
+            self._map = mmap.mmap(fileobj.fileno(), size)
+        else:
+            self._map = mmap.mmap(fileobj.fileno(), size,
+                                  access=mmap.ACCESS_READ)
+        self.capacity = capacity
+        self._allocate(capacity)
+
+
+    @property
+    def written(self):
+        return _counters.unpack_from(self._map, _COUNTERS_OFFSET)[0]
+
+
+    @written.setter
+    def written(self, written):
+        # rows are only ever written with claimed moved on first, so by
+        # now they are claimed.
+        _counters.pack_into(self._map, _COUNTERS_OFFSET, written, written)
+
+
+    @property
+    def claimed(self):
+        """One past the newest row the writer may be storing."""
+        return _counters.unpack_from(self._map, _COUNTERS_OFFSET)[1]
+
+
+    @property
+    def oldest(self):
+        """The index of the oldest row that isn't being written over."""
+        return max(0, self.claimed - self.capacity)
+
+
+    @property
+    def closed(self):
+        """Whether the writer is finished with this ring."""
+        return bool(_closed.unpack_from(self._map, _CLOSED_OFFSET)[0])
+
+
+    def intact(self, start):
+        """
+        Are rows from ``start`` on still as they were when read?
+
+        Call this after working on rows without copying them; if it says
+        no, some of them were written over while you did.
+        """
+        return start >= self.oldest
+
+
+    def cursor(self, backfill=0):
+        """
+        Make a new reader for this ring.
+
+        :param backfill: how many rows of existing history the cursor should
+            start with, if the ring has that many.
+        :rtype: SharedRingCursor
+        """
+        return SharedRingCursor(self, max(self.oldest,
+                                          self.written - backfill))
+
+
+    def write(self, block):
+        """
+        Copy the rows of a SampleBlock into the ring, overwriting the oldest.
+        """
+        written = self.written
+        _counters.pack_into(self._map, _COUNTERS_OFFSET, written,
+                            written + len(block))
+        super(SharedRingMixin, self).write(block)
+
+
+    def close(self):
+        """
+        Let go of the ring. The writer marks it closed, for its readers to
+        see, and removes the file.
+        """
+        if self._map is None:
+            return
+        if self.writable:
+            _closed.pack_into(self._map, _CLOSED_OFFSET, 1)
+            try:
+                if os.stat(self.path).st_ino == \
+                        os.fstat(self._file.fileno()).st_ino:
+                    os.unlink(self.path)
+            except OSError:
+                pass
+        self._release()
+        self._map.close()
+        self._map = None
+        self._file.close()
+
+
+
+class SharedRingCursor(RingCursor):
+    """
+    A `ring.RingCursor` for a ring that another process writes, which can
+    move on between one look at the ring and the next.
+    """
+
+    def read(self):
+        while True:
+            try:
+                return RingCursor.read(self)
+            except IndexError:
+                # overwritten as we looked; counted, so look again.
+                pass
+
+
+
+class NumpySharedRing(SharedRingMixin, NumpySampleRing):
+    """A ring in shared memory, read as numpy views of the mapping."""
+
+    def _allocate(self, capacity):
+        for name, dtype, code, width in _COLUMNS:
+            shape = (capacity, width) if width > 1 else capacity
+            column = numpy.frombuffer(self._map, dtype, capacity * width,
+                                      self._offsets[name]).reshape(shape)
+            setattr(self, name, column)
+
+
+    def _release(self):
+        # the mapping can't be closed while there are views of it.
+        for name, dtype, code, width in _COLUMNS:
+            setattr(self, name, None)
+
+
+
+class PythonSharedRing(SharedRingMixin, PythonSampleRing):
+    """
+    A ring in shared memory, read and written with struct.
+
+    Reads from this one are copies, as they are from a `PythonSampleRing`.
+    """
+
+    def _allocate(self, capacity):
+        self._structs = {}
+
+
+    def _release(self):
+        pass
+
+
+    def _struct(self, name, position, count):
+        """
+        :returns: a Struct for ``count`` values of column ``name``, and
+            where the row at ``position`` is.
+        """
+        code, width = _FORMATS[name]
+        packer = self._structs.get((code, count))
+        if packer is None:
+            packer = self._structs[code, count] = Struct(
+                '=%d%s' % (count, code))
+        return packer, (self._offsets[name] +
+                        position * width * Struct(code).size)
+
+
+    def _pack(self, name, position, values):
+        packer, offset = self._struct(name, position, len(values))
+        packer.pack_into(self._map, offset, *values)
+
+
+    def _store(self, block, row, position, length):
+        end = row + length
+        self._pack('counter', position, block.counter[row:end])
+        eeg = []
+        for values in block.eeg[row:end]:
+            eeg.extend(values)
+        self._pack('eeg', position, eeg)
+        accelerometer = []
+        for values in block.accelerometer[row:end]:
+            accelerometer.extend(values)
+        self._pack('accelerometer', position, accelerometer)
+        if block.timestamp is None:
+            timestamp = [float('nan')] * length
+        else:
+            timestamp = block.timestamp[row:end]
+        self._pack('timestamp', position, timestamp)
+        if block.index is None:
+            index = [-1] * length
+        else:
+            index = [int(i) for i in block.index[row:end]]
+        self._pack('index', position, index)
+
+
+    def _column(self, name, typecode, position, length):
+        packer, offset = self._struct(name, position,
+                                      length * _FORMATS[name][1])
+        return array(typecode, packer.unpack_from(self._map, offset))
+
+
+    def _view(self, position, length):
+        eeg = self._column('eeg', 'l', position, length)
+        accelerometer = self._column('accelerometer', 'h', position, length)
+        return SampleBlock(
+            self._column('counter', 'B', position, length),
+            [eeg[i:i + EEG_CHANNELS]
+             for i in range(0, length * EEG_CHANNELS, EEG_CHANNELS)],
+            [accelerometer[i:i + ACCELEROMETER_AXES]
+             for i in range(0, length * ACCELEROMETER_AXES,
+                            ACCELEROMETER_AXES)],
+            self._column('timestamp', 'd', position, length),
+            self._column('index', 'd', position, length))
+
+
+
+if numpy:
+    SharedRing = NumpySharedRing
+else:
+    SharedRing = PythonSharedRing
+
+
+def publish(name, capacity=DEFAULT_CAPACITY, ringClass=None):
+    """
+    Make a new ring for others to `attach` to, in place of any old one of
+    the same name.
+
+    Give its ``write`` to `control.DeviceReceiver.subscribeToSampleBlocks`,
+    and ``close`` it when you're done.
+
+    :param name: what readers will know it by; see `ringPath`.
+    :param capacity: how many rows it keeps. Readers that fall further
+        behind than this lose rows.
+    :rtype: SharedRing
+    """
+    if ringClass is None:
+        ringClass = SharedRing
+    path = ringPath(name)
+    directory, filename = os.path.split(path)
+    offsets, size = _layout(capacity)
+    # made whole under another name, so no reader finds it half done.
+    fd, temporary = tempfile.mkstemp(prefix=filename + '.', dir=directory)
+    fileobj = os.fdopen(fd, 'w+b')
+    ring = None
+    try:
+        fileobj.write(_header.pack(MAGIC, VERSION, offsets[_COLUMNS[0][0]],
+                                   capacity, EEG_CHANNELS, ACCELEROMETER_AXES,
+                                   0))
+        fileobj.truncate(size)
+        fileobj.flush()
+        ring = ringClass(path, fileobj, True)
+        os.rename(temporary, path)
+    except Exception:
+        if ring is not None:
+            ring.close()
+        else:
+            fileobj.close()
+        os.unlink(temporary)
+        raise
+    return ring
+
+
+def attach(name, ringClass=None):
+    """
+    Read the ring that the daemon published as ``name``.
+
+    If the daemon is restarted, it makes a new ring; once this one is
+    ``closed``, attach again.
+
+    :raises ValueError: if the file isn't a ring we can read.
+    :rtype: SharedRing
+    """
+    if ringClass is None:
+        ringClass = SharedRing
+    path = ringPath(name)
+    return ringClass(path, open(path, 'rb'), False)
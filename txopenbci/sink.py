@@ -4,47 +4,538 @@
 import csv
 import math
 import os
+import Queue
+import threading
 import time
+from twisted.application.service import Service
+from twisted.internet.defer import Deferred
 from twisted.python import log
 
+from .compressed import CompressedWriter
+from .pyramid import openSidecar
+from .metrics import REGISTRY, timer
+from .timing import monotonic
+from .recording import RecordingWriter, CSV_HEADER, RECORD_SIZE
+
+
+def _logMetrics(metrics, format):
+    """
+    :returns: the write-time histogram and bytes-written counter for a log of
+        ``format``.
+    """
+    if metrics is None:
+        metrics = REGISTRY
+    metrics = metrics.labelled(format=format)
+    return (
+        metrics.histogram('txopenbci_log_write_seconds',
+                          "Seconds spent logging each block of samples."),
+        metrics.counter('txopenbci_log_bytes_total',
+                        "Bytes of samples logged."))
+
+
+def _logFilename(extension):
+    """
+    A new log's name, from the process ID and the time, and a part number
+    if a log was already started in the same second.
+    """
+    base = 'sensor.%x.%x' % (os.getpid(), time.time())
+    filename = base + extension
+    part = 0
+    while os.path.exists(filename):
+        part += 1
+        filename = '%s.%d%s' % (base, part, extension)
+    return filename
+
+
+def _flushSummary(summary, sync=False):
+    if summary:
+        summary.flush()
+        if sync:
+            os.fsync(summary.fileobj.fileno())
+
+
+def _closeSummary(summary):
+    if summary:
+        summary.close()
+    return None
+
 
 class SensorLog(object):
-    """Log the sensor data to disk."""
+    """
+    Log the sensor data to disk.
+
+    Each log also gets a `txopenbci.pyramid` sidecar of its summaries,
+    unless it's made with ``summaries=False``.
+
+    :ivar size: the bytes written to the current file.
+    :ivar summary: the `pyramid.PyramidWriter` of the current file's
+        summaries, if any.
+    """
 
     logfile = None
     writer = None
+    summary = None
     time0 = None
+    size = 0
 
-    def __init__(self):
+    def __init__(self, metrics=None, summaries=True):
+        """
+        :param metrics: (optional) the `txopenbci.metrics.Registry` to time
+            writes in; by default, the global one.
+        :param summaries: (optional) whether to keep summaries of each log.
+        """
+        self.summaries = summaries
         self._rowBuffer = [''] * (1 + 8 + 3 + 1)
+        self._writeSeconds, self._bytesWritten = _logMetrics(metrics, 'csv')
 
 
     def _openLog(self):
         self.time0 = time.time()
-        filename = 'sensor.%x.%x.csv' % (os.getpid(), self.time0)
+        filename = _logFilename('.csv')
         self.logfile = file(filename, 'wb')
+        if self.summaries:
+            self.summary = openSidecar(filename, self.time0)
         self.writer = csv.writer(self.logfile)
-        self.writer.writerow([
-            'count',
-            's1', 's2', 's3', 's4', 's5', 's6', 's7', 's8',
-            'x', 'y', 'z',
-            'clock'
-        ])
+        self.writer.writerow(CSV_HEADER)
+        self.size = self.logfile.tell()
+
+
+    def handleBlock(self, block):
+        """
+        :type block: txopenbci.ring.SampleBlock
+        """
+        if not self.writer:
+            self._openLog()
+
+        start = timer()
+        before = self.size
+        row = self._rowBuffer
+        timestamp = block.timestamp
+        now = time.time()
+        row[12] = now - self.time0
+        for i in range(len(block)):
+            if timestamp is not None:
+                row[12] = timestamp[i] - self.time0
+            row[0] = block.counter[i]
+            row[1:9] = block.eeg[i]
+            row[9:12] = block.accelerometer[i]
+            self.writer.writerow(row)
+        if self.summary:
+            if timestamp is None:
+                timestamp = [now] * len(block)
+            self.summary.writeBlock(block, timestamp)
+        self.size = self.logfile.tell()
+        self._bytesWritten.inc(self.size - before)
+        self._writeSeconds.observe(timer() - start)
+
+
+    def flush(self):
+        """
+        Hand everything written so far to the operating system.
+        """
+        if self.logfile:
+            self.logfile.flush()
+        _flushSummary(self.summary)
+
+
+    def sync(self):
+        """
+        Flush, and wait for the disk to have it all.
+        """
+        if self.logfile:
+            self.logfile.flush()
+            os.fsync(self.logfile.fileno())
+        _flushSummary(self.summary, sync=True)
+
+
+    def close(self):
+        """
+        Close the file; the next block starts a new one.
+        """
+        if self.logfile:
+            self.logfile.close()
+            self.logfile = self.writer = None
+        self.summary = _closeSummary(self.summary)
+
+
+class BinarySensorLog(object):
+    """
+    Log the sensor data to disk in the binary format of `txopenbci.recording`.
+
+    This is much more compact than `SensorLog`, and can be read back with
+    `recording.Recording` without any parsing.
+
+    :ivar size: the bytes written to the current file, including any still
+        buffered.
+    """
+
+    writer = None
+    summary = None
+    time0 = None
+    size = 0
+
+    def __init__(self, chunkSize=64 * 1024, metrics=None, summaries=True):
+        """
+        :param metrics: (optional) the `txopenbci.metrics.Registry` to time
+            writes in; by default, the global one.
+        :param summaries: (optional) whether to keep summaries of each log,
+            as `SensorLog` does.
+        """
+        self.chunkSize = chunkSize
+        self.summaries = summaries
+        self._writeSeconds, self._bytesWritten = _logMetrics(metrics,
+                                                             'binary')
+
+
+    def _openLog(self):
+        self.time0 = time.time()
+        filename = _logFilename('.rec')
+        self.writer = RecordingWriter(file(filename, 'wb'), self.time0,
+                                      self.chunkSize)
+        if self.summaries:
+            self.summary = openSidecar(filename, self.time0)
+        self.size = self.writer.fileobj.tell()
+
+
+    def handleBlock(self, block):
+        """
+        :type block: txopenbci.ring.SampleBlock
+        """
+        if not self.writer:
+            self._openLog()
+
+        start = timer()
+        timestamp = block.timestamp
+        if timestamp is None:
+            timestamp = [time.time()] * len(block)
+        self.writer.writeBlock(block, timestamp)
+        if self.summary:
+            self.summary.writeBlock(block, timestamp)
+        self.size += len(block) * RECORD_SIZE
+        self._bytesWritten.inc(len(block) * RECORD_SIZE)
+        self._writeSeconds.observe(timer() - start)
+
+
+    def flush(self):
+        if self.writer:
+            self.writer.flush()
+        _flushSummary(self.summary)
+
+
+    def sync(self):
+        if self.writer:
+            self.writer.flush()
+            os.fsync(self.writer.fileobj.fileno())
+        _flushSummary(self.summary, sync=True)
 
 
-    def handleSample(self, sample):
+    def close(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        self.summary = _closeSummary(self.summary)
+
+
+class CompressedSensorLog(object):
+    """
+    Log the sensor data to disk compressed, in the format of
+    `txopenbci.compressed`, which can be read back a stretch of time at a
+    time with `compressed.CompressedRecording`.
+
+    :ivar size: the bytes written to the current file, not counting
+        samples still waiting to make up a block.
+    """
+
+    writer = None
+    summary = None
+    time0 = None
+    size = 0
+
+    def __init__(self, samplesPerBlock=250, level=1, metrics=None,
+                 summaries=True):
+        """
+        :param samplesPerBlock: (optional) how many samples to compress
+            together.
+        :param level: (optional) the zlib compression level, 1 to 9.
+        :param metrics: (optional) the `txopenbci.metrics.Registry` to time
+            writes in; by default, the global one.
+        :param summaries: (optional) whether to keep summaries of each log,
+            as `SensorLog` does.
+        """
+        self.samplesPerBlock = samplesPerBlock
+        self.summaries = summaries
+        self.level = level
+        self._writeSeconds, self._bytesWritten = _logMetrics(metrics,
+                                                             'compressed')
+
+
+    def _openLog(self):
+        self.time0 = time.time()
+        filename = _logFilename('.recz')
+        self.writer = CompressedWriter(file(filename, 'wb'), self.time0,
+                                       self.samplesPerBlock, self.level)
+        if self.summaries:
+            self.summary = openSidecar(filename, self.time0)
+        self.size = self.writer.fileobj.tell()
+
+
+    def handleBlock(self, block):
         """
-        :type sample: RawSample
+        :type block: txopenbci.ring.SampleBlock
         """
         if not self.writer:
             self._openLog()
 
-        self._rowBuffer[0] = sample.counter
-        self._rowBuffer[1:9] = sample.eeg
-        self._rowBuffer[9:12] = sample.accelerometer
-        self._rowBuffer[12] = time.time() - self.time0
+        start = timer()
+        timestamp = block.timestamp
+        if timestamp is None:
+            timestamp = [time.time()] * len(block)
+        self.writer.writeBlock(block, timestamp)
+        if self.summary:
+            self.summary.writeBlock(block, timestamp)
+        size = self.writer.fileobj.tell()
+        self._bytesWritten.inc(size - self.size)
+        self.size = size
+        self._writeSeconds.observe(timer() - start)
+
+
+    def flush(self):
+        if self.writer:
+            self.writer.flush()
+        _flushSummary(self.summary)
+
+
+    def sync(self):
+        if self.writer:
+            self.writer.flush()
+            os.fsync(self.writer.fileobj.fileno())
+        _flushSummary(self.summary, sync=True)
+
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        self.summary = _closeSummary(self.summary)
+
+
+class ThreadedLog(Service):
+    """
+    Run a `SensorLog`, `BinarySensorLog` or `CompressedSensorLog` on a
+    thread of its own, so a slow disk never holds up the reactor.
+
+    `handleBlock` copies the block and puts it on a queue, and that's all
+    the reactor thread does. The writer thread takes blocks off the queue
+    and logs them, flushing to the operating system every
+    ``flushInterval`` seconds. Rather than let the queue grow without
+    bound while the disk can't keep up, blocks that would take it past
+    ``maxQueuedSamples`` are dropped.
+
+    :ivar fsync: when to wait for the disk to have the data: ``'never'``,
+        leaving it to the operating system; ``'interval'``, at every flush;
+        or ``'always'``, after every block.
+    :ivar maxBytes: (optional) start a new file when the current one is this
+        big.
+    :ivar maxSeconds: (optional) start a new file when the current one is
+        this old.
+    :ivar highWaterMark: the most samples there have been in the queue.
+    :ivar droppedSamples: how many samples were dropped with the queue full.
+    :ivar rotations: how many times a new file was started.
+    :ivar errors: how many blocks couldn't be written.
+    """
+
+    maxQueuedSamples = 250 * 60
+    flushInterval = 1.0
+    fsync = 'interval'
+    maxBytes = None
+    maxSeconds = None
+
+    _stop = object()
+
+    def __init__(self, sensorLog, maxQueuedSamples=None, flushInterval=None,
+                 fsync=None, maxBytes=None, maxSeconds=None, reactor=None,
+                 metrics=None):
+        """
+        :param sensorLog: a `SensorLog` or the like, which only the
+            writer thread will touch from now on.
+        :param metrics: (optional) the `txopenbci.metrics.Registry` to report
+            the queue in, such as the device's `control.DeviceService.metrics`;
+            by default, the global one.
+        """
+        if maxQueuedSamples is not None:
+            self.maxQueuedSamples = maxQueuedSamples
+        if flushInterval is not None:
+            self.flushInterval = flushInterval
+        if fsync is not None:
+            self.fsync = fsync
+        if maxBytes is not None:
+            self.maxBytes = maxBytes
+        if maxSeconds is not None:
+            self.maxSeconds = maxSeconds
+        if self.fsync not in ('never', 'interval', 'always'):
+            raise ValueError("Unknown fsync policy %r" % (self.fsync,))
+        if reactor is None:
+            from twisted.internet import reactor
+        if metrics is None:
+            metrics = REGISTRY
+        self.sensorLog = sensorLog
+        self.reactor = reactor
+        self.queue = Queue.Queue()
+        # each only ever added to by one thread, the difference being
+        # what's in the queue.
+        self.samplesQueued = 0
+        self.samplesDone = 0
+        self.highWaterMark = 0
+        self.droppedSamples = 0
+        self.rotations = 0
+        self.errors = 0
+        self._thread = None
+        self._finished = None
+        # reporting only while running, so a stopped log isn't kept alive
+        # by them.
+        self._gauges = [
+            (metrics.gauge('txopenbci_log_queued_samples',
+                           "Samples waiting to be logged."),
+             lambda: self.queuedSamples),
+            (metrics.gauge('txopenbci_log_queue_high_water_samples',
+                           "The most samples there have been waiting to be "
+                           "logged."),
+             lambda: self.highWaterMark),
+        ]
+        self._droppedMetric = metrics.counter(
+            'txopenbci_log_dropped_samples_total', "Samples not logged "
+            "because the disk couldn't keep up.")
+
+
+    @property
+    def queuedSamples(self):
+        return self.samplesQueued - self.samplesDone
+
+
+    def handleBlock(self, block):
+        """
+        :type block: txopenbci.ring.SampleBlock
+        """
+        count = len(block)
+        queued = self.samplesQueued - self.samplesDone + count
+        if queued > self.maxQueuedSamples:
+            self.droppedSamples += count
+            self._droppedMetric.inc(count)
+            return
+        if queued > self.highWaterMark:
+            self.highWaterMark = queued
+        self.samplesQueued += count
+        # the block is a view into a ring that will be written over.
+        self.queue.put(block.copy())
+
+
+    def stats(self):
+        """
+        :returns: a dict of ``queuedSamples``, ``highWaterMark``,
+            ``droppedSamples``, ``rotations`` and ``errors``.
+        """
+        return {
+            'queuedSamples': self.queuedSamples,
+            'highWaterMark': self.highWaterMark,
+            'droppedSamples': self.droppedSamples,
+            'rotations': self.rotations,
+            'errors': self.errors,
+        }
+
+
+    def startService(self):
+        Service.startService(self)
+        for gauge, function in self._gauges:
+            gauge.function = function
+        self._finished = Deferred()
+        self._thread = threading.Thread(target=self._run,
+                                        name='txopenbci-sensor-log')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def stopService(self):
+        """
+        :returns: a Deferred that fires once everything queued is written
+            and the file closed.
+        """
+        Service.stopService(self)
+        for gauge, function in self._gauges:
+            # unless another log has taken it over since.
+            if gauge.function is function:
+                gauge.function = None
+        if self._thread is None:
+            return None
+        self._thread = None
+        self.queue.put(self._stop)
+        return self._finished
+
+
+    # == On the writer thread ==
+
+    def _run(self):
+        try:
+            lastFlush = monotonic()
+            while True:
+                try:
+                    block = self.queue.get(timeout=self.flushInterval)
+                except Queue.Empty:
+                    block = None
+                if block is self._stop:
+                    break
+                if block is not None:
+                    self._write(block)
+                if monotonic() - lastFlush >= self.flushInterval:
+                    self._flush()
+                    lastFlush = monotonic()
+            self._close()
+        finally:
+            self.reactor.callFromThread(self._finished.callback, None)
+
+
+    def _write(self, block):
+        sensorLog = self.sensorLog
+        try:
+            if sensorLog.writer is not None and self._full():
+                self._close()
+                self.rotations += 1
+            sensorLog.handleBlock(block)
+            if self.fsync == 'always':
+                sensorLog.sync()
+        except Exception:
+            self.errors += 1
+            log.err(None, "Could not log %d samples" % (len(block),))
+        self.samplesDone += len(block)
+
+
+    def _full(self):
+        """Whether it's time for a new file."""
+        sensorLog = self.sensorLog
+        if self.maxBytes is not None and sensorLog.size >= self.maxBytes:
+            return True
+        return (self.maxSeconds is not None and
+                time.time() - sensorLog.time0 >= self.maxSeconds)
+
+
+    def _flush(self):
+        try:
+            if self.fsync == 'never':
+                self.sensorLog.flush()
+            else:
+                self.sensorLog.sync()
+        except Exception:
+            self.errors += 1
+            log.err(None, "Could not flush the sensor log")
+
+
+    def _close(self):
+        self._flush()
+        try:
+            self.sensorLog.close()
+        except Exception:
+            self.errors += 1
+            log.err(None, "Could not close the sensor log")
 
-        self.writer.writerow(self._rowBuffer)
 
 
 class TimingWatchdog(object):
@@ -53,18 +544,25 @@ class TimingWatchdog(object):
         self.lastTime = float('NaN')
         self.lastCount = None
 
-    def handleSample(self, sample):
-        c = sample.counter
-        if self.lastCount is not None:
-            increment = (c - self.lastCount) % 256
-            if increment != 1:
-                dropped = increment - 1
-                log.msg("Dropped %s samples (%s..%s)" % (dropped, self.lastCount, c))
-        self.lastCount = c
+    def handleBlock(self, block):
+        """
+        :type block: txopenbci.ring.SampleBlock
+        """
         now = time.time()
+        # All the samples in a block arrived together, so the first one gets
+        # all the time since the last block and the rest get none.
         delta = now - self.lastTime
-        self.times[c % 250] = delta
-        if (c % 250) == 0 and not math.isnan(delta):
-            total = sum(self.times)
-            log.msg("Time for 250 samples: %s" % (total,))
+        for c in block.counter:
+            c = int(c)
+            if self.lastCount is not None:
+                increment = (c - self.lastCount) % 256
+                if increment != 1:
+                    dropped = increment - 1
+                    log.msg("Dropped %s samples (%s..%s)" % (dropped, self.lastCount, c))
+            self.lastCount = c
+            self.times[c % 250] = delta
+            if (c % 250) == 0 and not math.isnan(delta):
+                total = sum(self.times)
+                log.msg("Time for 250 samples: %s" % (total,))
+            delta = 0.0
         self.lastTime = now
\ No newline at end of file
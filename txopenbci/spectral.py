@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+Sliding-window spectra and band powers of the EEG channels, computed on
+the server once per device, however many clients are watching.
+"""
+from array import array
+import cmath
+import math
+
+try:
+    import numpy
+except ImportError as e:
+    numpy = None
+    numpy_reason = e
+else:
+    numpy_reason = None
+
+from .dsp import microvoltsPerCount
+from .protocol import SAMPLE_RATE
+from .ring import EEG_CHANNELS
+
+
+# (name, low, high) in Hz; each band includes its low edge but not its high.
+DEFAULT_BANDS = [
+    ('delta', 1.0, 4.0),
+    ('theta', 4.0, 8.0),
+    ('alpha', 8.0, 13.0),
+    ('beta', 13.0, 30.0),
+    ('gamma', 30.0, 50.0),
+]
+
+
+class _SpectralEngine(object):
+    """
+    Every ``hop`` samples, take the last ``windowSize`` samples of each
+    channel, remove the mean, apply a Hann window, and work out the
+    one-sided power spectral density in µV²/Hz and the power in each band
+    in µV².
+
+    If a block brings more than a hop's worth of samples, as after a hiccup,
+    only the spectrum at the end of the block is worked out; nobody wants
+    the stale ones.
+
+    :ivar latest: the latest result, a dict of ``counter`` (of the last
+        sample in the window), ``bands`` (a dict of band name to the power
+        in each channel) and ``spectrum`` (a PSD per channel), or None
+        before the window first fills.
+    """
+
+    def __init__(self, windowSize=256, hop=SAMPLE_RATE // 4,
+                 sampleRate=SAMPLE_RATE, bands=DEFAULT_BANDS,
+                 scale=microvoltsPerCount(), channels=EEG_CHANNELS):
+        """
+        :param scale: microvolts per count.
+        """
+        self.windowSize = windowSize
+        self.hop = hop
+        self.sampleRate = sampleRate
+        self.bands = list(bands)
+        self.channels = channels
+        self.frequencies = [float(sampleRate) * i / windowSize
+                            for i in range(windowSize // 2 + 1)]
+        self.latest = None
+        self._filled = 0
+        self._sinceUpdate = 0
+        self._listeners = set()
+
+        window = [0.5 - 0.5 * math.cos(2 * math.pi * i / windowSize)
+                  for i in range(windowSize)]
+        # one-sided PSD: double everything but DC and Nyquist.
+        norm = scale ** 2 / (sampleRate * sum(w * w for w in window))
+        binScale = [2 * norm] * len(self.frequencies)
+        binScale[0] = norm
+        if windowSize % 2 == 0:
+            binScale[-1] = norm
+        resolution = float(sampleRate) / windowSize
+        # the bins of each band, and the width to integrate them over.
+        bandBins = [[i for i, f in enumerate(self.frequencies)
+                     if low <= f < high]
+                    for name, low, high in self.bands]
+        self._setup(window, binScale, bandBins, resolution)
+
+
+    def subscribeToSpectra(self, listener):
+        """
+        :param listener: called with each new result, as in ``latest``.
+        """
+        self._listeners.add(listener)
+
+
+    def unsubscribeFromSpectra(self, listener):
+        self._listeners.discard(listener)
+
+
+    def handleBlock(self, block):
+        """
+        :type block: txopenbci.ring.SampleBlock
+        """
+        count = len(block)
+        if not count:
+            return
+        self._append(block.eeg)
+        self._filled = min(self.windowSize, self._filled + count)
+        self._sinceUpdate += count
+        if self._filled == self.windowSize and self._sinceUpdate >= self.hop:
+            self._sinceUpdate = 0
+            spectrum, bandPowers = self._compute()
+            self.latest = {
+                'counter': int(block.counter[-1]),
+                'bands': dict((name, power) for (name, low, high), power
+                              in zip(self.bands, bandPowers)),
+                'spectrum': spectrum,
+            }
+            for listener in list(self._listeners):
+                listener(self.latest)
+
+
+
+class NumpySpectralEngine(_SpectralEngine):
+    """
+    Keeps the window in a ring buffer, and transforms every channel in one
+    call.
+    """
+
+    def _setup(self, window, binScale, bandBins, resolution):
+        self._buffer = numpy.zeros((self.windowSize, self.channels))
+        self._position = 0
+        self._window = numpy.array(window)[:, numpy.newaxis]
+        self._binScale = numpy.array(binScale)
+        # power in each band is the PSD times this, summed over the bins.
+        self._bandMatrix = numpy.zeros((len(binScale), len(bandBins)))
+        for band, bins in enumerate(bandBins):
+            self._bandMatrix[bins, band] = resolution
+
+
+    def _append(self, eeg):
+        size = self.windowSize
+        eeg = numpy.asarray(eeg)[-size:]
+        start = self._position
+        first = min(len(eeg), size - start)
+        self._buffer[start:start + first] = eeg[:first]
+        self._buffer[:len(eeg) - first] = eeg[first:]
+        self._position = (start + len(eeg)) % size
+
+
+    def _compute(self):
+        # oldest first, so the window lines up with the samples.
+        samples = numpy.roll(self._buffer, -self._position, axis=0)
+        samples -= samples.mean(axis=0)
+        transformed = numpy.fft.rfft(samples * self._window, axis=0)
+        psd = (transformed.real ** 2 + transformed.imag ** 2) * \
+            self._binScale[:, numpy.newaxis]
+        return psd.T, psd.T.dot(self._bandMatrix).T
+
+
+
+class PythonSpectralEngine(_SpectralEngine):
+    """
+    A radix-2 FFT, so ``windowSize`` must be a power of two.
+    """
+
+    def _setup(self, window, binScale, bandBins, resolution):
+        size = self.windowSize
+        if size & (size - 1):
+            raise ValueError("windowSize must be a power of two, not %d"
+                             % (size,))
+        self._rows = []
+        self._window = window
+        self._binScale = binScale
+        self._bandBins = bandBins
+        self._resolution = resolution
+        bits = size.bit_length() - 1
+        self._reversed = [int(bin(i)[2:].zfill(bits)[::-1], 2) if bits else 0
+                          for i in range(size)]
+        self._twiddles = [cmath.exp(-2j * math.pi * i / size)
+                          for i in range(size // 2)]
+
+
+    def _append(self, eeg):
+        self._rows.extend(eeg)
+        del self._rows[:-self.windowSize]
+
+
+    def _fft(self, values):
+        size = self.windowSize
+        out = [values[i] for i in self._reversed]
+        half = 1
+        while half < size:
+            step = size // (half * 2)
+            for start in range(0, size, half * 2):
+                for k in range(half):
+                    twiddled = self._twiddles[k * step] * out[start + half + k]
+                    out[start + half + k] = out[start + k] - twiddled
+                    out[start + k] += twiddled
+            half *= 2
+        return out
+
+
+    def _compute(self):
+        spectrum = []
+        bandPowers = [[] for bins in self._bandBins]
+        bins = len(self._binScale)
+        for channel in zip(*self._rows):
+            mean = sum(channel) / float(len(channel))
+            transformed = self._fft([(value - mean) * w for value, w
+                                     in zip(channel, self._window)])
+            psd = array('d', [abs(transformed[i]) ** 2 * self._binScale[i]
+                              for i in range(bins)])
+            spectrum.append(psd)
+            for powers, bandBins in zip(bandPowers, self._bandBins):
+                powers.append(sum(psd[i] for i in bandBins) *
+                              self._resolution)
+        return spectrum, bandPowers
+
+
+
+if numpy:
+    SpectralEngine = NumpySpectralEngine
+else:
+    SpectralEngine = PythonSpectralEngine
+
+
+
+class SpectralSource(object):
+    """
+    A receiver's spectra, worked out by one engine for everyone who wants
+    them, and only while somebody does.
+
+    The engine listens to the receiver while there are subscribers, and for
+    ``holdTime`` seconds after each `hold`, so clients polling for the
+    latest spectrum keep it current. A fresh engine is made each time it
+    starts again, as the old window would span the time nobody listened.
+
+    :ivar engine: the current `SpectralEngine`.
+    """
+
+    holdTime = 10.0
+
+    def __init__(self, receiver, clock, engineFactory=None):
+        """
+        :param receiver: a DeviceReceiver, or something with the same
+            subscribeToSampleBlocks and unsubscribeFromSampleBlocks.
+        :param engineFactory: (optional) makes the engine; by default,
+            `SpectralEngine`.
+        """
+        if engineFactory is None:
+            engineFactory = SpectralEngine
+        self.receiver = receiver
+        self.clock = clock
+        self.engineFactory = engineFactory
+        self.engine = engineFactory()
+        self.running = False
+        self._listeners = set()
+        self._holdCall = None
+
+
+    def subscribeToSpectra(self, listener):
+        """
+        :param listener: called with each new result, as in
+            `SpectralEngine.latest`.
+        """
+        self._listeners.add(listener)
+        self._start()
+
+
+    def unsubscribeFromSpectra(self, listener):
+        self._listeners.discard(listener)
+        self._stopIfIdle()
+
+
+    def hold(self):
+        """
+        Keep the engine running for another ``holdTime`` seconds.
+        """
+        self._start()
+        if self._holdCall is not None:
+            self._holdCall.cancel()
+        self._holdCall = self.clock.callLater(self.holdTime, self._release)
+
+
+    def _release(self):
+        self._holdCall = None
+        self._stopIfIdle()
+
+
+    def _start(self):
+        if self.running:
+            return
+        self.running = True
+        self.engine = self.engineFactory()
+        self.engine.subscribeToSpectra(self._handleSpectrum)
+        self.receiver.subscribeToSampleBlocks(self.engine.handleBlock)
+
+
+    def _stopIfIdle(self):
+        if not self.running or self._listeners or self._holdCall is not None:
+            return
+        self.running = False
+        self.receiver.unsubscribeFromSampleBlocks(self.engine.handleBlock)
+        self.engine.unsubscribeFromSpectra(self._handleSpectrum)
+
+
+    def _handleSpectrum(self, result):
+        # listeners may unsubscribe as we go.
+        for listener in list(self._listeners):
+            listener(result)
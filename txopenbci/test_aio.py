@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of `txopenbci.aio`, which only runs on Python 3, where there is no
+Twisted; so these use only the standard library's unittest. Run them
+with::
+
+    python3 -m unittest txopenbci.test_aio
+
+or ``tox -e py3``. Under trial on Python 2 they are all skipped.
+"""
+import base64
+import unittest
+from unittest import TestCase
+
+from .aio import asyncio, asyncio_reason, DeviceSession, DaemonSession, \
+    DaemonError
+from .fixtures import fixture
+from .protocol import decodeSamples, SAMPLE_SIZE
+from .ring import SampleBlock
+from .wire import packBlocks
+
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.written = b''
+        self.paused = False
+        self.closed = False
+
+    def write(self, data):
+        self.written += data
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+    def close(self):
+        self.closed = True
+
+
+
+skipUnlessAsyncio = unittest.skipIf(
+    asyncio is None, "could not load asyncio: %s" % (asyncio_reason,))
+
+
+
+class _SessionTests(object):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.transport = FakeTransport()
+
+    def wait(self, future):
+        return self.loop.run_until_complete(future)
+
+
+
+@skipUnlessAsyncio
+class TestDeviceSession(_SessionTests, TestCase):
+    def setUp(self):
+        _SessionTests.setUp(self)
+        self.session = DeviceSession('/dev/null', loop=self.loop)
+        self.session.connection_made(self.transport)
+
+    def test_reset(self):
+        answer = self.session.reset()
+        self.assertEqual(b'v', self.transport.written)
+        response = fixture('reset_response')
+        self.session.data_received(response[:10])
+        self.assertFalse(answer.done())
+        self.session.data_received(response[10:])
+        self.assertEqual(response[:-len(b'$$$')], self.wait(answer))
+
+    def test_stream(self):
+        self.wait(self.session.start_stream())
+        self.assertEqual(b'b', self.transport.written)
+        data = fixture('stream_16samples')
+        self.session.data_received(data[:SAMPLE_SIZE * 5 + 7])
+        self.session.data_received(data[SAMPLE_SIZE * 5 + 7:])
+        first = self.wait(self.session.__anext__())
+        second = self.wait(self.session.__anext__())
+        expected = SampleBlock(*decodeSamples(data))
+        self.assertEqual(list(expected.counter),
+                         list(first.counter) + list(second.counter))
+        self.assertEqual(list(expected.eeg[15]), list(second.eeg[10]))
+        self.assertEqual(list(range(16)),
+                         [int(i) for i in list(first.index) +
+                          list(second.index)])
+        self.assertEqual(5, len(first.timestamp))
+        self.assertEqual(16, self.session.samplesReceived)
+
+    def test_waiting(self):
+        self.session.start_stream()
+        waiting = self.session.__anext__()
+        self.assertFalse(waiting.done())
+        self.session.data_received(fixture('stream_16samples'))
+        self.assertEqual(16, len(self.wait(waiting)))
+
+    def test_backpressure(self):
+        self.session.maxQueuedBlocks = 4
+        self.session.start_stream()
+        data = fixture('stream_16samples')
+        for i in range(4):
+            self.session.data_received(data[i * SAMPLE_SIZE:
+                                            (i + 1) * SAMPLE_SIZE])
+        self.assertTrue(self.transport.paused)
+        self.wait(self.session.__anext__())
+        self.assertTrue(self.transport.paused)
+        self.wait(self.session.__anext__())
+        self.assertFalse(self.transport.paused)
+
+    def test_lost(self):
+        self.session.start_stream()
+        self.session.data_received(fixture('stream_16samples'))
+        self.session.connection_lost(None)
+        self.wait(self.session.__anext__())
+        self.assertRaises(StopAsyncIteration, self.wait,
+                          self.session.__anext__())
+
+    def test_exit(self):
+        self.session.start_stream()
+        self.wait(self.session.__aexit__(None, None, None))
+        self.assertEqual(b'bs', self.transport.written)
+        self.assertTrue(self.transport.closed)
+
+
+
+@skipUnlessAsyncio
+class TestDaemonSession(_SessionTests, TestCase):
+    def setUp(self):
+        _SessionTests.setUp(self)
+        self.session = DaemonSession('example.com', 8088, device='ttyUSB0',
+                                     fps=5, loop=self.loop)
+
+        self.protocols = []
+
+        def connect(factory, host, port):
+            self.connected = (host, port)
+            proto = factory()
+            self.protocols.append(proto)
+            proto.connection_made(self.transport)
+            connected = self.loop.create_future()
+            connected.set_result((self.transport, proto))
+            return connected
+        self.loop.create_connection = connect
+
+    def test_stream(self):
+        entered = self.session.__aenter__()
+        self.assertEqual(('example.com', 8088), self.connected)
+        self.assertTrue(self.transport.written.startswith(
+            b'GET /devices/ttyUSB0/stream?format=binary&fps=5 HTTP/1.0\r\n'
+            b'Host: example.com:8088\r\n'))
+        block = SampleBlock(*decodeSamples(fixture('stream_16samples')))
+        event = (b'event: sensorBlock\ndata: ' +
+                 base64.b64encode(packBlocks([block])) + b'\n\n')
+        self.session.data_received(b'HTTP/1.0 200 OK\r\nContent-Type: '
+                                   b'text/event-stream\r\n\r\n'
+                                   b'event: keepalive\ndata: "hello"\n\n' +
+                                   event[:30])
+        self.assertIs(self.session, self.wait(entered))
+        self.session.data_received(event[30:])
+        received = self.wait(self.session.__anext__())
+        self.assertEqual(list(block.eeg[3]), list(received.eeg[3]))
+
+    def test_commandRefused(self):
+        started = self.session.start_stream()
+        self.wait(asyncio.sleep(0))
+        self.assertTrue(self.transport.written.startswith(
+            b'POST /devices/ttyUSB0/control HTTP/1.0\r\n'))
+        response = self.protocols[-1]
+        response.data_received(b'HTTP/1.0 500 Internal Server Error\r\n\r\n')
+        response.connection_lost(None)
+        with self.assertRaises(DaemonError) as caught:
+            self.wait(started)
+        self.assertEqual("The daemon answered 500 to start",
+                         str(caught.exception))
+
+    def test_notFound(self):
+        entered = self.session.__aenter__()
+        self.session.data_received(b'HTTP/1.0 404 Not Found\r\n\r\n')
+        self.assertRaises(DaemonError, self.wait, entered)
+        self.assertTrue(self.transport.closed)
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+from array import array
+
+from twisted.trial.unittest import TestCase
+
+from .compressed import (
+    numpy, numpy_reason, numpy_encodeBlock, numpy_decodeBlock,
+    python_encodeBlock, python_decodeBlock, CompressedWriter,
+    CompressedRecording, readHeader)
+from .protocol import decodeSamples, numpy_decodeSamples, python_decodeSamples
+from .ring import SampleBlock, GAP_EEG
+from .fixtures import fixture, rows, times, TIME0
+
+
+class _EncodingTests(object):
+    decodeSamples = None
+    encodeBlock = None
+    decodeBlock = None
+
+    def setUp(self):
+        data = fixture('stream_16samples')
+        self.first = SampleBlock(*self.decodeSamples(data, 10))
+        self.second = SampleBlock(*self.decodeSamples(data, 6, 33 * 10))
+
+    def test_roundTrip(self):
+        encoded = self.encodeBlock([(self.first, times(0, 10)),
+                                    (self.second, times(10, 6))])
+        self.assertEqual(16 * (1 + 32 + 6 + 8), len(encoded))
+        decoded = self.decodeBlock(encoded, 16)
+        self.first.timestamp = times(0, 10)
+        self.second.timestamp = times(10, 6)
+        self.assertEqual(rows([self.first, self.second], timestamps=True),
+                         rows([decoded], timestamps=True))
+
+    def test_gapMarker(self):
+        # differences to and from the marker don't fit in 32 bits.
+        eeg = self.first.eeg
+        eeg[3][:] = array('l', [GAP_EEG] * 8)
+        eeg[4][0] = 2 ** 23 - 1
+        decoded = self.decodeBlock(
+            self.encodeBlock([(self.first, times(0, 10))]), 10)
+        self.assertEqual([list(row) for row in eeg],
+                         [list(row) for row in decoded.eeg])
+
+
+
+class TestPythonEncoding(_EncodingTests, TestCase):
+    decodeSamples = staticmethod(python_decodeSamples)
+    encodeBlock = staticmethod(python_encodeBlock)
+    decodeBlock = staticmethod(python_decodeBlock)
+
+
+
+class TestNumpyEncoding(_EncodingTests, TestCase):
+    decodeSamples = staticmethod(numpy_decodeSamples)
+    encodeBlock = staticmethod(numpy_encodeBlock)
+    decodeBlock = staticmethod(numpy_decodeBlock)
+
+    def test_sameEncoding(self):
+        data = fixture('stream_16samples')
+        pythonBlock = SampleBlock(*python_decodeSamples(data))
+        numpyBlock = SampleBlock(*numpy_decodeSamples(data))
+        self.assertEqual(python_encodeBlock([(pythonBlock, times(0, 16))]),
+                         numpy_encodeBlock([(numpyBlock, times(0, 16))]))
+
+    if numpy is None:
+        skip = "could not load numpy: %s" % (numpy_reason,)
+
+
+
+class TestCompressedRecording(TestCase):
+    def setUp(self):
+        self.filename = self.mktemp()
+        self.block = SampleBlock(*decodeSamples(fixture('stream_16samples')))
+
+    def write(self, blocks=4, close=True):
+        writer = CompressedWriter(open(self.filename, 'wb'), TIME0,
+                                  samplesPerBlock=20)
+        for i in range(blocks):
+            writer.writeBlock(self.block, times(i * 16, 16))
+        if close:
+            writer.close()
+        else:
+            writer.flush()
+        return writer
+
+    def test_header(self):
+        self.write()
+        with open(self.filename, 'rb') as fileobj:
+            header = readHeader(fileobj)
+        self.assertEqual(TIME0, header['time0'])
+        self.assertEqual(20, header['samplesPerBlock'])
+
+    def test_index(self):
+        self.write()
+        recording = CompressedRecording(self.filename)
+        self.addCleanup(recording.close)
+        self.assertEqual([32, 32], [info.count for info in recording.index])
+        self.assertEqual(TIME0 + 32 / 250.0, recording.index[1].first)
+        self.assertEqual(64, len(recording))
+        blocks = list(recording.blocks())
+        self.assertEqual(list(self.block.counter) * 4,
+                         [c for block in blocks for c in block.counter])
+
+    def test_timeRange(self):
+        self.write()
+        recording = CompressedRecording(self.filename)
+        self.addCleanup(recording.close)
+        blocks = list(recording.blocks(TIME0 + 40 / 250.0,
+                                       TIME0 + 45 / 250.0))
+        self.assertEqual(1, len(blocks))
+        self.assertEqual(list(times(40, 5)), list(blocks[0].timestamp))
+        self.assertEqual(list(self.block.counter[8:13]),
+                         list(blocks[0].counter))
+
+    def test_blocksRead(self):
+        """
+        Only the blocks overlapping the range are read, including at the
+        edges of blocks.
+        """
+        self.write()
+        recording = CompressedRecording(self.filename)
+        self.addCleanup(recording.close)
+        read = []
+        readBlock = recording.readBlock
+        def record(info):
+            read.append(recording.index.index(info))
+            return readBlock(info)
+        recording.readBlock = record
+        def counters(start, stop):
+            del read[:]
+            return [c for block in recording.blocks(start, stop)
+                    for c in block.counter]
+        self.assertEqual(list(self.block.counter[:8]),
+                         counters(TIME0 + 32 / 250.0, TIME0 + 40 / 250.0))
+        self.assertEqual([1], read)
+        self.assertEqual(list(self.block.counter[-1:]),
+                         counters(TIME0 + 31 / 250.0, TIME0 + 32 / 250.0))
+        self.assertEqual([0], read)
+        self.assertEqual(64, len(counters(TIME0 - 1, None)))
+        self.assertEqual([0, 1], read)
+        self.assertEqual([], counters(TIME0 + 1, None))
+        self.assertEqual([], read)
+        self.assertEqual([], counters(None, TIME0))
+        self.assertEqual([], read)
+
+    def test_noIndex(self):
+        writer = self.write(close=False)
+        # and the start of a block that never got finished.
+        writer.fileobj.write(b'\x40\x00')
+        writer.fileobj.close()
+        recording = CompressedRecording(self.filename)
+        self.addCleanup(recording.close)
+        self.assertEqual([32, 32], [info.count for info in recording.index])
+        self.assertEqual(64, len(recording))
+
+    def test_read(self):
+        self.write()
+        recording = CompressedRecording(self.filename)
+        self.addCleanup(recording.close)
+        records = recording.read(TIME0 + 30 / 250.0)
+        self.assertEqual(34, len(records))
+        self.assertEqual(list(self.block.eeg[14]), list(records['eeg'][0]))
+        self.assertEqual(TIME0 + 30 / 250.0, records['timestamp'][0])
+
+    if numpy is None:
+        test_read.skip = "could not load numpy: %s" % (numpy_reason,)
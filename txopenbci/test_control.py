@@ -5,11 +5,19 @@ To test:
 """
 
 from twisted.internet import defer
+from twisted.internet.error import ConnectError, ConnectionLost
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
 from twisted.test.proto_helpers import StringTransport
 
 from twisted.trial.unittest import TestCase
-from .protocol import CMD_RESET, CMD_STREAM_STOP
-from .control import DeviceCommander, DeviceReceiver, RawSample
+from .protocol import CMD_RESET, CMD_STREAM_START, CMD_STREAM_STOP
+from .control import (
+    DeviceCommander, DeviceReceiver, DeviceRegistry, DeviceService, RawSample,
+    SampleBlock)
+from .ring import GAP_EEG
+from .fixtures import fixture
+from .timing import ClockModel
 
 
 
@@ -43,6 +51,18 @@ class TestDeviceCommander(TestCase):
         self.assertIsNotNone(self.commander.client)
         self.assertEqual(transport, self.commander.client.transport)
 
+    def test_connectFailed(self):
+        # only logged, for callers that don't wait on it.
+        d = self.commander.connect(FailingEndpoint())
+        self.assertIsNone(self.successResultOf(d))
+        self.assertIsNone(self.commander.client)
+        self.commander.connect(self.endpoint)
+        self.assertIsNotNone(self.commander.client)
+
+    def test_attemptConnectionFailed(self):
+        d = self.commander.attemptConnection(FailingEndpoint())
+        self.failureResultOf(d, ConnectError)
+
     def test_resetOnConnect(self):
         self.commander.connect(self.endpoint)
         transport = self.endpoint.transports[0]
@@ -56,8 +76,47 @@ class TestDeviceCommander(TestCase):
         self.assertEqual(CMD_STREAM_STOP, transport.value())
         self.assertTrue(transport.disconnecting)
 
+    def test_streamSamples(self):
+        self.commander.connect(self.endpoint)
+        transport = self.endpoint.transports[0]
+        samples = []
+        self.commander.receiver.subscribeToSampleData(
+            lambda s: samples.append(s))
+        self.commander.client.dataReceived(fixture('reset_response'))
+        transport.clear()
+        self.commander.startStream()
+        self.assertEqual(CMD_STREAM_START, transport.value())
+        data = fixture('stream_16samples')
+        self.commander.client.dataReceived(data[:50])
+        self.commander.client.dataReceived(data[50:])
+        self.assertEqual(range(16), [s.counter for s in samples])
+        self.assertFalse(transport.disconnecting)
+
+    def test_corruptFrame(self):
+        self.commander.connect(self.endpoint)
+        transport = self.endpoint.transports[0]
+        samples = []
+        self.commander.receiver.subscribeToSampleData(
+            lambda s: samples.append(s))
+        self.commander.client.dataReceived(fixture('reset_response'))
+        self.commander.startStream()
+        data = fixture('stream_16samples')
+        # sample 3 loses its end marker.
+        self.commander.client.dataReceived(data[:4 * 33 - 1] + data[4 * 33:])
+        self.assertEqual([0, 1, 2] + range(4, 16),
+                         [s.counter for s in samples])
+        self.assertFalse(transport.disconnecting)
+        stats = self.commander.receiver.stats()
+        self.assertEqual(1, stats['corruptFrames'])
+        self.assertEqual(32, stats['bytesDiscarded'])
+        self.assertEqual(1, stats['samplesLost'])
+
 
 class TestDeviceReceiver(TestCase):
+    def test_responseWithoutCommander(self):
+        receiver = DeviceReceiver(None)
+        receiver.handleResponse(fixture('reset_response'))
+
     def test_subscribeToSampleData(self):
         # noinspection PyTypeChecker
         receiver = DeviceReceiver(None)
@@ -68,6 +127,92 @@ class TestDeviceReceiver(TestCase):
         receiver._publishSample(sample)
         self.assertEqual([sample], samples)
 
+    def test_subscribeToSampleBlocks(self):
+        receiver = DeviceReceiver(None)
+        blocks = []
+        samples = []
+        receiver.subscribeToSampleBlocks(lambda b: blocks.append(b))
+        receiver.subscribeToSampleData(lambda s: samples.append(s))
+        data = fixture('stream_16samples')
+        receiver.handleFrames(data, 16)
+        self.assertEqual(1, len(blocks))
+        block = blocks[0]
+        self.assertIsInstance(block, SampleBlock)
+        self.assertEqual(16, len(block))
+        self.assertEqual(range(16), [s.counter for s in samples])
+        self.assertEqual(list(block.eeg[3]), list(samples[3].eeg))
+
+    def test_timestamps(self):
+        receiver = DeviceReceiver(None)
+        receiver.clockModel = ClockModel(now=lambda: 10.0,
+                                         wallNow=lambda: 1000.0)
+        blocks = []
+        receiver.subscribeToSampleBlocks(lambda b: blocks.append(b))
+        receiver.handleFrames(fixture('stream_16samples'), 16)
+        timestamp = list(blocks[0].timestamp)
+        # the last sample arrived just now, and the rest at the sample rate
+        # before it.
+        self.assertAlmostEqual(1000.0, timestamp[-1])
+        self.assertAlmostEqual(1000.0 - 15 / 250.0, timestamp[0])
+
+    def gappyStream(self):
+        """Samples 0 to 4 and 8 to 15, the rest lost."""
+        data = fixture('stream_16samples')
+        return data[:5 * 33] + data[8 * 33:], 13
+
+    def test_gaps(self):
+        receiver = DeviceReceiver(None)
+        gaps = []
+        blocks = []
+        receiver.subscribeToGaps(lambda gap: gaps.append(gap))
+        receiver.subscribeToSampleBlocks(lambda b: blocks.append(b))
+        receiver.handleFrames(*self.gappyStream())
+        self.assertEqual([(5, 3)], [(gap.start, gap.length) for gap in gaps])
+        self.assertEqual(13, len(blocks[0]))
+        self.assertEqual([0, 1, 2, 3, 4] + range(8, 16),
+                         [int(i) for i in blocks[0].index])
+        stats = receiver.stats()
+        self.assertEqual(13, stats['samples'])
+        self.assertEqual(3, stats['samplesLost'])
+        self.assertEqual(1, stats['gaps'])
+        self.assertEqual(3, stats['largestGap'])
+        self.assertEqual(3 / 16.0, stats['lossRatio'])
+        self.assertEqual(16, stats['nextIndex'])
+
+    def test_fillGaps(self):
+        receiver = DeviceReceiver(None, fillGaps=True)
+        blocks = []
+        receiver.subscribeToSampleBlocks(lambda b: blocks.append(b))
+        receiver.handleFrames(*self.gappyStream())
+        block = blocks[0]
+        self.assertEqual(range(16), [int(c) for c in block.counter])
+        self.assertEqual(range(16), [int(i) for i in block.index])
+        self.assertEqual([GAP_EEG] * 8, list(block.eeg[6]))
+        self.assertEqual(16, receiver.ring.written)
+
+    def test_newStream(self):
+        commander = DeviceCommander()
+        commander.sender.setTransport(StringTransport())
+        receiver = commander.receiver
+        gaps = []
+        receiver.subscribeToGaps(lambda gap: gaps.append(gap))
+        data = fixture('stream_16samples')
+        receiver.handleFrames(data, 16)
+        # the counter of a new connection starts wherever it likes.
+        receiver.prepareParsing(None)
+        receiver.handleFrames(data[5 * 33:], 11)
+        self.assertEqual([], gaps)
+        self.assertEqual(27, receiver.unwrapper.nextIndex)
+
+    def test_backfill(self):
+        receiver = DeviceReceiver(None)
+        receiver.handleFrames(fixture('stream_16samples'), 16)
+        blocks = []
+        receiver.subscribeToSampleBlocks(lambda b: blocks.append(b),
+                                         backfill=4)
+        self.assertEqual([12, 13, 14, 15],
+                         [int(c) for b in blocks for c in b.counter])
+
     def test_handleSample(self):
         receiver = DeviceReceiver(None)
         samples = []
@@ -109,3 +254,159 @@ class TestDeviceReceiver(TestCase):
         self.assertEqual(counter, result.counter)
         self.assertEqual(eeg, list(result.eeg))
         self.assertEqual(accelerometer, list(result.accelerometer))
+
+
+class FailingEndpoint(object):
+    """An endpoint that can't connect, until ``working`` is set."""
+
+    def __init__(self):
+        self.attempts = 0
+        self.working = None
+
+    def connect(self, protocolFactory):
+        self.attempts += 1
+        if self.working is not None:
+            return self.working.connect(protocolFactory)
+        return defer.fail(ConnectError("no such device"))
+
+
+
+class TestDeviceService(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.endpoint = StringTransportEndpoint()
+        self.service = DeviceService(self.endpoint, self.clock)
+        self.service.jitter = 0
+        self.commander = self.service.commander
+
+    def loseConnection(self):
+        self.commander.client.connectionLost(Failure(ConnectionLost()))
+
+    def test_reconnect(self):
+        self.service.startService()
+        self.addCleanup(self.service.stopService)
+        self.assertEqual(1, len(self.endpoint.transports))
+        self.clock.advance(5)
+        self.loseConnection()
+        self.assertIsNone(self.commander.client)
+        self.assertEqual(0, self.service.stats()['downFor'])
+        self.clock.advance(0.5)
+        self.assertEqual(2, len(self.endpoint.transports))
+        self.assertEqual(CMD_RESET, self.endpoint.transports[1].value())
+        stats = self.service.stats()
+        self.assertEqual(2, stats['connections'])
+        self.assertEqual(0.5, stats['lastDowntime'])
+        self.assertEqual(0.5, stats['downtime'])
+        self.assertIsNone(stats['downFor'])
+
+    def test_resumeStream(self):
+        self.service.startService()
+        self.addCleanup(self.service.stopService)
+        self.commander.client.dataReceived(fixture('reset_response'))
+        self.commander.startStream()
+        self.commander.client.dataReceived(fixture('stream_16samples'))
+        self.loseConnection()
+        self.clock.advance(0.5)
+        transport = self.endpoint.transports[1]
+        self.assertEqual(CMD_RESET, transport.value())
+        transport.clear()
+        samples = []
+        self.commander.receiver.subscribeToSampleData(
+            lambda s: samples.append(s))
+        self.commander.client.dataReceived(fixture('reset_response'))
+        self.assertEqual(CMD_STREAM_START, transport.value())
+        self.commander.client.dataReceived(fixture('stream_16samples'))
+        self.assertEqual(range(16), [s.counter for s in samples])
+        # the new stream follows on from the old one.
+        self.assertEqual(range(16, 32), [s.index for s in samples])
+
+    def test_noResumeWhenStopped(self):
+        self.service.startService()
+        self.addCleanup(self.service.stopService)
+        self.commander.client.dataReceived(fixture('reset_response'))
+        self.commander.startStream()
+        self.commander.stopStream()
+        self.loseConnection()
+        self.clock.advance(0.5)
+        transport = self.endpoint.transports[1]
+        transport.clear()
+        self.commander.client.dataReceived(fixture('reset_response'))
+        self.assertEqual(b'', transport.value())
+
+    def test_backoff(self):
+        endpoint = FailingEndpoint()
+        service = DeviceService(endpoint, self.clock)
+        service.jitter = 0
+        service.startService()
+        self.addCleanup(service.stopService)
+        self.assertEqual(1, endpoint.attempts)
+        delays = []
+        while len(delays) < 8:
+            delays.append(self.clock.getDelayedCalls()[0].getTime() -
+                          self.clock.seconds())
+            self.clock.advance(delays[-1])
+        self.assertEqual([0.5, 1, 2, 4, 8, 16, 30, 30], delays)
+        self.assertEqual(9, endpoint.attempts)
+        self.assertEqual(9, service.stats()['retries'])
+        endpoint.working = StringTransportEndpoint()
+        self.clock.advance(30)
+        self.assertEqual(0, service.stats()['retries'])
+        self.assertIsNotNone(service.commander.client)
+
+    def test_jitter(self):
+        endpoint = FailingEndpoint()
+        service = DeviceService(endpoint, self.clock)
+        service.startService()
+        self.addCleanup(service.stopService)
+        delay = self.clock.getDelayedCalls()[0].getTime()
+        self.assertTrue(0 <= delay < 1.5, delay)
+
+    def test_stopCancelsRetry(self):
+        endpoint = FailingEndpoint()
+        service = DeviceService(endpoint, self.clock)
+        service.startService()
+        service.stopService()
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+
+class TestDeviceRegistry(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.registry = DeviceRegistry(self.clock)
+        self.endpoints = {}
+        for deviceId in ['a', 'b']:
+            self.endpoints[deviceId] = StringTransportEndpoint()
+            self.registry.addDevice(deviceId, self.endpoints[deviceId])
+
+    def test_connectOnStart(self):
+        self.assertEqual([], self.endpoints['a'].transports)
+        self.registry.startService()
+        self.addCleanup(self.registry.stopService)
+        for deviceId in ['a', 'b']:
+            self.assertEqual(1, len(self.endpoints[deviceId].transports))
+            self.assertIsNotNone(
+                self.registry.getDevice(deviceId).commander.client)
+
+    def test_duplicate(self):
+        self.assertRaises(KeyError, self.registry.addDevice, 'a',
+                          StringTransportEndpoint())
+
+    def test_subscribeToDevices(self):
+        seen = []
+        self.registry.subscribeToDevices(
+            lambda deviceId, device: seen.append(deviceId))
+        self.registry.addDevice('c', StringTransportEndpoint())
+        self.assertEqual(['a', 'b', 'c'], seen)
+
+    def test_stats(self):
+        self.registry.startService()
+        self.addCleanup(self.registry.stopService)
+        receiver = self.registry.getDevice('a').commander.receiver
+        receiver.handleFrames(fixture('stream_16samples'), 16)
+        self.clock.advance(2)
+        stats = self.registry.stats()
+        self.assertEqual(16, stats['a']['samples'])
+        self.assertEqual(8.0, stats['a']['samplesPerSecond'])
+        self.assertEqual(0, stats['b']['samples'])
+        self.assertTrue(stats['b']['connected'])
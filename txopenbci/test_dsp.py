@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+from array import array
+from twisted.trial.unittest import TestCase
+
+import math
+
+from .dsp import (
+    numpy, numpy_reason, NumpyDownsampler, PythonDownsampler,
+    DownsampledSource, NumpyIIRFilter, PythonIIRFilter, ScaleToMicrovolts,
+    CommonAverageReference, FilteredSource, notchSection, bandpassSections)
+from .protocol import (
+    decodeSamples, numpy_decodeSamples, python_decodeSamples)
+from .ring import SampleBlock
+from .fixtures import fixture, rows
+
+
+class _DownsamplerTests(object):
+    decodeSamples = None
+    downsampler = None
+
+    def setUp(self):
+        data = fixture('stream_16samples')
+        self.whole = SampleBlock(*self.decodeSamples(data))
+        self.pieces = [SampleBlock(*self.decodeSamples(data, count, 33 * start))
+                       for start, count in [(0, 3), (3, 5), (8, 1), (9, 7)]]
+
+    def downsample(self, factor, mode, blocks):
+        downsampler = self.downsampler(factor, mode)
+        result = []
+        for block in blocks:
+            result.extend(rows([downsampler.process(block)]))
+        return result
+
+    def test_decimate(self):
+        result = self.downsample(4, 'decimate', [self.whole])
+        self.assertEqual([0, 4, 8, 12], [row[0] for row in result])
+        self.assertEqual(rows([self.whole])[4], result[1])
+
+    def test_mean(self):
+        result = self.downsample(2, 'mean', [self.whole])
+        whole = rows([self.whole])
+        self.assertEqual(8, len(result))
+        for channel in range(8):
+            pair = [whole[0][1][channel], whole[1][1][channel]]
+            self.assertIn(result[0][1][channel],
+                          [sum(pair) // 2, (sum(pair) + 1) // 2])
+
+    def test_minmax(self):
+        result = self.downsample(8, 'minmax', [self.whole])
+        self.assertEqual([0, 0, 8, 8], [row[0] for row in result])
+        whole = rows([self.whole])
+        for channel in range(8):
+            column = [row[1][channel] for row in whole[:8]]
+            self.assertEqual(min(column), result[0][1][channel])
+            self.assertEqual(max(column), result[1][1][channel])
+
+    def test_acrossBlocks(self):
+        for mode in ['decimate', 'mean', 'minmax']:
+            self.assertEqual(self.downsample(3, mode, [self.whole]),
+                             self.downsample(3, mode, self.pieces))
+
+    def test_holdsRemainder(self):
+        downsampler = self.downsampler(4, 'decimate')
+        self.assertEqual(0, len(downsampler.process(self.pieces[0])))
+        self.assertEqual([0, 4],
+                         list(downsampler.process(self.pieces[1]).counter))
+
+    def test_timestamps(self):
+        downsampler = self.downsampler(4, 'minmax')
+        stamped = []
+        for start, block in zip([0, 3, 8, 9], self.pieces):
+            timestamp = array('d', range(start, start + len(block)))
+            if numpy and isinstance(block.eeg, numpy.ndarray):
+                timestamp = numpy.array(timestamp)
+            stamped.append(SampleBlock(block.counter, block.eeg,
+                                       block.accelerometer, timestamp))
+        timestamps = []
+        for block in stamped:
+            timestamps.extend(downsampler.process(block).timestamp)
+        self.assertEqual([0, 0, 4, 4, 8, 8, 12, 12], timestamps)
+
+    def test_badMode(self):
+        self.assertRaises(ValueError, self.downsampler, 2, 'median')
+
+
+
+class TestPythonDownsampler(_DownsamplerTests, TestCase):
+    decodeSamples = staticmethod(python_decodeSamples)
+    downsampler = PythonDownsampler
+
+
+
+class TestNumpyDownsampler(_DownsamplerTests, TestCase):
+    decodeSamples = staticmethod(numpy_decodeSamples)
+    downsampler = NumpyDownsampler
+
+    def test_sameAsPython(self):
+        data = fixture('stream_16samples')
+        for mode in ['decimate', 'mean', 'minmax']:
+            self.assertEqual(
+                rows([PythonDownsampler(3, mode).process(
+                    SampleBlock(*python_decodeSamples(data)))]),
+                rows([NumpyDownsampler(3, mode).process(
+                    SampleBlock(*numpy_decodeSamples(data)))]))
+
+    if numpy is None:
+        skip = "could not load numpy: %s" % (numpy_reason,)
+
+
+
+def sineBlock(frequency, count, start=0, numpyArrays=False):
+    """
+    A block with a sine wave on every channel, on top of a large offset as
+    electrodes have.
+    """
+    eeg = [[100000 + int(1000 * math.sin(2 * math.pi * frequency * i / 250.0))
+            for channel in range(8)] for i in range(start, start + count)]
+    counter = [i % 256 for i in range(start, start + count)]
+    accelerometer = [[0, 0, 0]] * count
+    if numpyArrays:
+        return SampleBlock(numpy.array(counter, 'u1'), numpy.array(eeg, 'i4'),
+                           numpy.array(accelerometer, 'i2'))
+    return SampleBlock(array('B', counter), [array('l', row) for row in eeg],
+                       [array('h', row) for row in accelerometer])
+
+
+
+class _FilterTests(object):
+    iirFilter = None
+    numpyArrays = False
+
+    def filtered(self, frequency, pieces=[(0, 500)]):
+        iirFilter = self.iirFilter(
+            [notchSection(60)] + bandpassSections(1, 50))
+        rows = []
+        for start, count in pieces:
+            block = iirFilter.process(
+                sineBlock(frequency, count, start, self.numpyArrays))
+            rows.extend([list(row) for row in block.eeg])
+        return rows
+
+    def amplitude(self, rows):
+        settled = [row[0] for row in rows[250:]]
+        return max(abs(value) for value in settled)
+
+    def test_passband(self):
+        self.assertTrue(900 < self.amplitude(self.filtered(10)) < 1100)
+
+    def test_notch(self):
+        self.assertTrue(self.amplitude(self.filtered(60)) < 10)
+
+    def test_noStartupTransient(self):
+        rows = self.filtered(0)
+        self.assertTrue(max(abs(row[0]) for row in rows) < 1)
+
+    def test_acrossBlocks(self):
+        whole = self.filtered(10)
+        pieces = self.filtered(10, [(0, 1), (1, 100), (101, 399)])
+        for row, other in zip(whole, pieces):
+            for value, otherValue in zip(row, other):
+                self.assertAlmostEqual(value, otherValue, places=6)
+
+    def test_scale(self):
+        block = ScaleToMicrovolts().process(
+            sineBlock(0, 1, numpyArrays=self.numpyArrays))
+        self.assertAlmostEqual(2235.17, block.eeg[0][0], places=2)
+
+    def test_commonAverage(self):
+        block = sineBlock(0, 2, numpyArrays=self.numpyArrays)
+        block.eeg[1][3] += 800
+        block = CommonAverageReference().process(block)
+        self.assertEqual([0.0] * 8, list(block.eeg[0]))
+        self.assertEqual([-100.0] * 3 + [700.0] + [-100.0] * 4,
+                         list(block.eeg[1]))
+
+
+
+class TestPythonIIRFilter(_FilterTests, TestCase):
+    iirFilter = PythonIIRFilter
+
+
+
+class TestNumpyIIRFilter(_FilterTests, TestCase):
+    iirFilter = NumpyIIRFilter
+    numpyArrays = True
+
+    def test_sameAsPython(self):
+        sections = [notchSection(50)] + bandpassSections(0.5, 40)
+        numpyRows = NumpyIIRFilter(sections).process(
+            sineBlock(7, 300, numpyArrays=True)).eeg
+        pythonRows = PythonIIRFilter(sections).process(sineBlock(7, 300)).eeg
+        for row, other in zip(numpyRows, pythonRows):
+            for value, otherValue in zip(row, other):
+                self.assertAlmostEqual(value, otherValue, places=6)
+
+    if numpy is None:
+        skip = "could not load numpy: %s" % (numpy_reason,)
+
+
+
+class FakeReceiver(object):
+    def __init__(self):
+        self.listeners = set()
+
+    def subscribeToSampleBlocks(self, listener):
+        self.listeners.add(listener)
+
+    def unsubscribeFromSampleBlocks(self, listener):
+        self.listeners.discard(listener)
+
+
+
+class TestDownsampledSource(TestCase):
+    def test_subscribesWhileListened(self):
+        receiver = FakeReceiver()
+        source = DownsampledSource(receiver, 2)
+        received = []
+        listener = lambda block: received.append(block)
+        source.subscribeToSampleBlocks(listener)
+        self.assertEqual(1, len(receiver.listeners))
+        for deliver in list(receiver.listeners):
+            deliver(SampleBlock(*decodeSamples(fixture('stream_16samples'))))
+        self.assertEqual([8], [len(block) for block in received])
+        source.unsubscribeFromSampleBlocks(listener)
+        self.assertEqual(set(), receiver.listeners)
+
+    def test_unsubscribedDuringDelivery(self):
+        """
+        A receiver delivering to the listeners it had when a block arrived
+        may still hand it to a source whose last listener has just gone.
+        """
+        receiver = FakeReceiver()
+        source = DownsampledSource(receiver, 2)
+        received = []
+        listener = lambda block: received.append(block)
+        source.subscribeToSampleBlocks(listener)
+        delivering = list(receiver.listeners)
+        source.unsubscribeFromSampleBlocks(listener)
+        for deliver in delivering:
+            deliver(SampleBlock(*decodeSamples(fixture('stream_16samples'))))
+        self.assertEqual([], received)
+
+    def test_filtered(self):
+        receiver = FakeReceiver()
+        source = FilteredSource(receiver)
+        received = []
+        source.subscribeToSampleBlocks(lambda block: received.append(block))
+        for deliver in list(receiver.listeners):
+            deliver(sineBlock(10, 16))
+        self.assertEqual([16], [len(block) for block in received])
+        self.assertIsInstance(received[0].eeg[0][0], float)
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+import os
+
+from twisted.trial.unittest import TestCase
+
+from .compressed import CompressedWriter
+from .history import (
+    numpy, numpy_reason, numpy_aggregate, python_aggregate, LRUCache,
+    RecordingLibrary)
+from .protocol import decodeSamples
+from .pyramid import PyramidWriter, sidecarName
+from .recording import RecordingWriter, recordingToCSV
+from .ring import SampleBlock, GAP_EEG
+from .fixtures import fixture, TIME0
+
+
+# more than two of the sources' 250-sample blocks.
+SAMPLES = 16 * 40
+
+
+def writeRecording(writer):
+    block = SampleBlock(*decodeSamples(fixture('stream_16samples')))
+    for start in range(0, SAMPLES, 16):
+        writer.writeBlock(block, [TIME0 + (start + i) / 250.0
+                                  for i in range(16)])
+    writer.close()
+
+
+def expected():
+    """The counters and EEG rows of every sample in the recordings."""
+    block = SampleBlock(*decodeSamples(fixture('stream_16samples')))
+    return ([int(c) for c in block.counter] * (SAMPLES // 16),
+            [list(row) for row in block.eeg] * (SAMPLES // 16))
+
+
+class TestLRUCache(TestCase):
+    def test_evict(self):
+        cache = LRUCache(2)
+        made = []
+        def make(key):
+            return lambda: made.append(key) or key
+        cache.get('a', make('a'))
+        cache.get('b', make('b'))
+        # using 'a' makes 'b' the least recent.
+        cache.get('a', make('a'))
+        cache.get('c', make('c'))
+        cache.get('a', make('a'))
+        cache.get('b', make('b'))
+        self.assertEqual(['a', 'b', 'c', 'b'], made)
+        self.assertEqual(2, cache.hits)
+        self.assertEqual(2, len(cache))
+
+
+
+class _AggregateTests(object):
+    aggregate = None
+
+    def test_buckets(self):
+        minimum, maximum, mean = self.aggregate([[1, 5, 3, 7, 2],
+                                                 [0, 0, 1, 1, 9]], 2)
+        self.assertEqual([[1, 3, 2], [0, 1, 9]],
+                         [list(row) for row in minimum])
+        self.assertEqual([[5, 7, 2], [0, 1, 9]],
+                         [list(row) for row in maximum])
+        self.assertEqual([[3.0, 5.0, 2.0], [0.0, 1.0, 9.0]],
+                         [list(row) for row in mean])
+
+    def test_gaps(self):
+        minimum, maximum, mean = self.aggregate(
+            [[1, GAP_EEG, 3, 7, GAP_EEG, GAP_EEG]], 2)
+        self.assertEqual([1, 3, 0], list(minimum[0]))
+        self.assertEqual([1, 7, 0], list(maximum[0]))
+        self.assertEqual([1.0, 5.0], list(mean[0])[:2])
+        self.assertNotEqual(mean[0][2], mean[0][2])
+
+
+
+class TestPythonAggregate(_AggregateTests, TestCase):
+    aggregate = staticmethod(python_aggregate)
+
+
+
+class TestNumpyAggregate(_AggregateTests, TestCase):
+    aggregate = staticmethod(numpy_aggregate)
+
+    if numpy is None:
+        skip = "could not load numpy: %s" % (numpy_reason,)
+
+
+
+class _LibraryTests(object):
+    """
+    :ivar name: the recording, as written by ``write``.
+    """
+    name = None
+
+    def setUp(self):
+        self.directory = self.mktemp()
+        os.mkdir(self.directory)
+        self.write(os.path.join(self.directory, 'sensor.1.2.rec'))
+        self.library = RecordingLibrary(self.directory)
+        self.counters, self.eeg = expected()
+
+    def write(self, filename):
+        writeRecording(RecordingWriter(open(filename, 'wb'), TIME0))
+
+    def test_info(self):
+        info = self.library.info(self.name)
+        self.assertEqual(SAMPLES, info['samples'])
+        self.assertAlmostEqual((SAMPLES - 1) / 250.0, info['duration'])
+
+    def test_byIndex(self):
+        result = self.library.query(self.name, 240, 260)
+        self.assertEqual((240, 260), (result['start'], result['stop']))
+        self.assertEqual([row[2] for row in self.eeg[240:260]],
+                         list(result['eeg'][2]))
+        self.assertAlmostEqual(240 / 250.0, result['time'][0])
+
+    def test_byTime(self):
+        result = self.library.query(self.name, 0.999, 1.099, byTime=True,
+                                    channels=[7, 0])
+        self.assertEqual((250, 275), (result['start'], result['stop']))
+        self.assertEqual([[row[7] for row in self.eeg[250:275]],
+                          [row[0] for row in self.eeg[250:275]]],
+                         [list(column) for column in result['eeg']])
+
+    def test_buckets(self):
+        result = self.library.query(self.name, buckets=10)
+        self.assertEqual(SAMPLES // 10, result['bucketSize'])
+        self.assertEqual(10, len(result['mean'][0]))
+        self.assertEqual(max(row[0] for row in self.eeg[:64]),
+                         result['max'][0][0])
+        self.assertAlmostEqual(64 / 250.0, result['time'][1])
+
+    def test_tooMany(self):
+        self.assertRaises(ValueError, self.library.query, self.name,
+                          maxSamples=100)
+        self.assertRaises(ValueError, self.library.query, self.name,
+                          buckets=101, maxSamples=100)
+        self.assertRaises(ValueError, self.library.query, self.name,
+                          buckets=10, maxRead=100)
+        result = self.library.query(self.name, 0, 100, buckets=10,
+                                    maxSamples=100, maxRead=100)
+        self.assertEqual(10, len(result['min'][0]))
+
+    def test_cache(self):
+        self.library.query(self.name, 0, 10)
+        misses = self.library.cache.misses
+        self.library.query(self.name, 10, 20)
+        self.assertEqual(misses, self.library.cache.misses)
+
+
+
+class TestBinaryRecordings(_LibraryTests, TestCase):
+    name = 'sensor.1.2.rec'
+
+    def test_list(self):
+        self.assertEqual([('sensor.1.2.rec', 'binary')],
+                         [(recording['name'], recording['format'])
+                          for recording in self.library.list()])
+
+    def test_unknown(self):
+        self.assertRaises(KeyError, self.library.open, 'sensor.1.3.rec')
+        self.assertRaises(KeyError, self.library.open, '../sensor.1.2.rec')
+
+    def test_growing(self):
+        source = self.library.open(self.name)
+        with open(os.path.join(self.directory, self.name), 'ab') as f:
+            f.write(b'\x00' * 47)
+        self.assertNotIdentical(source, self.library.open(self.name))
+        self.assertEqual(SAMPLES + 1, len(self.library.open(self.name)))
+
+
+
+class TestCompressedRecordings(_LibraryTests, TestCase):
+    name = 'sensor.1.2.recz'
+
+    def write(self, filename):
+        writeRecording(CompressedWriter(open(filename + 'z', 'wb'), TIME0))
+
+
+
+class TestCSVRecordings(_LibraryTests, TestCase):
+    name = 'sensor.1.2.csv'
+
+    def write(self, filename):
+        _LibraryTests.write(self, filename)
+        recordingToCSV(filename, filename[:-len('.rec')] + '.csv')
+
+
+
+class TestSummarizedRecordings(TestCase):
+    def setUp(self):
+        self.directory = self.mktemp()
+        os.mkdir(self.directory)
+        filename = os.path.join(self.directory, 'sensor.1.2.rec')
+        writeRecording(RecordingWriter(open(filename, 'wb'), TIME0))
+        self.library = RecordingLibrary(self.directory)
+        self.unsummarized = self.library.query('sensor.1.2.rec', buckets=10)
+        writeRecording(PyramidWriter(open(sidecarName(filename), 'wb'),
+                                     TIME0, (16, 64)))
+
+    def test_list(self):
+        self.assertEqual(['sensor.1.2.rec'],
+                         [recording['name']
+                          for recording in self.library.list()])
+
+    def test_buckets(self):
+        misses = self.library.cache.misses
+        result = self.library.query('sensor.1.2.rec', buckets=10)
+        self.assertEqual(64, result['bucketSize'])
+        # the samples weren't needed.
+        self.assertEqual(misses, self.library.cache.misses)
+        for key in 'min', 'max':
+            self.assertEqual([list(channel)
+                              for channel in self.unsummarized[key]],
+                             result[key])
+        for mean, expected in zip(result['mean'][3],
+                                  self.unsummarized['mean'][3]):
+            self.assertAlmostEqual(expected, mean)
+        self.assertAlmostEqual(128 / 250.0, result['time'][2], 5)
+
+    def test_unread(self):
+        # with summaries, there are no samples to read.
+        result = self.library.query('sensor.1.2.rec', buckets=10,
+                                    maxRead=100)
+        self.assertEqual(64, result['bucketSize'])
+
+    def test_gaps(self):
+        block = SampleBlock(*decodeSamples(fixture('stream_16samples')))
+        for row in range(2, 5):
+            for channel in range(8):
+                block.eeg[row][channel] = GAP_EEG
+        filename = os.path.join(self.directory, 'gaps.1.2.rec')
+
+        def write(writer):
+            for start in range(0, SAMPLES, 16):
+                writer.writeBlock(block, [TIME0 + (start + i) / 250.0
+                                          for i in range(16)])
+            writer.close()
+        write(RecordingWriter(open(filename, 'wb'), TIME0))
+        fromSamples = self.library.query('gaps.1.2.rec', buckets=10)
+        write(PyramidWriter(open(sidecarName(filename), 'wb'), TIME0,
+                            (16, 64)))
+        fromSummaries = self.library.query('gaps.1.2.rec', buckets=10)
+        for key in 'min', 'max':
+            self.assertEqual([list(channel) for channel in fromSamples[key]],
+                             fromSummaries[key])
+        for mean, expected in zip(fromSummaries['mean'][3],
+                                  fromSamples['mean'][3]):
+            self.assertAlmostEqual(expected, mean)
+
+    def test_fine(self):
+        # buckets smaller than the finest summaries come from the samples.
+        self.library.cache = LRUCache(10)
+        result = self.library.query('sensor.1.2.rec', 0, 80, buckets=10)
+        self.assertEqual(8, result['bucketSize'])
+        self.assertNotEqual(0, self.library.cache.misses)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+from twisted.trial.unittest import TestCase
+
+from .metrics import Registry, DISABLED
+
+
+class TestRegistry(TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = self.registry.counter('things_total', "Things.")
+        counter.inc()
+        counter.inc(2)
+        # the same name is the same counter.
+        self.registry.counter('things_total', "Things.").inc()
+        self.assertEqual(
+            '# HELP things_total Things.\n'
+            '# TYPE things_total counter\n'
+            'things_total 4\n',
+            self.registry.exposition())
+
+    def test_labels(self):
+        device = self.registry.labelled(device='a')
+        device.counter('things_total', "Things.").inc()
+        device.labelled(format='csv').counter('things_total', "Things.").inc(3)
+        self.registry.counter('things_total', "Things.",
+                              {'device': 'b"\\'}).inc(2)
+        self.assertEqual(
+            '# HELP things_total Things.\n'
+            '# TYPE things_total counter\n'
+            'things_total{device="a"} 1\n'
+            'things_total{device="a",format="csv"} 3\n'
+            'things_total{device="b\\"\\\\"} 2\n',
+            self.registry.exposition())
+
+    def test_gauge(self):
+        gauge = self.registry.gauge('level', "Level.")
+        gauge.inc(5)
+        gauge.dec(2)
+        value = [1.5]
+        self.registry.gauge('rate', "Rate.", function=lambda: value[0])
+        value[0] = 2.5
+        self.assertEqual(
+            '# HELP level Level.\n'
+            '# TYPE level gauge\n'
+            'level 3\n'
+            '# HELP rate Rate.\n'
+            '# TYPE rate gauge\n'
+            'rate 2.5\n',
+            self.registry.exposition())
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('size', "Size.", [1, 10])
+        for value in [0.5, 1, 5, 50]:
+            histogram.observe(value)
+        self.assertEqual(
+            '# HELP size Size.\n'
+            '# TYPE size histogram\n'
+            'size_bucket{le="1"} 2\n'
+            'size_bucket{le="10"} 3\n'
+            'size_bucket{le="+Inf"} 4\n'
+            'size_sum 56.5\n'
+            'size_count 4\n',
+            self.registry.exposition())
+
+    def test_wrongKind(self):
+        self.registry.counter('things_total', "Things.")
+        self.assertRaises(ValueError, self.registry.gauge, 'things_total',
+                          "Things.")
+
+    def test_disabled(self):
+        counter = DISABLED.labelled(device='a').counter('things_total', "")
+        counter.inc()
+        DISABLED.histogram('size', "").observe(1)
+        self.assertEqual(0, counter.value)
+        self.assertEqual('', DISABLED.exposition())
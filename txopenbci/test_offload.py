@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import pickle
+import Queue
+
+from twisted.internet.defer import Deferred
+from twisted.trial.unittest import TestCase
+
+from .metrics import Registry
+from .offload import OffloadedSubscriber, readSlot, writeSlot, slotSize
+from .protocol import decodeSamples
+from .ring import SampleBlock
+from .fixtures import fixture, makeBlock
+
+
+def firstIndex(block):
+    return int(block.index[0]), len(block)
+
+
+def fail(block):
+    raise ValueError("no good")
+
+
+
+class FakeProcess(object):
+    exitcode = -9
+
+
+
+class TestSlots(TestCase):
+    def test_roundTrip(self):
+        block = makeBlock(1000)
+        buf = multiprocessing.RawArray('c', 2 * slotSize(16))
+        writeSlot(buf, slotSize(16), block)
+        read = readSlot(buf, slotSize(16))
+        self.assertEqual(list(block.counter), list(read.counter))
+        self.assertEqual(list(block.eeg[7]), list(read.eeg[7]))
+        self.assertEqual(list(block.timestamp), list(read.timestamp))
+        self.assertEqual(list(block.index), list(read.index))
+
+    def test_noTimestamps(self):
+        block = SampleBlock(*decodeSamples(fixture('stream_16samples')))
+        buf = multiprocessing.RawArray('c', slotSize(16))
+        writeSlot(buf, 0, block)
+        read = readSlot(buf, 0)
+        self.assertIdentical(None, read.timestamp)
+        self.assertIdentical(None, read.index)
+
+
+
+class TestDispatch(TestCase):
+    """
+    The reactor side, with queues standing in for the workers.
+    """
+
+    def setUp(self):
+        self.results = []
+        self.subscriber = self.makeSubscriber()
+
+    def makeSubscriber(self, **kwargs):
+        kwargs.setdefault('workers', 1)
+        kwargs.setdefault('maxPendingSamples', 20)
+        subscriber = OffloadedSubscriber(firstIndex, self.results.append,
+                                         metrics=Registry(), **kwargs)
+        subscriber._tasks = [Queue.Queue()
+                             for i in range(subscriber.workers)]
+        return subscriber
+
+    def tasks(self, subscriber=None, worker=0):
+        tasks = (subscriber or self.subscriber)._tasks[worker]
+        return [tasks.get_nowait() for i in range(tasks.qsize())]
+
+    def finish(self, sequence, slot, subscriber=None):
+        subscriber = subscriber or self.subscriber
+        block = readSlot(subscriber.buffer, slot * subscriber.slotSize)
+        subscriber._handleResult(sequence, slot, True,
+                                 pickle.dumps(firstIndex(block)))
+
+    def test_oldest(self):
+        for i in range(5):
+            self.subscriber.handleBlock(makeBlock(i * 16))
+        self.assertEqual([(0, 0), (1, 1)], self.tasks())
+        # the first two waiting blocks were dropped for the last.
+        self.assertEqual(32, self.subscriber.droppedSamples)
+        self.assertEqual(16, self.subscriber.pendingSamples)
+        self.finish(0, 0)
+        self.assertEqual([(0, 16)], self.results)
+        self.assertEqual([(2, 0)], self.tasks())
+        self.finish(1, 1)
+        self.finish(2, 0)
+        self.assertEqual([(0, 16), (16, 16), (64, 16)], self.results)
+
+    def test_newest(self):
+        subscriber = self.makeSubscriber(policy='newest')
+        for i in range(5):
+            subscriber.handleBlock(makeBlock(i * 16))
+        self.assertEqual(32, subscriber.droppedSamples)
+        self.tasks(subscriber)
+        self.finish(0, 0, subscriber)
+        self.assertEqual(32, readSlot(subscriber.buffer, 0).index[0])
+
+    def test_ordered(self):
+        self.subscriber.handleBlock(makeBlock(0))
+        self.subscriber.handleBlock(makeBlock(16))
+        self.finish(1, 1)
+        self.assertEqual([], self.results)
+        self.finish(0, 0)
+        self.assertEqual([(0, 16), (16, 16)], self.results)
+
+    def test_unordered(self):
+        subscriber = self.makeSubscriber(ordered=False)
+        subscriber.handleBlock(makeBlock(0))
+        subscriber.handleBlock(makeBlock(16))
+        self.finish(1, 1, subscriber)
+        self.assertEqual([(16, 16)], self.results)
+
+    def test_split(self):
+        subscriber = self.makeSubscriber(slotSamples=5, slotsPerWorker=4)
+        subscriber.handleBlock(makeBlock(0))
+        self.assertEqual(4, len(self.tasks(subscriber)))
+        self.assertEqual([15], list(readSlot(subscriber.buffer,
+                                             3 * subscriber.slotSize).index))
+
+    def test_spread(self):
+        subscriber = self.makeSubscriber(workers=2)
+        for i in range(3):
+            subscriber.handleBlock(makeBlock(i * 16))
+        self.assertEqual([(0, 0), (2, 1)], self.tasks(subscriber, 0))
+        self.assertEqual([(1, 2)], self.tasks(subscriber, 1))
+
+    def test_failed(self):
+        self.subscriber.handleBlock(makeBlock(0))
+        self.subscriber._handleResult(0, 0, False, "Traceback: no good")
+        self.assertEqual([], self.results)
+        self.assertEqual(1, self.subscriber.errors)
+
+    def test_workerDied(self):
+        subscriber = self.makeSubscriber(workers=2)
+        for i in range(3):
+            subscriber.handleBlock(makeBlock(i * 16))
+        process = subscriber._processes[0] = FakeProcess()
+        self.finish(1, 2, subscriber)
+        self.assertEqual([], self.results)
+        subscriber._workerDied(0, process)
+        # what worker 0 had is gone, and needn't be waited for.
+        self.assertEqual([(16, 16)], self.results)
+        self.assertEqual(2, subscriber.errors)
+        self.assertEqual({'pendingSamples': 0, 'highWaterMark': 0,
+                          'busySlots': 0, 'droppedSamples': 0, 'errors': 2,
+                          'restarts': 0}, subscriber.stats())
+
+    def test_badPolicy(self):
+        self.assertRaises(ValueError, OffloadedSubscriber, firstIndex,
+                          self.results.append, policy='random')
+
+
+
+class TestWorkers(TestCase):
+    def setUp(self):
+        self.results = []
+        self.done = Deferred()
+
+    def start(self, subscriber):
+        subscriber.startService()
+        # so that a failed test doesn't leave workers behind.
+        self.addCleanup(lambda: subscriber.running and
+                        subscriber.stopService())
+
+    def collect(self, expected):
+        def collect(result):
+            self.results.append(result)
+            if len(self.results) == expected:
+                self.done.callback(None)
+        return collect
+
+    def test_workers(self):
+        subscriber = OffloadedSubscriber(firstIndex, self.collect(10),
+                                         maxPendingSamples=1000,
+                                         metrics=Registry())
+        self.start(subscriber)
+        for i in range(10):
+            subscriber.handleBlock(makeBlock(i * 16))
+
+        def finished(_):
+            self.assertEqual([(i * 16, 16) for i in range(10)], self.results)
+            return subscriber.stopService()
+        return self.done.addCallback(finished)
+
+    def test_pendingGauge(self):
+        """
+        The pending samples are reported while the subscriber runs, and it
+        lets go of the gauge when stopped.
+        """
+        registry = Registry()
+        subscriber = OffloadedSubscriber(firstIndex, self.results.append,
+                                         workers=1, metrics=registry)
+        gauge = registry.gauge('txopenbci_offload_pending_samples', '')
+        self.assertIdentical(None, gauge.function)
+        self.start(subscriber)
+        subscriber.pendingSamples = 5
+        self.assertEqual(5, gauge.samples('')[0][2])
+        subscriber.pendingSamples = 0
+
+        def stopped(_):
+            self.assertIdentical(None, gauge.function)
+        return subscriber.stopService().addCallback(stopped)
+
+    def test_failing(self):
+        subscriber = OffloadedSubscriber(fail, self.results.append,
+                                         workers=1, metrics=Registry())
+        self.start(subscriber)
+        subscriber.handleBlock(makeBlock())
+
+        def stopped(_):
+            self.assertEqual([], self.results)
+            self.assertEqual(1, subscriber.errors)
+        return subscriber.stopService().addCallback(stopped)
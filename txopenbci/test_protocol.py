@@ -1,41 +1,37 @@
 # -*- coding: utf-8 -*-
 from collections import OrderedDict
-import gzip
-from os import path
+from struct import Struct
 
+from ometa.grammar import OMeta
 import parsley
-from twisted.python.util import sibpath
 from twisted.trial.unittest import TestCase
 
 try:
     import numpy
-except ImportError, e:
+except ImportError as e:
     numpy = None
     numpy_reason = e
 else:
     numpy_reason = None
 
 
-from .protocol import grammar, python_int32From3Bytes, numpy_int32From3Bytes
-
-
-def fixture(name):
-    filename = sibpath(__file__, path.join('test', name + '.raw'))
-    if path.exists(filename + '.gz'):
-        # some fixtures are gzipped to prevent git and other tools from messing with
-        # their line endings.
-        with gzip.open(filename + '.gz') as datafile:
-            return datafile.read()
-    else:
-        with file(filename, 'rb') as datafile:
-            return datafile.read()
-
+from ._sausage import SwitchingTrampolinedParser
+from .fixtures import fixture
+from .protocol import (
+    grammar, python_int32From3Bytes, numpy_int32From3Bytes,
+    python_accelerometerFromBytes, python_decodeSamples, numpy_decodeSamples,
+    SampleFramer, ResynchronizingFramer, FramingError, SAMPLE_SIZE,
+    _reference_int32From3Bytes, _reference_decodeSamples)
 
 
 class FakeReceiver(object):
     def __init__(self):
         self.results = []
         self.samples = []
+        self.discarded = []
+
+    def handleCorruptData(self, discarded):
+        self.discarded.append(discarded)
 
     def handleResponse(self, content):
         self.results.append(content)
@@ -43,6 +39,11 @@ class FakeReceiver(object):
     def handleSample(self, *a):
         self.samples.append(a)
 
+    def handleFrames(self, buf, count, offset=0):
+        for i in range(count):
+            start = offset + i * SAMPLE_SIZE
+            self.handleSample(ord(buf[start + 1]), buf[start + 2:start + 32])
+
 
 class TestGrammar(TestCase):
     def setUp(self):
@@ -67,6 +68,128 @@ class TestGrammar(TestCase):
         self.assertEqual(15, samples[-1][0])
 
 
+class SwitchingReceiver(FakeReceiver):
+    """Starts streaming when the board answers the reset."""
+    currentRule = 'idle'
+
+    def handleResponse(self, content):
+        FakeReceiver.handleResponse(self, content)
+        self.currentRule = 'sample'
+
+
+
+class TestSwitchingParser(TestCase):
+    def setUp(self):
+        self.receiver = SwitchingReceiver()
+        self.parser = SwitchingTrampolinedParser(
+            OMeta(grammar).parseGrammar('OpenBCIDevice'), self.receiver, {},
+            {'sample': SampleFramer})
+
+    def test_switchToFramer(self):
+        # the samples come in the same read as the end of the response.
+        data = fixture('reset_response') + fixture('stream_16samples')
+        self.parser.receive(data[:100])
+        self.parser.receive(data[100:-40])
+        self.parser.receive(data[-40:])
+        self.assertEqual(1, len(self.receiver.results))
+        self.assertEqual(range(16),
+                         [counter for counter, payload
+                          in self.receiver.samples])
+
+    def test_backToGrammar(self):
+        data = fixture('reset_response')
+        self.parser.receive(data + fixture('stream_16samples')[:50])
+        # not until the frame is finished.
+        self.receiver.currentRule = 'idle'
+        self.parser.receive(fixture('stream_16samples')[50:66])
+        self.assertEqual(2, len(self.receiver.samples))
+        self.parser.receive(data)
+        self.assertEqual(2, len(self.receiver.results))
+
+
+
+class TestSampleFramer(TestCase):
+    def setUp(self):
+        self.receiver = FakeReceiver()
+        self.framer = SampleFramer(self.receiver)
+
+    def test_matchesGrammar(self):
+        data = fixture('stream_16samples')
+        parsley.makeGrammar(grammar, {'receiver': self.receiver})(
+            data).sampleStream()
+        fromGrammar = self.receiver.samples
+        self.receiver.samples = []
+        self.framer.receive(data)
+        self.assertEqual(fromGrammar, self.receiver.samples)
+        self.assertEqual(b'', self.framer.pending)
+
+    def test_partialFrames(self):
+        data = fixture('stream_16samples')
+        for i in range(0, len(data), 7):
+            self.framer.receive(data[i:i + 7])
+        samples = self.receiver.samples
+        self.assertEqual(range(16), [s[0] for s in samples])
+        self.assertEqual(b'', self.framer.pending)
+
+    def test_badEnd(self):
+        data = fixture('stream_with_bad_end')
+        self.assertRaises(FramingError, self.framer.receive, data)
+
+
+
+class TestResynchronizingFramer(TestCase):
+    def setUp(self):
+        self.receiver = FakeReceiver()
+        self.framer = ResynchronizingFramer(self.receiver)
+
+    def counters(self):
+        return [sample[0] for sample in self.receiver.samples]
+
+    def corrupted(self):
+        """
+        The 16 sample fixture, with garbage holding a fake start marker in
+        place of the end of sample 4 and the start of sample 5, and a byte
+        missing from sample 10.
+        """
+        data = fixture('stream_16samples')
+        frame = lambda i: data[i * SAMPLE_SIZE:(i + 1) * SAMPLE_SIZE]
+        return (b''.join(frame(i) for i in range(4)) +
+                frame(4)[:20] + b'\x00\xA0\x07garbage' + frame(5)[3:] +
+                b''.join(frame(i) for i in range(6, 10)) +
+                frame(10)[:-2] + frame(10)[-1:] +
+                b''.join(frame(i) for i in range(11, 16)))
+
+    def test_recovers(self):
+        self.framer.receive(self.corrupted())
+        self.assertEqual([0, 1, 2, 3] + range(6, 10) + range(11, 16),
+                         self.counters())
+        self.assertEqual(2, self.framer.corruptFrames)
+        self.assertEqual(20 + 10 + 30 + 32, self.framer.bytesDiscarded)
+        self.assertEqual([60, 32], self.receiver.discarded)
+        self.assertEqual(b'', self.framer.pending)
+
+    def test_recoversAcrossChunks(self):
+        data = self.corrupted()
+        for i in range(0, len(data), 5):
+            self.framer.receive(data[i:i + 5])
+        self.assertEqual([0, 1, 2, 3] + range(6, 10) + range(11, 16),
+                         self.counters())
+        self.assertEqual([60, 32], self.receiver.discarded)
+
+    def test_goodStream(self):
+        data = fixture('stream_16samples')
+        self.framer.receive(data)
+        self.assertEqual(range(16), self.counters())
+        self.assertEqual(0, self.framer.corruptFrames)
+
+    def test_badEnd(self):
+        data = fixture('stream_with_bad_end')
+        self.framer.receive(data)
+        # everything up to the bad frame; the rest is too short to confirm.
+        self.assertEqual(range(73), self.counters())
+        self.assertEqual(1, self.framer.corruptFrames)
+
+
 int24cases = OrderedDict([
     ('max', (b'\x7F\xFF\xFF', 2 ** 23 - 1)),
     ('one', (b'\x00\x00\x01', 1)),
@@ -77,6 +200,34 @@ int24cases = OrderedDict([
 ])
 
 
+_referenceStruct = Struct('>xB' + 'bH' * 8 + 'hhhx')
+
+
+def referenceDecode(data):
+    """
+    Decode sample packets one value at a time, the slow and obvious way.
+    """
+    counters, eeg, accelerometer = [], [], []
+    for offset in range(0, len(data), SAMPLE_SIZE):
+        parts = _referenceStruct.unpack_from(data, offset)
+        counters.append(parts[0])
+        eeg.append([(high << 16) | low
+                    for high, low in zip(parts[1:17:2], parts[2:17:2])])
+        accelerometer.append(list(parts[17:]))
+    return counters, eeg, accelerometer
+
+
+def extremeFrames():
+    """Sample packets with every interesting 24- and 16-bit value."""
+    values = [in_bytes for in_bytes, number in int24cases.values()]
+    frames = []
+    for i in range(len(values) + 1):
+        eeg = b''.join((values * 2)[i:i + 8])
+        frames.append(b'\xA0' + chr(i) + eeg.ljust(24, b'\x00') +
+                      b'\x80\x00\x7f\xff\xff\xff' + b'\xC0')
+    return b''.join(frames)
+
+
 class TestBitTwiddle(TestCase):
 
     def _test_int32From3Bytes(self, func):
@@ -94,5 +245,73 @@ class TestBitTwiddle(TestCase):
     def test_numpy_int32From3Bytes(self):
         return self._test_int32From3Bytes(numpy_int32From3Bytes)
 
+    def test_reference_int32From3Bytes(self):
+        return self._test_int32From3Bytes(_reference_int32From3Bytes)
+
+    def test_python_int32From3BytesMany(self):
+        data = b'\x00' + b''.join(
+            [in_bytes for in_bytes, number in int24cases.values()])
+        self.assertEqual([number for in_bytes, number in int24cases.values()],
+                         list(python_int32From3Bytes(data, offset=1)))
+
     if numpy is None:
         test_numpy_int32From3Bytes.skip = "could not load numpy: %s" % (numpy_reason,)
+
+
+class TestDecodeSamples(TestCase):
+
+    def _test_decodeSamples(self, func):
+        data = fixture('stream_16samples')
+        receiver = FakeReceiver()
+        SampleFramer(receiver).receive(data)
+        counters, eeg, accelerometer = func(data)
+        self.assertEqual(16, len(counters))
+        for i, (counter, payload) in enumerate(receiver.samples):
+            self.assertEqual(counter, counters[i])
+            self.assertEqual(list(python_int32From3Bytes(payload, 8)),
+                             list(eeg[i]))
+            self.assertEqual(list(python_accelerometerFromBytes(payload, 24)),
+                             list(accelerometer[i]))
+
+    def _test_decodeSamplesOffset(self, func):
+        data = fixture('stream_16samples')
+        counters, eeg, accelerometer = func(data, 3, SAMPLE_SIZE * 2)
+        self.assertEqual([2, 3, 4], list(counters))
+        self.assertEqual(3, len(eeg))
+        self.assertEqual(3, len(accelerometer))
+
+    def _test_decodeSamplesExtremes(self, func):
+        data = extremeFrames()
+        expected = referenceDecode(data)
+        counters, eeg, accelerometer = func(data)
+        self.assertEqual(expected, (list(counters),
+                                    [list(row) for row in eeg],
+                                    [list(row) for row in accelerometer]))
+
+    def test_python_decodeSamples(self):
+        self._test_decodeSamples(python_decodeSamples)
+        self._test_decodeSamplesOffset(python_decodeSamples)
+        self._test_decodeSamplesExtremes(python_decodeSamples)
+
+    def test_reference_decodeSamples(self):
+        self._test_decodeSamples(_reference_decodeSamples)
+        self._test_decodeSamplesOffset(_reference_decodeSamples)
+        self._test_decodeSamplesExtremes(_reference_decodeSamples)
+
+    def test_sameAsReference(self):
+        data = extremeFrames() + fixture('stream_16samples')
+
+        def lists(decoded):
+            counters, eeg, accelerometer = decoded
+            return (list(counters), [list(row) for row in eeg],
+                    [list(row) for row in accelerometer])
+        self.assertEqual(lists(_reference_decodeSamples(data)),
+                         lists(python_decodeSamples(data)))
+
+    def test_numpy_decodeSamples(self):
+        self._test_decodeSamples(numpy_decodeSamples)
+        self._test_decodeSamplesOffset(numpy_decodeSamples)
+        self._test_decodeSamplesExtremes(numpy_decodeSamples)
+
+    if numpy is None:
+        test_numpy_decodeSamples.skip = "could not load numpy: %s" % (numpy_reason,)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from array import array
+
+from twisted.trial.unittest import TestCase
+
+from .protocol import numpy_decodeSamples, python_decodeSamples
+from .pyramid import numpy, numpy_reason, PyramidWriter, Pyramid
+from .ring import SampleBlock, GAP_EEG
+from .fixtures import fixture, times, TIME0
+
+
+LEVELS = (16, 64, 128)
+
+
+class _PyramidTests(object):
+    decodeSamples = None
+
+    def setUp(self):
+        self.filename = self.mktemp()
+        self.writer = PyramidWriter(open(self.filename, 'wb'), TIME0, LEVELS)
+        self.block = SampleBlock(*self.decodeSamples(
+            fixture('stream_16samples'), 10))
+        self.rows = [list(row) for row in self.block.eeg]
+
+    def write(self, blocks):
+        for i in range(blocks):
+            self.writer.writeBlock(self.block, times(i * 10, 10))
+
+    def test_levels(self):
+        # 200 samples: 12 full buckets and one of 8 at the finest level.
+        self.write(20)
+        self.writer.close()
+        pyramid = Pyramid(self.filename)
+        self.assertEqual(LEVELS, pyramid.levels)
+        self.assertEqual(TIME0, pyramid.time0)
+        self.assertEqual([[16] * 12 + [8], [64] * 3 + [8], [128, 72]],
+                         [[summary.count for summary in level]
+                          for level in pyramid.summaries])
+        second = pyramid.summaries[0][1]
+        self.assertEqual(16, second.start)
+        self.assertAlmostEqual(16 / 250.0, second.time, 5)
+        rows = (self.rows * 20)[16:32]
+        self.assertEqual([min(column) for column in zip(*rows)],
+                         list(second.min))
+        self.assertEqual([max(column) for column in zip(*rows)],
+                         list(second.max))
+        top = pyramid.summaries[2][0]
+        rows = (self.rows * 20)[:128]
+        for channel, column in enumerate(zip(*rows)):
+            self.assertAlmostEqual(sum(column) / 128.0, top.mean[channel])
+            self.assertEqual(min(column), top.min[channel])
+
+    def test_crash(self):
+        self.write(20)
+        self.writer.flush()
+        # and half a record.
+        with open(self.filename, 'ab') as fileobj:
+            fileobj.write(b'\x01' * 20)
+        pyramid = Pyramid(self.filename)
+        # the short finest bucket is lost; the coarser ones are made up.
+        self.assertEqual([[16] * 12, [64] * 3], [
+            [summary.count for summary in level]
+            for level in pyramid.summaries[:2]])
+        self.assertEqual([128, 64], [summary.count
+                                     for summary in pyramid.summaries[2]])
+        self.writer.close()
+        closed = Pyramid(self.filename)
+        self.assertEqual(list(closed.summaries[0][11].max),
+                         list(pyramid.summaries[0][11].max))
+
+    def test_gaps(self):
+        self.block.eeg[2][:] = array('l', [GAP_EEG] * 8)
+        self.write(2)
+        self.writer.close()
+        first = Pyramid(self.filename).summaries[0][0]
+        self.assertEqual((16, 14), (first.count, first.valid))
+        rows = self.rows[:2] + self.rows[3:] + self.rows[:2] + self.rows[3:6]
+        self.assertEqual([min(column) for column in zip(*rows)],
+                         list(first.min))
+
+    def test_badLevels(self):
+        self.assertRaises(ValueError, PyramidWriter, open(self.mktemp(), 'wb'),
+                          TIME0, (16, 40))
+
+
+
+class TestPythonPyramid(_PyramidTests, TestCase):
+    decodeSamples = staticmethod(python_decodeSamples)
+
+
+
+class TestNumpyPyramid(_PyramidTests, TestCase):
+    decodeSamples = staticmethod(numpy_decodeSamples)
+
+    if numpy is None:
+        skip = "could not load numpy: %s" % (numpy_reason,)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import csv
+import os
+
+from twisted.trial.unittest import TestCase
+
+from .protocol import decodeSamples, python_decodeSamples
+from .recording import (
+    numpy, numpy_reason, RecordingWriter, Recording, iterRecords,
+    recordingToCSV, readHeader, CSV_HEADER, RECORD_SIZE)
+from .ring import SampleBlock
+from .fixtures import fixture, TIME0
+
+
+def openFiles():
+    return len(os.listdir('/proc/self/fd'))
+
+
+class TestRecording(TestCase):
+
+    def setUp(self):
+        self.filename = self.mktemp()
+        self.block = SampleBlock(*decodeSamples(fixture('stream_16samples')))
+        self.timestamps = [TIME0 + i / 250.0 for i in range(16)]
+
+    def write(self, block=None, chunkSize=64 * 1024):
+        writer = RecordingWriter(open(self.filename, 'wb'), TIME0, chunkSize)
+        writer.writeBlock(block or self.block, self.timestamps)
+        writer.close()
+
+    def test_header(self):
+        self.write()
+        with open(self.filename, 'rb') as fileobj:
+            header = readHeader(fileobj)
+        self.assertEqual(TIME0, header['time0'])
+        self.assertEqual(RECORD_SIZE, header['recordSize'])
+        self.assertEqual(47, RECORD_SIZE)
+
+    def test_chunking(self):
+        writer = RecordingWriter(open(self.filename, 'wb'), TIME0,
+                                 chunkSize=RECORD_SIZE * 20)
+        writer.writeBlock(self.block, self.timestamps)
+        self.assertEqual(1, len(writer._chunks))
+        writer.writeBlock(self.block, self.timestamps)
+        self.assertEqual([], writer._chunks)
+        writer.close()
+
+    def test_iterRecords(self):
+        self.write()
+        header, records = iterRecords(self.filename)
+        records = list(records)
+        self.assertEqual(16, len(records))
+        for i, sample in enumerate(self.block.samples()):
+            self.assertEqual(
+                (sample.counter,) + tuple(sample.eeg) +
+                tuple(sample.accelerometer) + (self.timestamps[i],),
+                records[i])
+
+    def test_pythonBlocks(self):
+        block = SampleBlock(
+            *python_decodeSamples(fixture('stream_16samples')))
+        self.write(block)
+        header, records = iterRecords(self.filename)
+        self.assertEqual(
+            (0,) + tuple(block.eeg[0]) + tuple(block.accelerometer[0]) +
+            (TIME0,),
+            next(records))
+
+    def test_closeEarly(self):
+        self.write()
+        before = openFiles()
+        header, records = iterRecords(self.filename)
+        self.assertEqual(before, openFiles())
+        next(records)
+        # the file, and the mapping's own copy of it.
+        self.assertEqual(before + 2, openFiles())
+        records.close()
+        self.assertEqual(before, openFiles())
+
+    if not os.path.isdir('/proc/self/fd'):
+        test_closeEarly.skip = "can't count open files here"
+
+    def test_truncatedRecord(self):
+        self.write()
+        with open(self.filename, 'ab') as fileobj:
+            fileobj.write(b'\x00' * (RECORD_SIZE // 2))
+        header, records = iterRecords(self.filename)
+        self.assertEqual(16, len(list(records)))
+
+    def test_toCSV(self):
+        self.write()
+        csvFilename = self.mktemp()
+        recordingToCSV(self.filename, csvFilename)
+        with open(csvFilename, 'rb') as csvfile:
+            rows = list(csv.reader(csvfile))
+        self.assertEqual(CSV_HEADER, rows[0])
+        self.assertEqual(17, len(rows))
+        self.assertEqual('15', rows[-1][0])
+        self.assertAlmostEqual(15 / 250.0, float(rows[-1][-1]), places=5)
+
+    def test_memoryMapped(self):
+        self.write()
+        recording = Recording(self.filename)
+        self.assertEqual(16, len(recording))
+        records = recording.records
+        self.assertIsInstance(records, numpy.memmap)
+        self.assertEqual(range(16), list(records['counter']))
+        self.assertEqual(self.block.eeg.tolist(), records['eeg'].tolist())
+        self.assertEqual(self.block.accelerometer.tolist(),
+                         records['accelerometer'].tolist())
+        self.assertEqual(self.timestamps, list(records['timestamp']))
+
+    def test_memoryMappedEmpty(self):
+        RecordingWriter(open(self.filename, 'wb'), TIME0).close()
+        self.assertEqual(0, len(Recording(self.filename)))
+
+    if numpy is None:
+        test_memoryMapped.skip = "could not load numpy: %s" % (numpy_reason,)
+        test_memoryMappedEmpty.skip = test_memoryMapped.skip
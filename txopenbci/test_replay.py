@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.trial.unittest import TestCase
+
+from .control import DeviceCommander
+from .protocol import decodeSamples, SAMPLE_SIZE
+from .replay import (
+    CaptureEndpoint, ReplayEndpoint, RESET_RESPONSE, synthesizeStream)
+from .test_control import StringTransportEndpoint
+from .fixtures import fixture
+
+
+class TestSynthesizeStream(TestCase):
+    def test_framing(self):
+        data = synthesizeStream(300)
+        self.assertEqual(300 * SAMPLE_SIZE, len(data))
+        counters, eeg, accelerometer = decodeSamples(data)
+        self.assertEqual(range(256) + range(44), list(counters))
+        self.assertEqual(0, eeg[0][0])
+
+
+class TestReplayEndpoint(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.commander = DeviceCommander()
+        self.responses = []
+        self.commander.receiver.handleResponse = self.responses.append
+        self.counters = []
+        self.commander.receiver.subscribeToSampleBlocks(
+            lambda block: self.counters.extend(int(c) for c in block.counter))
+
+    def connect(self, data, **kwargs):
+        endpoint = ReplayEndpoint(self.clock, data, **kwargs)
+        self.commander.connect(endpoint)
+        self.clock.advance(0)
+        self.assertEqual([RESET_RESPONSE[:-3]], self.responses)
+        return endpoint.transports[0]
+
+    def test_realTime(self):
+        transport = self.connect(fixture('stream_16samples'))
+        self.commander.startStream()
+        self.clock.pump([0.01] * 100)
+        self.assertEqual(250, len(self.counters))
+        self.assertEqual(range(16) * 15 + range(10), self.counters)
+        self.assertEqual(250 * SAMPLE_SIZE, transport.bytesSent)
+
+    def test_speed(self):
+        self.connect(synthesizeStream(1000), speed=4)
+        self.commander.startStream()
+        self.clock.pump([0.01] * 50)
+        self.assertEqual(500, len(self.counters))
+
+    def test_stopStream(self):
+        self.connect(synthesizeStream(1000))
+        self.commander.startStream()
+        self.clock.pump([0.01] * 10)
+        self.commander.stopStream()
+        received = len(self.counters)
+        self.clock.pump([0.01] * 10)
+        self.assertEqual(received, len(self.counters))
+
+    def test_fastAsPossible(self):
+        self.connect(synthesizeStream(1000), speed=None, loop=False,
+                     chunkSize=1000)
+        self.commander.startStream()
+        self.clock.advance(0)
+        self.assertEqual(1000, len(self.counters))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_hangUp(self):
+        transport = self.connect(synthesizeStream(100))
+        self.commander.startStream()
+        self.commander.hangUp()
+        self.clock.advance(0)
+        self.assertTrue(transport.disconnected)
+        self.assertIsNone(self.commander.client)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+class TestCaptureEndpoint(TestCase):
+    def test_capture(self):
+        filename = self.mktemp()
+        capture = open(filename, 'wb')
+        commander = DeviceCommander()
+        commander.connect(CaptureEndpoint(StringTransportEndpoint(), capture))
+        # the protocol's transport is the wrapper doing the capturing.
+        wrapper = commander.client.transport
+        wrapper.dataReceived(fixture('reset_response'))
+        commander.startStream()
+        wrapper.dataReceived(fixture('stream_16samples'))
+        capture.close()
+        with open(filename, 'rb') as captured:
+            self.assertEqual(
+                fixture('reset_response') + fixture('stream_16samples'),
+                captured.read())
+
+    def test_stopService(self):
+        """
+        Stopping the endpoint closes the capture, with everything received
+        so far in it; anything received later is passed on but not saved.
+        """
+        filename = self.mktemp()
+        endpoint = CaptureEndpoint(StringTransportEndpoint(),
+                                   open(filename, 'wb'))
+        endpoint.startService()
+        commander = DeviceCommander()
+        commander.connect(endpoint)
+        wrapper = commander.client.transport
+        wrapper.dataReceived(fixture('reset_response'))
+        endpoint.stopService()
+        self.assertTrue(endpoint.capture.closed)
+        wrapper.dataReceived(b'more')
+        wrapper.connectionLost(Failure(ConnectionDone()))
+        with open(filename, 'rb') as captured:
+            self.assertEqual(fixture('reset_response'), captured.read())
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+from array import array
+
+from twisted.trial.unittest import TestCase
+
+from .ring import (
+    numpy, numpy_reason, NumpySampleRing, PythonSampleRing, SampleBlock,
+    GAP_EEG, GAP_ACCELEROMETER)
+from .protocol import numpy_decodeSamples, python_decodeSamples
+from .fixtures import fixture, rows
+
+
+class _RingTests(object):
+    ringClass = None
+    decodeSamples = None
+
+    def setUp(self):
+        self.data = fixture('stream_16samples')
+        self.block = SampleBlock(*self.decodeSamples(self.data))
+        self.expected = rows([self.block])
+
+    def test_readBack(self):
+        ring = self.ringClass(32)
+        ring.write(self.block)
+        self.assertEqual(16, ring.written)
+        self.assertEqual(self.expected, rows(ring.read(0)))
+        self.assertEqual(self.expected[4:9], rows(ring.read(4, 9)))
+
+    def test_timestamps(self):
+        ring = self.ringClass(20)
+        ring.write(self.block)
+        self.assertTrue(all(t != t for t in ring.read(0)[0].timestamp))
+        stamped = SampleBlock(self.block.counter, self.block.eeg,
+                              self.block.accelerometer,
+                              array('d', range(16)))
+        ring.write(stamped)
+        self.assertEqual(range(16), [sample.timestamp
+                                     for block in ring.read(16)
+                                     for sample in block.samples()])
+
+    def test_fillGaps(self):
+        # rows 0 to 4 and 8 to 15 of the fixture, as from a lossy link.
+        kept = range(5) + range(8, 16)
+        block = self.block.copy()
+        index = array('d', kept)
+        timestamp = array('d', [10.0 + i for i in kept])
+        if numpy and isinstance(block.eeg, numpy.ndarray):
+            index = numpy.array(index, 'i8')
+            timestamp = numpy.array(timestamp)
+            rowsKept = numpy.array(kept)
+            block = SampleBlock(block.counter[rowsKept], block.eeg[rowsKept],
+                                block.accelerometer[rowsKept], timestamp,
+                                index)
+        else:
+            block = SampleBlock(array('B', [block.counter[i] for i in kept]),
+                                [block.eeg[i] for i in kept],
+                                [block.accelerometer[i] for i in kept],
+                                timestamp, index)
+        filled = rows([block.fillGaps()])
+        self.assertEqual(self.expected[:5], filled[:5])
+        self.assertEqual(self.expected[8:], filled[8:])
+        self.assertEqual((6, [GAP_EEG] * 8, [GAP_ACCELEROMETER] * 3),
+                         filled[6])
+        self.assertEqual(range(10, 26), list(block.fillGaps().timestamp))
+        filled = block.fillGaps()
+        self.assertIs(filled, filled.fillGaps())
+
+    def test_wrap(self):
+        ring = self.ringClass(20)
+        ring.write(self.block)
+        ring.write(self.block)
+        self.assertEqual(32, ring.written)
+        self.assertEqual(12, ring.oldest)
+        blocks = ring.read(12)
+        self.assertEqual(2, len(blocks))
+        self.assertEqual(self.expected[12:] + self.expected,
+                         rows(blocks))
+        self.assertRaises(IndexError, ring.read, 11)
+
+    def test_writeMoreThanCapacity(self):
+        ring = self.ringClass(10)
+        ring.write(self.block)
+        self.assertEqual(6, ring.oldest)
+        self.assertEqual(self.expected[6:], rows(ring.read(6)))
+
+    def test_cursor(self):
+        ring = self.ringClass(20)
+        cursor = ring.cursor()
+        ring.write(self.block)
+        self.assertEqual(16, cursor.pending())
+        self.assertEqual(self.expected, rows(cursor.read()))
+        self.assertEqual([], cursor.read())
+
+    def test_cursorOverrun(self):
+        ring = self.ringClass(20)
+        cursor = ring.cursor()
+        ring.write(self.block)
+        ring.write(self.block)
+        self.assertEqual(self.expected[12:] + self.expected,
+                         rows(cursor.read()))
+        self.assertEqual(12, cursor.overruns)
+
+    def test_backfill(self):
+        ring = self.ringClass(20)
+        ring.write(self.block)
+        cursor = ring.cursor(backfill=5)
+        self.assertEqual(self.expected[11:], rows(cursor.read()))
+        cursor = ring.cursor(backfill=100)
+        self.assertEqual(self.expected, rows(cursor.read()))
+
+
+
+class TestPythonSampleRing(_RingTests, TestCase):
+    ringClass = PythonSampleRing
+    decodeSamples = staticmethod(python_decodeSamples)
+
+    def test_storage(self):
+        ring = self.ringClass(4)
+        self.assertIsInstance(ring.eeg, array)
+        self.assertEqual(4 * 8, len(ring.eeg))
+
+
+
+class TestNumpySampleRing(_RingTests, TestCase):
+    ringClass = NumpySampleRing
+    decodeSamples = staticmethod(numpy_decodeSamples)
+
+    def test_readIsView(self):
+        ring = self.ringClass(20)
+        ring.write(self.block)
+        view = ring.read(0)[0]
+        self.assertIs(ring.eeg, view.eeg.base)
+
+    if numpy is None:
+        skip = "could not load numpy: %s" % (numpy_reason,)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+from array import array
+import multiprocessing
+import os
+
+from twisted.trial.unittest import TestCase
+
+from .protocol import numpy_decodeSamples, python_decodeSamples
+from .ring import SampleBlock
+from .shm import (numpy, numpy_reason, NumpySharedRing, PythonSharedRing,
+                  publish, attach, ringPath, PREFIX, _counters,
+                  _COUNTERS_OFFSET)
+from .fixtures import fixture, rows
+from .test_recording import openFiles
+
+
+def _readInChild(path, ringClass, results):
+    ring = attach(path, ringClass)
+    cursor = ring.cursor(backfill=100)
+    results.put(rows(cursor.read()))
+    ring.close()
+
+
+
+class _SharedRingTests(object):
+    ringClass = None
+    decodeSamples = None
+
+    def setUp(self):
+        self.block = SampleBlock(*self.decodeSamples(
+            fixture('stream_16samples')))
+        self.block.timestamp = array('d', [100.0 + i for i in range(16)])
+        self.block.index = array('d', range(16))
+        self.expected = rows([self.block])
+        self.path = os.path.abspath(self.mktemp())
+
+    def publish(self, capacity=32):
+        ring = publish(self.path, capacity, self.ringClass)
+        self.addCleanup(ring.close)
+        return ring
+
+    def attach(self):
+        ring = attach(self.path, self.ringClass)
+        self.addCleanup(ring.close)
+        return ring
+
+    def test_readBack(self):
+        writer = self.publish()
+        reader = self.attach()
+        cursor = reader.cursor()
+        self.assertEqual([], rows(cursor.read()))
+        writer.write(self.block)
+        self.assertEqual((16, 16), (reader.written, reader.claimed))
+        blocks = cursor.read()
+        self.assertEqual(self.expected, rows(blocks))
+        self.assertEqual([100.0 + i for i in range(16)],
+                         list(blocks[0].timestamp))
+        self.assertEqual(range(16), [int(i) for i in blocks[0].index])
+        self.assertEqual(0, cursor.pending())
+
+    def test_writtenWhileReading(self):
+        """
+        Rows the writer publishes while a cursor is reading are left for
+        its next read, not skipped.
+        """
+        writer = self.publish()
+        reader = self.attach()
+        cursor = reader.cursor()
+        writer.write(self.block.slice(0, 8))
+        read = reader.read
+        def readThenWrite(start, stop=None):
+            blocks = read(start, stop)
+            writer.write(self.block.slice(8, 16))
+            return blocks
+        reader.read = readThenWrite
+        self.assertEqual(self.expected[:8], rows(cursor.read()))
+        del reader.read
+        self.assertEqual(self.expected[8:], rows(cursor.read()))
+        self.assertEqual(0, cursor.overruns)
+
+    def test_wrap(self):
+        writer = self.publish(20)
+        reader = self.attach()
+        cursor = reader.cursor()
+        writer.write(self.block)
+        writer.write(self.block)
+        self.assertEqual(12, reader.oldest)
+        self.assertEqual(self.expected[12:] + self.expected,
+                         rows(cursor.read()))
+        self.assertEqual(12, cursor.overruns)
+
+    def test_claimed(self):
+        writer = self.publish(20)
+        reader = self.attach()
+        cursor = reader.cursor()
+        writer.write(self.block)
+        self.assertTrue(reader.intact(0))
+        # as if the writer were partway through storing ten more.
+        _counters.pack_into(writer._map, _COUNTERS_OFFSET, 16, 26)
+        self.assertEqual(6, reader.oldest)
+        self.assertFalse(reader.intact(5))
+        self.assertTrue(reader.intact(6))
+        self.assertEqual(self.expected[6:], rows(cursor.read()))
+        self.assertEqual(6, cursor.overruns)
+
+    def test_unknown(self):
+        writer = self.publish()
+        writer.write(SampleBlock(self.block.counter, self.block.eeg,
+                                 self.block.accelerometer))
+        block, = self.attach().read(0)
+        self.assertTrue(all(t != t for t in block.timestamp))
+        self.assertEqual([-1] * 16, [int(i) for i in block.index])
+
+    def test_close(self):
+        writer = self.publish()
+        reader = self.attach()
+        self.assertFalse(reader.closed)
+        writer.close()
+        self.assertTrue(reader.closed)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_replaced(self):
+        old = self.publish()
+        new = self.publish()
+        old.close()
+        self.assertFalse(self.attach().closed)
+        new.close()
+
+    def test_publishFails(self):
+        """
+        If the ring can't be made or put in place, the half-made file is
+        closed and removed, even while the error is still being handled.
+        """
+        def broken(path, fileobj, writable):
+            raise ValueError("broken")
+        def cantRename(source, destination):
+            raise OSError("can't rename")
+        directory = os.path.dirname(self.path)
+        state = lambda: (openFiles(), sorted(os.listdir(directory)))
+        before = state()
+        for ringClass in [broken, self.ringClass]:
+            try:
+                publish(self.path, 32, ringClass)
+            except (ValueError, OSError):
+                # the traceback still holds publish's frame here.
+                self.assertEqual(before, state())
+            else:
+                self.fail("publish didn't fail")
+            self.patch(os, 'rename', cantRename)
+
+    if not os.path.isdir('/proc/self/fd'):
+        test_publishFails.skip = "can't count open files here"
+
+    def test_notRing(self):
+        with open(self.path, 'wb') as fileobj:
+            fileobj.write(b'\0' * 256)
+        self.assertRaises(ValueError, attach, self.path, self.ringClass)
+
+    def test_otherProcess(self):
+        writer = self.publish()
+        writer.write(self.block)
+        results = multiprocessing.Queue()
+        child = multiprocessing.Process(
+            target=_readInChild, args=(self.path, self.ringClass, results))
+        child.start()
+        self.addCleanup(child.join)
+        self.assertEqual(self.expected, results.get(timeout=10))
+
+    def test_name(self):
+        self.assertEqual(PREFIX + 'ttyUSB0',
+                         os.path.basename(ringPath('ttyUSB0')))
+        self.assertEqual('/tmp/ring', ringPath('/tmp/ring'))
+
+
+
+class TestPythonSharedRing(_SharedRingTests, TestCase):
+    ringClass = PythonSharedRing
+    decodeSamples = staticmethod(python_decodeSamples)
+
+
+
+class TestNumpySharedRing(_SharedRingTests, TestCase):
+    ringClass = NumpySharedRing
+    decodeSamples = staticmethod(numpy_decodeSamples)
+
+    def test_views(self):
+        writer = self.publish()
+        reader = self.attach()
+        cursor = reader.cursor()
+        writer.write(self.block)
+        block, = cursor.read()
+        self.assertFalse(block.eeg.flags.owndata)
+        self.assertFalse(block.eeg.flags.writeable)
+        writer.write(self.block)
+        self.assertEqual(list(self.block.eeg[3]), list(reader.eeg[19]))
+
+    def test_mixed(self):
+        # the file is the same whoever writes it.
+        writer = publish(self.path, 32, PythonSharedRing)
+        self.addCleanup(writer.close)
+        writer.write(self.block)
+        self.assertEqual(self.expected, rows(self.attach().read(0)))
+
+    if numpy is None:
+        skip = "could not load numpy: %s" % (numpy_reason,)
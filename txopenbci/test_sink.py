@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import glob
+import os
+
+from twisted.trial.unittest import TestCase
+
+from .pyramid import Pyramid
+from .sink import SensorLog, BinarySensorLog, CompressedSensorLog, ThreadedLog
+from .fixtures import makeBlock
+from .metrics import Registry
+
+
+class FakeLog(object):
+    """Keeps counters of blocks instead of writing them."""
+    writer = None
+    time0 = None
+    size = 0
+
+    def __init__(self):
+        self.counters = []
+        self.syncs = 0
+        self.closes = 0
+
+    def handleBlock(self, block):
+        self.writer = True
+        self.counters.extend(int(c) for c in block.counter)
+
+    def flush(self):
+        pass
+
+    def sync(self):
+        self.syncs += 1
+
+    def close(self):
+        self.writer = None
+        self.closes += 1
+
+
+
+class TestThreadedLog(TestCase):
+    def test_writes(self):
+        fake = FakeLog()
+        threaded = ThreadedLog(fake)
+        # queued before the writer starts, so it can't have taken any yet.
+        for i in range(3):
+            threaded.handleBlock(makeBlock())
+        self.assertEqual(48, threaded.highWaterMark)
+        threaded.startService()
+        d = threaded.stopService()
+
+        def stopped(_):
+            self.assertEqual(list(makeBlock().counter) * 3, fake.counters)
+            self.assertEqual(0, threaded.queuedSamples)
+            self.assertEqual(1, fake.closes)
+        return d.addCallback(stopped)
+
+    def test_full(self):
+        fake = FakeLog()
+        threaded = ThreadedLog(fake, maxQueuedSamples=20)
+        # not started, so nothing leaves the queue.
+        threaded.handleBlock(makeBlock(count=10))
+        threaded.handleBlock(makeBlock(count=16))
+        threaded.handleBlock(makeBlock(count=10))
+        self.assertEqual(20, threaded.queuedSamples)
+        self.assertEqual(16, threaded.droppedSamples)
+        self.assertEqual(20, threaded.stats()['highWaterMark'])
+
+    def test_fsyncAlways(self):
+        fake = FakeLog()
+        threaded = ThreadedLog(fake, fsync='always', flushInterval=60)
+        threaded.startService()
+        threaded.handleBlock(makeBlock())
+        threaded.handleBlock(makeBlock())
+
+        def stopped(_):
+            # once for each block, and again on closing.
+            self.assertEqual(3, fake.syncs)
+        return threaded.stopService().addCallback(stopped)
+
+    def test_badPolicy(self):
+        self.assertRaises(ValueError, ThreadedLog, FakeLog(), fsync='often')
+
+    def test_metrics(self):
+        """
+        Each log reports on its own device, and only while it runs.
+        """
+        registry = Registry()
+        logs = [ThreadedLog(FakeLog(), metrics=registry.labelled(device=d))
+                for d in 'ab']
+        for threaded in logs:
+            threaded.startService()
+        logs[0].handleBlock(makeBlock())
+        logs[1].handleBlock(makeBlock(count=10))
+
+        def highWater():
+            return dict(
+                line.rsplit(' ', 1)
+                for line in registry.exposition().splitlines()
+                if line.startswith('txopenbci_log_queue_high_water_samples'))
+        self.assertEqual(
+            {'txopenbci_log_queue_high_water_samples{device="a"}': '16',
+             'txopenbci_log_queue_high_water_samples{device="b"}': '10'},
+            highWater())
+        d = logs[0].stopService()
+
+        def stopped(_):
+            self.assertEqual(
+                {'txopenbci_log_queue_high_water_samples{device="a"}': '0',
+                 'txopenbci_log_queue_high_water_samples{device="b"}': '10'},
+                highWater())
+            return logs[1].stopService()
+        return d.addCallback(stopped)
+
+    def test_rotate(self):
+        os.mkdir('rotate')
+        os.chdir('rotate')
+        self.addCleanup(os.chdir, '..')
+        threaded = ThreadedLog(SensorLog(), maxBytes=1000)
+        threaded.startService()
+        for i in range(3):
+            threaded.handleBlock(makeBlock())
+
+        def stopped(_):
+            self.assertEqual(2, threaded.rotations)
+            filenames = sorted(glob.glob('sensor.*.csv'))
+            self.assertEqual(3, len(filenames))
+            for filename in filenames:
+                with open(filename) as logfile:
+                    self.assertEqual(17, len(logfile.readlines()))
+        return threaded.stopService().addCallback(stopped)
+
+
+
+class TestSummaries(TestCase):
+    def setUp(self):
+        directory = self.mktemp()
+        os.makedirs(directory)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(directory)
+
+    def check(self, sensorLog, extension):
+        for i in range(20):
+            sensorLog.handleBlock(makeBlock())
+        sensorLog.close()
+        (filename,) = glob.glob('sensor.*' + extension)
+        pyramid = Pyramid(filename + '.pyr')
+        self.assertEqual([250, 70], [summary.count
+                                     for summary in pyramid.summaries[0]])
+
+    def test_csv(self):
+        self.check(SensorLog(), '.csv')
+
+    def test_binary(self):
+        self.check(BinarySensorLog(), '.rec')
+
+    def test_compressed(self):
+        self.check(CompressedSensorLog(), '.recz')
+
+    def test_off(self):
+        sensorLog = BinarySensorLog(summaries=False)
+        sensorLog.handleBlock(makeBlock())
+        sensorLog.close()
+        self.assertEqual([], glob.glob('*.pyr'))
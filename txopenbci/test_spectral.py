@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from .dsp import microvoltsPerCount
+from .spectral import (
+    numpy, numpy_reason, NumpySpectralEngine, PythonSpectralEngine,
+    SpectralSource)
+from .test_dsp import FakeReceiver, sineBlock
+
+
+class _SpectralTests(object):
+    engine = None
+    numpyArrays = False
+
+    def feed(self, engine, frequency, count, blockSize=50):
+        for start in range(0, count, blockSize):
+            engine.handleBlock(
+                sineBlock(frequency, blockSize, start, self.numpyArrays))
+
+    def test_waitsForWindow(self):
+        engine = self.engine()
+        self.feed(engine, 10, 250)
+        self.assertIdentical(None, engine.latest)
+        self.feed(engine, 10, 50)
+        self.assertNotIdentical(None, engine.latest)
+
+    def test_bandPower(self):
+        engine = self.engine()
+        self.feed(engine, 10, 1000)
+        bands = engine.latest['bands']
+        # a sine of amplitude A has power A**2 / 2.
+        expected = (1000 * microvoltsPerCount()) ** 2 / 2
+        for channel in range(8):
+            self.assertTrue(0.98 < bands['alpha'][channel] / expected < 1.02)
+            self.assertTrue(bands['beta'][channel] < expected / 1000)
+        self.assertEqual(129, len(engine.latest['spectrum'][0]))
+
+    def test_hop(self):
+        engine = self.engine(hop=100)
+        results = []
+        engine.subscribeToSpectra(lambda result: results.append(result))
+        self.feed(engine, 10, 600)
+        # samples 299 (as soon as the window fills), 399, 499 and 599.
+        self.assertEqual([43, 143, 243, 87],
+                         [result['counter'] for result in results])
+
+
+
+class TestPythonSpectralEngine(_SpectralTests, TestCase):
+    engine = PythonSpectralEngine
+
+    def test_powerOfTwo(self):
+        self.assertRaises(ValueError, PythonSpectralEngine, windowSize=250)
+
+
+
+class TestNumpySpectralEngine(_SpectralTests, TestCase):
+    engine = NumpySpectralEngine
+    numpyArrays = True
+
+    def test_sameAsPython(self):
+        engines = []
+        for engine, numpyArrays in [(NumpySpectralEngine(), True),
+                                    (PythonSpectralEngine(), False)]:
+            for start in range(0, 500, 30):
+                engine.handleBlock(sineBlock(21, 30, start, numpyArrays))
+            engines.append(engine)
+        numpyEngine, pythonEngine = engines
+        for row, other in zip(numpyEngine.latest['spectrum'],
+                              pythonEngine.latest['spectrum']):
+            for value, otherValue in zip(row, other):
+                self.assertAlmostEqual(value, otherValue, places=6)
+
+    if numpy is None:
+        skip = "could not load numpy: %s" % (numpy_reason,)
+
+
+
+class TestSpectralSource(TestCase):
+    def setUp(self):
+        self.receiver = FakeReceiver()
+        self.clock = Clock()
+        self.source = SpectralSource(self.receiver, self.clock,
+                                     PythonSpectralEngine)
+
+    def feed(self, count):
+        for start in range(0, count, 50):
+            for deliver in list(self.receiver.listeners):
+                deliver(sineBlock(10, 50, start))
+
+    def test_subscribesWhileListened(self):
+        self.assertEqual(set(), self.receiver.listeners)
+        results = []
+        listener = lambda result: results.append(result)
+        self.source.subscribeToSpectra(listener)
+        self.assertEqual(1, len(self.receiver.listeners))
+        self.feed(300)
+        self.assertEqual(1, len(results))
+        self.source.unsubscribeFromSpectra(listener)
+        self.assertEqual(set(), self.receiver.listeners)
+
+    def test_hold(self):
+        self.source.hold()
+        self.clock.advance(self.source.holdTime - 1)
+        self.source.hold()
+        self.feed(300)
+        self.assertNotIdentical(None, self.source.engine.latest)
+        self.clock.advance(self.source.holdTime - 1)
+        self.assertEqual(1, len(self.receiver.listeners))
+        self.clock.advance(1)
+        self.assertEqual(set(), self.receiver.listeners)
+
+    def test_freshEngine(self):
+        """
+        Starting again starts a new window, rather than carrying on from
+        samples taken before the quiet spell.
+        """
+        self.source.hold()
+        self.feed(300)
+        self.clock.advance(self.source.holdTime)
+        self.assertNotIdentical(None, self.source.engine.latest)
+        self.source.hold()
+        self.assertIdentical(None, self.source.engine.latest)
+        self.feed(200)
+        self.assertIdentical(None, self.source.engine.latest)
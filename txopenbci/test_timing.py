@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import random
+from array import array
+
+from twisted.trial.unittest import TestCase
+
+from .timing import numpy, numpy_reason, ClockModel, CounterUnwrapper
+
+
+def simulate(seconds, drift=200e-6, latency=0.005, jitter=0.02,
+             chunk=12, numpyArrays=False, seed=0):
+    """
+    Feed a model chunks from a board whose crystal is ``drift`` fast,
+    arriving after a random delay. The host's clocks both start at zero.
+
+    :returns: the model, and the errors of the last second of timestamps
+        against the true sample times plus ``latency``.
+    """
+    rng = random.Random(seed)
+    now = [0.0]
+    model = ClockModel(now=lambda: now[0], wallNow=lambda: now[0])
+    period = (1.0 - drift) / 250
+    errors = []
+    total = int(seconds * 250)
+    for start in range(0, total, chunk):
+        indices = range(start, start + chunk)
+        if numpyArrays:
+            indices = numpy.array(indices, 'i8')
+        else:
+            indices = array('d', indices)
+        now[0] = (indices[-1] * period + latency +
+                  rng.uniform(0, jitter))
+        stamps = model.timestamps(indices)
+        if start >= total - 250:
+            errors.extend([stamp - (index * period + latency)
+                           for stamp, index in zip(stamps, indices)])
+    return model, errors
+
+
+def mean(values):
+    return sum(values) / len(values)
+
+
+
+class _TimingTests(object):
+    numpyArrays = False
+
+    def counters(self, values):
+        if self.numpyArrays:
+            return numpy.array(values, 'u1')
+        return array('B', values)
+
+    def indices(self, values):
+        if self.numpyArrays:
+            return numpy.array(values, 'i8')
+        return array('d', values)
+
+    def test_unwrap(self):
+        unwrapper = CounterUnwrapper()
+        indices, gaps = unwrapper.unwrap(self.counters([3, 4, 5]))
+        self.assertEqual([0, 1, 2], list(indices))
+        self.assertEqual([], gaps)
+        # skipping 248 packets, then wrapping past 255.
+        indices, gaps = unwrapper.unwrap(self.counters([6, 255, 0, 1]))
+        self.assertEqual([3, 252, 253, 254], list(indices))
+        self.assertEqual([(1, 248)], gaps)
+        # the same counter again is a whole turn later.
+        indices, gaps = unwrapper.unwrap(self.counters([1]))
+        self.assertEqual([510], list(indices))
+        self.assertEqual([(0, 255)], gaps)
+        self.assertEqual(511, unwrapper.nextIndex)
+
+    def test_forget(self):
+        unwrapper = CounterUnwrapper()
+        unwrapper.unwrap(self.counters([3, 4, 5]))
+        unwrapper.forget()
+        indices, gaps = unwrapper.unwrap(self.counters([100, 101]))
+        self.assertEqual([3, 4], list(indices))
+        self.assertEqual([], gaps)
+
+    def test_driftAndJitter(self):
+        model, errors = simulate(120, numpyArrays=self.numpyArrays)
+        error = model.samplePeriod / ((1.0 - 200e-6) / 250) - 1
+        self.assertTrue(abs(error) < 10e-6, error)
+        # the fit can't know the fixed part of the latency, only smooth out
+        # the jitter around it, which averages half of ``jitter``.
+        average = mean(errors)
+        self.assertTrue(abs(average - 0.01) < 0.003, average)
+        spread = max(errors) - min(errors)
+        self.assertTrue(spread < 0.005, spread)
+
+    def test_wallClock(self):
+        model = ClockModel(now=lambda: 5.0, wallNow=lambda: 1000.0)
+        stamps = model.timestamps(self.indices([0, 1]))
+        self.assertAlmostEqual(1000.0, stamps[1])
+        self.assertAlmostEqual(1000.0 - 1 / 250.0, stamps[0])
+
+    def test_lostSamples(self):
+        model = ClockModel(now=lambda: 5.0, wallNow=lambda: 1000.0)
+        stamps = model.timestamps(self.indices([0, 1, 5]))
+        self.assertAlmostEqual(1000.0 - 4 / 250.0, stamps[1])
+
+    def test_resetOnGap(self):
+        model, errors = simulate(10, numpyArrays=self.numpyArrays)
+        self.assertEqual(0, model.resets)
+        # the stream stops for a minute, and comes back.
+        model.now = model.wallNow = lambda: 70.0
+        stamps = model.timestamps(self.indices([2507, 2508]))
+        self.assertEqual(1, model.resets)
+        # starting over from the clock, at the nominal rate.
+        self.assertAlmostEqual(70.0, stamps[1])
+        self.assertAlmostEqual(1 / 250.0, stamps[1] - stamps[0])
+
+
+
+class TestPythonTiming(_TimingTests, TestCase):
+    pass
+
+
+
+class TestNumpyTiming(_TimingTests, TestCase):
+    numpyArrays = True
+
+    if numpy is None:
+        skip = "could not load numpy: %s" % (numpy_reason,)
@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+import base64
+import json
+import os
+import re
+import urlparse
+
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase
+from twisted.web.resource import getChildForRequest
+from twisted.web.static import File
+from twisted.web.test.requesthelper import DummyRequest
+
+from .compressed import CompressedWriter
+from .control import DeviceRegistry
+from .dsp import DownsampledSource, FilteredSource
+from .history import RecordingLibrary
+from .test_control import StringTransportEndpoint
+from .test_history import SAMPLES, writeRecording
+from .fixtures import fixture, TIME0
+from .web import Root, SampleStreamer, MultiplexedStreamer, EventFanOut
+from .wire import unpackBlock
+
+
+class StreamingRequest(DummyRequest):
+    """
+    A DummyRequest that takes push producers, rather than pulling on them
+    until they unregister.
+    """
+    producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+def request(root, path, **args):
+    """Make a request for ``path`` and find the resource that handles it."""
+    req = StreamingRequest(path.split('/'))
+    for name, value in args.items():
+        req.addArg(name, value)
+    req.transport = StringTransport()
+    req.transport.disconnected = False
+    return req, getChildForRequest(root, req)
+
+
+def events(req):
+    """The (event, data) pairs written to a request."""
+    found = []
+    for message in ''.join(req.written).split('\n\n'):
+        lines = dict(line.split(': ', 1) for line in message.splitlines())
+        if lines.get('event') == 'sensorBlock':
+            found.append(('sensorBlock',
+                          unpackBlock(base64.b64decode(lines['data']))))
+        elif lines:
+            found.append((lines.get('event'), json.loads(lines['data'])))
+    return found
+
+
+class TestDevices(TestCase):
+    def setUp(self):
+        self.registry = DeviceRegistry(Clock())
+        for deviceId in ['a', 'b']:
+            self.registry.addDevice(deviceId, StringTransportEndpoint())
+        self.root = Root(self.registry.getDevice('a'), self.registry)
+        self.clock = Clock()
+
+    def receive(self, deviceId):
+        receiver = self.registry.getDevice(deviceId).commander.receiver
+        receiver.handleFrames(fixture('stream_16samples'), 2)
+        self.clock.advance(0)
+
+    def test_listing(self):
+        req, resource = request(self.root, 'devices/')
+        result = json.loads(resource.render(req))
+        self.assertEqual(['a', 'b'], sorted(result))
+
+    def test_stats(self):
+        receiver = self.registry.getDevice('b').commander.receiver
+        data = fixture('stream_16samples')
+        # samples 0, 1 and 5; 2 to 4 are lost.
+        receiver.handleFrames(data[:2 * 33] + data[5 * 33:6 * 33], 3)
+        req, resource = request(self.root, 'devices/b/stats')
+        result = json.loads(resource.render(req))
+        self.assertEqual(3, result['samplesLost'])
+        self.assertEqual(0.5, result['lossRatio'])
+        req, resource = request(self.root, 'devices/')
+        result = json.loads(resource.render(req))
+        self.assertEqual(3, result['b']['samplesLost'])
+        self.assertEqual(0, result['a']['samplesLost'])
+
+    def test_metrics(self):
+        def lost():
+            req, resource = request(self.root, 'metrics')
+            lines = resource.render(req).splitlines()
+            self.assertEqual('text/plain; version=0.0.4',
+                             req.outgoingHeaders['content-type'])
+            for line in lines:
+                name, value = line.rsplit(' ', 1)
+                if name == 'txopenbci_samples_lost_total{device="b"}':
+                    return float(value)
+        before = lost()
+        receiver = self.registry.getDevice('b').commander.receiver
+        data = fixture('stream_16samples')
+        receiver.handleFrames(data[:2 * 33] + data[5 * 33:6 * 33], 3)
+        self.assertEqual(before + 3, lost())
+
+    def test_unknownDevice(self):
+        req, resource = request(self.root, 'devices/z/stream')
+        resource.render(req)
+        self.assertEqual(404, req.responseCode)
+
+    def test_deviceStream(self):
+        req, resource = request(self.root, 'devices/b/stream')
+        self.assertIsInstance(resource, SampleStreamer)
+        resource.clock = self.clock
+        resource.render(req)
+        self.receive('a')
+        self.receive('b')
+        self.assertEqual(['keepalive', 'sensorData', 'sensorData'],
+                         [name for name, data in events(req)])
+
+    def test_pageScripts(self):
+        """
+        The page's scripts are relative, so they load from the top-level page
+        and from each device's page, wherever the daemon is mounted.
+        """
+        for page in ['', 'devices/b/']:
+            req, resource = request(self.root, page)
+            with open(resource.path) as fileobj:
+                srcs = re.findall(r'<script src="([^/"][^"]*)"', fileobj.read())
+            self.assertEqual(['static/datastream.js'], srcs)
+            path = urlparse.urljoin('/' + page, srcs[0])
+            req, resource = request(self.root, path[1:])
+            self.assertIsInstance(resource, File)
+            self.assertTrue(resource.exists(), path)
+
+    def test_multiplexedStream(self):
+        req, resource = request(self.root, 'devices/stream')
+        self.assertIsInstance(resource, MultiplexedStreamer)
+        resource.fanOut.clock = self.clock
+        resource.render(req)
+        self.receive('a')
+        self.receive('b')
+        self.assertEqual([['a', 0], ['a', 1], ['b', 0], ['b', 1]],
+                         [data[:2] for name, data in events(req)[1:]])
+
+
+class TestRecordings(TestCase):
+    def setUp(self):
+        directory = self.mktemp()
+        os.mkdir(directory)
+        writeRecording(CompressedWriter(
+            open(os.path.join(directory, 'sensor.1.2.recz'), 'wb'), TIME0))
+        registry = DeviceRegistry(Clock())
+        self.root = Root(registry.addDevice('a', StringTransportEndpoint()),
+                         recordings=RecordingLibrary(directory))
+
+    def get(self, path, **args):
+        req, resource = request(self.root, path, **args)
+        return req, resource.render(req)
+
+    def test_list(self):
+        req, body = self.get('recordings/')
+        self.assertEqual(['sensor.1.2.recz'],
+                         [recording['name'] for recording in json.loads(body)])
+
+    def test_info(self):
+        req, body = self.get('recordings/sensor.1.2.recz')
+        self.assertEqual(SAMPLES, json.loads(body)['samples'])
+
+    def test_data(self):
+        req, body = self.get('recordings/sensor.1.2.recz/data', by='index',
+                             start='10', stop='20', channels='1,3')
+        result = json.loads(body)
+        self.assertEqual([1, 3], result['channels'])
+        self.assertEqual(10, len(result['eeg'][1]))
+
+    def test_buckets(self):
+        req, body = self.get('recordings/sensor.1.2.recz/data', start='0.5',
+                             buckets='4')
+        result = json.loads(body)
+        self.assertEqual(125, result['start'])
+        self.assertEqual(4, len(result['min'][0]))
+
+    def test_errors(self):
+        req, body = self.get('recordings/nothing.rec')
+        self.assertEqual(404, req.responseCode)
+        req, body = self.get('recordings/sensor.1.2.recz/data', channels='9')
+        self.assertEqual(400, req.responseCode)
+        req, body = self.get('recordings/sensor.1.2.recz/data',
+                             buckets='1000000000')
+        self.assertEqual(400, req.responseCode)
+        self.root.getStaticEntity('recordings').maxSamples = 100
+        req, body = self.get('recordings/sensor.1.2.recz/data')
+        self.assertEqual(400, req.responseCode)
+
+
+
+class TestBinaryStream(TestCase):
+    def setUp(self):
+        self.registry = DeviceRegistry(Clock())
+        self.device = self.registry.addDevice('a', StringTransportEndpoint())
+        self.root = Root(self.device)
+        self.clock = Clock()
+        self.root.getStaticEntity('stream').clock = self.clock
+
+    def receive(self, count):
+        self.device.commander.receiver.handleFrames(
+            fixture('stream_16samples'), count)
+
+    def test_batches(self):
+        req, resource = request(self.root, 'stream', format='binary', fps='5')
+        resource.render(req)
+        other, resource = request(self.root, 'stream', format='binary',
+                                  fps='5')
+        resource.render(other)
+        self.assertEqual(1, len(resource.feeds))
+        self.receive(3)
+        self.receive(4)
+        self.clock.advance(0.2)
+        self.receive(2)
+        self.clock.advance(0.2)
+        blocks = [data for name, data in events(req)[1:]]
+        self.assertEqual([7, 2], [len(block) for block in blocks])
+        self.assertEqual([0, 1, 2, 0, 1, 2, 3], list(blocks[0].counter))
+        self.assertEqual(''.join(req.written), ''.join(other.written))
+
+    def test_stopsWithoutSubscribers(self):
+        req, resource = request(self.root, 'stream', format='binary')
+        resource.render(req)
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+        req.transport.disconnected = True
+        self.clock.advance(1)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_forgotten(self):
+        resource = None
+        for rate in ('62.5', '50', '25'):
+            req, resource = request(self.root, 'stream', format='binary',
+                                    rate=rate)
+            resource.render(req)
+            req.transport.disconnected = True
+        req, resource = request(self.root, 'stream', rate='50')
+        resource.render(req)
+        self.assertEqual(4, len(resource.feeds))
+        self.clock.advance(1)
+        self.receive(4)
+        # only what the JSON client at 50 Hz needs is left.
+        self.assertEqual(1, len(resource.feeds))
+        self.assertEqual([5], [source.factor
+                               for source in resource.sources.values()
+                               if isinstance(source, DownsampledSource)])
+        req.finish()
+        self.assertEqual({}, resource.feeds)
+        self.assertEqual([], [source for source in resource.sources.values()
+                              if isinstance(source, DownsampledSource)])
+
+    def test_badFormat(self):
+        req, resource = request(self.root, 'stream', format='xml')
+        resource.render(req)
+        self.assertEqual(400, req.responseCode)
+
+    def test_downsampled(self):
+        req, resource = request(self.root, 'stream', format='binary',
+                                rate='62.5', mode='minmax')
+        resource.render(req)
+        other, resource = request(self.root, 'stream', rate='62.5',
+                                  mode='minmax')
+        resource.render(other)
+        self.assertEqual(2, len(resource.feeds))
+        self.assertEqual(1, len([source for source in resource.sources.values()
+                                 if isinstance(source, DownsampledSource)]))
+        self.receive(6)
+        self.clock.advance(0.2)
+        (block,) = [data for name, data in events(req)[1:]]
+        self.assertEqual([0, 0], list(block.counter))
+        self.assertEqual(2, len(events(other)[1:]))
+
+    def test_filtered(self):
+        req, resource = request(self.root, 'stream', filtered='1', rate='125')
+        resource.render(req)
+        other, resource = request(self.root, 'stream', filtered='1')
+        resource.render(other)
+        self.receive(4)
+        self.clock.advance(0)
+        self.assertEqual([0, 2], [data[0] for name, data in events(req)[1:]])
+        self.assertEqual(4, len(events(other)[1:]))
+        self.assertIsInstance(events(other)[1][1][1][0], float)
+        # one filter, feeding both the raw and the downsampled streams.
+        self.assertEqual(1, len([source for source in resource.sources.values()
+                                 if isinstance(source, FilteredSource)]))
+
+    def test_badArguments(self):
+        for args in [{'rate': 'fast'}, {'mode': 'median'},
+                     {'format': 'binary', 'filtered': '1'}]:
+            req, resource = request(self.root, 'stream', **args)
+            resource.render(req)
+            self.assertEqual(400, req.responseCode)
+
+
+class TestSpectrum(TestCase):
+    def setUp(self):
+        self.registry = DeviceRegistry(Clock())
+        self.device = self.registry.addDevice('a', StringTransportEndpoint())
+        self.root = Root(self.device)
+        self.clock = Clock()
+        streamer = self.root.getStaticEntity('spectrum').getStaticEntity(
+            'stream')
+        streamer.fanOut.clock = self.clock
+        streamer.bandsFanOut.clock = self.clock
+
+    def receive(self, count):
+        receiver = self.device.commander.receiver
+        for i in range(count // 16):
+            receiver.handleFrames(fixture('stream_16samples'), 16)
+        self.clock.advance(0)
+
+    def test_snapshot(self):
+        req, resource = request(self.root, 'spectrum')
+        result = json.loads(resource.render(req))
+        self.assertEqual(None, result['latest'])
+        self.assertEqual([8.0, 13.0], result['bandEdges']['alpha'])
+        self.receive(256)
+        result = json.loads(resource.render(req))
+        self.assertEqual(129, len(result['frequencies']))
+        self.assertEqual(8, len(result['latest']['bands']['alpha']))
+        self.assertEqual(8, len(result['latest']['spectrum']))
+
+    def test_sharedEngine(self):
+        """
+        Each device has one engine, however many resources serve it, and it
+        only listens to the device while someone wants spectra.
+        """
+        registry = DeviceRegistry(Clock())
+        device = registry.addDevice('a', StringTransportEndpoint())
+        receiver = device.commander.receiver
+        root = Root(device, registry)
+        listening = lambda: len(receiver._blockSubscribers)
+        before = listening()
+        req, resource = request(root, 'spectrum/stream')
+        resource.render(req)
+        other, otherResource = request(root, 'devices/a/spectrum/stream')
+        otherResource.render(other)
+        self.assertIdentical(resource.spectra, otherResource.spectra)
+        self.assertEqual(before + 1, listening())
+        req.finish()
+        self.assertEqual(before + 1, listening())
+        other.finish()
+        self.assertEqual(before, listening())
+
+    def test_stream(self):
+        req, resource = request(self.root, 'spectrum/stream')
+        resource.render(req)
+        bandsOnly, resource = request(self.root, 'spectrum/stream',
+                                      spectrum='0')
+        resource.render(bandsOnly)
+        self.receive(256 + 64)
+        results = [data for name, data in events(req)[1:]]
+        self.assertEqual(2, len(results))
+        self.assertIn('spectrum', results[0])
+        bands = [data for name, data in events(bandsOnly)[1:]][-1]
+        self.assertEqual(['bands', 'counter'], sorted(bands))
+        self.assertEqual(results[-1]['bands'], bands['bands'])
+
+
+
+class TestEventFanOut(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.fanOut = EventFanOut(maxQueuedBytes=100)
+        self.fanOut.clock = self.clock
+
+    def subscribe(self):
+        req = StreamingRequest([''])
+        req.transport = StringTransport()
+        req.transport.disconnected = False
+        subscriber = self.fanOut.add(req)
+        del req.written[:]
+        return req, subscriber
+
+    def test_coalesce(self):
+        req, subscriber = self.subscribe()
+        self.fanOut.broadcast('a' * 10)
+        self.fanOut.broadcast('b' * 10)
+        self.assertEqual([], req.written)
+        self.clock.advance(0)
+        self.assertEqual(['a' * 10 + 'b' * 10], req.written)
+        self.assertEqual(20, subscriber.sentBytes)
+
+    def test_pausedQueueBounded(self):
+        req, subscriber = self.subscribe()
+        subscriber.pauseProducing()
+        for i in range(30):
+            self.fanOut.broadcast('%010d' % (i,))
+        self.clock.advance(0)
+        self.assertEqual([], req.written)
+        self.assertEqual(100, subscriber.queuedBytes)
+        self.assertEqual(20, subscriber.dropped)
+        subscriber.resumeProducing()
+        self.clock.advance(0)
+        self.assertEqual([''.join('%010d' % (i,) for i in range(20, 30))],
+                         req.written)
+
+    def test_decimate(self):
+        self.fanOut.policy = 'decimate'
+        req, subscriber = self.subscribe()
+        subscriber.pauseProducing()
+        for i in range(11):
+            self.fanOut.broadcast('%010d' % (i,))
+        subscriber.resumeProducing()
+        self.clock.advance(0)
+        self.assertEqual([''.join('%010d' % (i,) for i in [1, 3, 5, 7, 9, 10])],
+                         req.written)
+        self.assertEqual(5, subscriber.dropped)
+
+    def test_stalledClientsDontHoldUpOthers(self):
+        subscribers = [self.subscribe() for i in range(100)]
+        for req, subscriber in subscribers[::3]:
+            subscriber.pauseProducing()
+        for i in range(1000):
+            self.fanOut.broadcast('%010d' % (i,))
+            self.clock.advance(0)
+        for i, (req, subscriber) in enumerate(subscribers):
+            self.assertTrue(subscriber.queuedBytes <= 100)
+            if i % 3:
+                self.assertEqual(10000, subscriber.sentBytes)
+            else:
+                self.assertEqual(990, subscriber.dropped)
+
+    def test_removeOnFinish(self):
+        req, subscriber = self.subscribe()
+        subscriber.pauseProducing()
+        self.fanOut.broadcast('x' * 200)
+        req.finish()
+        self.assertEqual(0, len(self.fanOut))
+        self.assertEqual(1, self.fanOut.dropped)
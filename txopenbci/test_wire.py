@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from twisted.trial.unittest import TestCase
+
+from .protocol import numpy_decodeSamples, python_decodeSamples
+from .ring import SampleBlock
+from .fixtures import fixture, rows
+from .wire import (
+    numpy, numpy_reason, numpy_packBlocks, numpy_unpackBlock,
+    python_packBlocks, python_unpackBlock)
+
+
+class _WireTests(object):
+    decodeSamples = None
+    packBlocks = None
+    unpackBlock = None
+
+    def setUp(self):
+        data = fixture('stream_16samples')
+        self.first = SampleBlock(*self.decodeSamples(data, 10))
+        self.second = SampleBlock(*self.decodeSamples(data, 6, 33 * 10))
+
+    def test_roundTrip(self):
+        packed = self.packBlocks([self.first, self.second])
+        self.assertEqual(4 + 16 * (32 + 6 + 1), len(packed))
+        unpacked = self.unpackBlock(packed)
+        self.assertEqual(rows([self.first, self.second]), rows([unpacked]))
+
+    def test_empty(self):
+        self.assertEqual(0, len(self.unpackBlock(self.packBlocks([]))))
+
+    def test_layout(self):
+        packed = self.packBlocks([self.second])
+        self.assertEqual(b'\x06\x00\x00\x00', packed[:4])
+        self.assertEqual(b'\x0a\x0b\x0c\x0d\x0e\x0f', packed[-6:])
+
+
+
+class TestPythonWire(_WireTests, TestCase):
+    decodeSamples = staticmethod(python_decodeSamples)
+    packBlocks = staticmethod(python_packBlocks)
+    unpackBlock = staticmethod(python_unpackBlock)
+
+
+
+class TestNumpyWire(_WireTests, TestCase):
+    decodeSamples = staticmethod(numpy_decodeSamples)
+    packBlocks = staticmethod(numpy_packBlocks)
+    unpackBlock = staticmethod(numpy_unpackBlock)
+
+    def test_samePacking(self):
+        data = fixture('stream_16samples')
+        pythonBlock = SampleBlock(*python_decodeSamples(data))
+        numpyBlock = SampleBlock(*numpy_decodeSamples(data))
+        self.assertEqual(python_packBlocks([pythonBlock]),
+                         numpy_packBlocks([numpyBlock]))
+
+    if numpy is None:
+        skip = "could not load numpy: %s" % (numpy_reason,)
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+When was each sample taken?
+
+The board doesn't say. All we have is the time each chunk of packets
+turned up, which lumps a chunk's samples together and carries the jitter
+of the serial port and the reactor, and the packet counter, which ticks at
+the board's own crystal rate but wraps at 256.
+
+`CounterUnwrapper` turns the counter into a running sample index, noting
+where packets went missing. `ClockModel` keeps a least-squares fit of
+arrival time against that index, weighted towards recent chunks. The fit's
+slope is the board's real sample period by the host clock, drift and all,
+and the fitted line gives every sample a smooth timestamp.
+"""
+import time
+from array import array
+
+try:
+    import numpy
+except ImportError as e:
+    numpy = None
+    numpy_reason = e
+else:
+    numpy_reason = None
+
+from .protocol import SAMPLE_RATE
+
+
+# time.monotonic arrived in Python 3.3; fall back to the wall clock before.
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class CounterUnwrapper(object):
+    """
+    Running sample indices from the board's 8-bit packet counter.
+
+    The counter goes up by one for each packet, so a bigger step means
+    packets were lost on the way. A counter that doesn't change at all is
+    taken as 256 packets gone by.
+
+    :ivar nextIndex: the index the next packet will get, if none are lost.
+    """
+
+    def __init__(self):
+        self.nextIndex = 0
+        self.lastCounter = None
+
+
+    def forget(self):
+        """
+        Stop expecting the counter to follow on, as when the stream starts
+        over. Indices carry on from where they were.
+        """
+        self.lastCounter = None
+
+
+    def unwrap(self, counters):
+        """
+        Turn the counters of a block into running sample indices.
+
+        :returns: the index of each packet (numpy int64, or array of
+            doubles, which hold whole numbers exactly up to 2**53), and a
+            list of ``(position, missing)`` pairs: the position in the block
+            of each packet that came after a gap, and how many packets are
+            missing before it.
+        """
+        count = len(counters)
+        last = self.lastCounter
+        if not count:
+            return array('d'), []
+        if numpy is not None and isinstance(counters, numpy.ndarray):
+            steps = numpy.empty(count, 'i8')
+            steps[1:] = numpy.diff(counters.astype('i8'))
+            steps[0] = 1 if last is None else int(counters[0]) - last
+            steps = (steps - 1) % 256 + 1
+            indices = self.nextIndex - 1 + numpy.cumsum(steps)
+            gaps = [(int(position), int(steps[position]) - 1)
+                    for position in numpy.flatnonzero(steps > 1)]
+        else:
+            indices = array('d')
+            gaps = []
+            index = self.nextIndex - 1
+            for position, counter in enumerate(counters):
+                counter = int(counter)
+                if last is None:
+                    step = 1
+                else:
+                    step = (counter - last - 1) % 256 + 1
+                    if step > 1:
+                        gaps.append((position, step - 1))
+                index += step
+                last = counter
+                indices.append(index)
+        self.lastCounter = int(counters[-1])
+        self.nextIndex = int(indices[-1]) + 1
+        return indices, gaps
+
+
+
+class ClockModel(object):
+    """
+    Per-sample timestamps from chunk arrival times.
+
+    Timestamps are in the same terms as ``time.time()``, but are worked out
+    on ``now`` (a monotonic clock when there is one), with the difference
+    between the two taken once, when the model starts. So they're
+    comparable between boards on the same host, and don't jump when the
+    wall clock is set.
+
+    :ivar samplePeriod: the current estimate of seconds per sample.
+    :ivar residual: how much later than the fitted line the latest chunk
+        arrived, in seconds: a measure of transport latency jitter.
+    :ivar resets: how many times the model has started over.
+    """
+
+    # how much weight each chunk keeps, per sample since: about 30 seconds'
+    # memory at 250 Hz.
+    forgetting = 1.0 - 1.0 / (SAMPLE_RATE * 30)
+    # a chunk this far off the line means the stream was interrupted, and
+    # the old fit no longer applies.
+    maxResidual = 1.0
+
+    def __init__(self, sampleRate=SAMPLE_RATE, now=monotonic,
+                 wallNow=time.time):
+        """
+        :param now: the clock to fit against.
+        :param wallNow: the clock to report in.
+        """
+        self.nominalPeriod = 1.0 / sampleRate
+        self.now = now
+        self.wallNow = wallNow
+        self.resets = -1
+        self.reset()
+
+
+    def reset(self):
+        """
+        Forget everything, as when the stream starts over.
+        """
+        self.samplePeriod = self.nominalPeriod
+        self.residual = 0.0
+        self.resets += 1
+        self._wallOffset = None
+        # the latest (index, arrival) point, and weighted sums of 1, x, y,
+        # x*x and x*y for the fit, taken relative to it.
+        self._reference = None
+        self._sums = None
+
+
+    def _fit(self, x, y):
+        """
+        Add the point (x, y) to the fit, and move its origin there.
+        """
+        if self._reference is not None:
+            x0, y0 = self._reference
+            dx, dy = x - x0, y - y0
+            decay = self.forgetting ** dx
+            s, sx, sy, sxx, sxy = [value * decay for value in self._sums]
+            # shift the origin to the new point...
+            sxx += s * dx * dx - 2 * dx * sx
+            sxy += s * dx * dy - dx * sy - dy * sx
+            sx -= s * dx
+            sy -= s * dy
+            # ...and add it, there.
+            self._sums = [s + 1, sx, sy, sxx, sxy]
+        else:
+            self._sums = [1.0, 0.0, 0.0, 0.0, 0.0]
+        self._reference = (x, y)
+
+
+    def _line(self):
+        """
+        :returns: the fitted time at the latest point's index, and the slope.
+        """
+        s, sx, sy, sxx, sxy = self._sums
+        spread = s * sxx - sx * sx
+        # until the points are spread over a few seconds, the slope is
+        # mostly jitter; stick to the nominal rate.
+        if spread < (s * SAMPLE_RATE) ** 2:
+            slope = self.nominalPeriod
+        else:
+            slope = (s * sxy - sx * sy) / spread
+        return self._reference[1] + (sy - slope * sx) / s, slope
+
+
+    def timestamps(self, indices, arrival=None):
+        """
+        Timestamp a block that has just arrived.
+
+        :param indices: the running index of each sample in the block, as
+            from `CounterUnwrapper`.
+        :param arrival: when the block arrived, by ``now``; defaults to now.
+        :returns: the time of each sample, as floats.
+        """
+        if not len(indices):
+            return array('d')
+        if arrival is None:
+            arrival = self.now()
+        last = float(indices[-1])
+
+        if self._reference is not None:
+            origin, slope = self._line()
+            predicted = origin + slope * (last - self._reference[0])
+            if abs(arrival - predicted) > self.maxResidual:
+                self.reset()
+        if self._wallOffset is None:
+            self._wallOffset = self.wallNow() - arrival
+
+        self._fit(last, arrival)
+        origin, slope = self._line()
+        self.samplePeriod = slope
+        self.residual = arrival - origin
+        # relative to the last sample, to keep the precision of big indices.
+        end = origin + self._wallOffset
+        if numpy is not None and isinstance(indices, numpy.ndarray):
+            return (indices - last) * slope + end
+        return array('d', [(index - last) * slope + end for index in indices])
@@ -1,12 +1,22 @@
 # -*- coding: utf-8 -*-
 import array
+import base64
+from collections import deque
 import json
 import os.path
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.task import LoopingCall
 from twisted.python.util import sibpath
 from twisted.web.resource import Resource, NoResource
 from twisted.web.server import NOT_DONE_YET
-from twisted.web.http import ACCEPTED
+from twisted.web.http import ACCEPTED, BAD_REQUEST, NOT_FOUND
 from twisted.web.static import File
+from twisted.web.util import redirectTo
+from zope.interface import implementer
+
+from . import dsp, protocol, wire
+from .history import RecordingLibrary
+from .metrics import REGISTRY
 
 try:
     import numpy
@@ -27,25 +37,259 @@ class ArrayEncoder(json.JSONEncoder):
 _dumps = ArrayEncoder().encode
 
 
+_indexPath = os.path.join(sibpath(__file__, "webpages"), 'index.html')
+
+
 class Root(Resource):
 
-    def __init__(self, deviceService):
+    def __init__(self, deviceService, registry=None, recordings=None):
         """
+        :param deviceService: the device for the top-level ``control`` and
+            ``stream`` resources.
         :type deviceService: txopenbci.control.DeviceService
+        :param registry: (optional) all the devices, to be served under
+            ``devices``.
+        :type registry: txopenbci.control.DeviceRegistry
+        :param recordings: (optional) the recordings to serve under
+            ``recordings``; by default, those in the current directory,
+            where the sinks write them.
+        :type recordings: txopenbci.history.RecordingLibrary
         """
         Resource.__init__(self)
 
         self.putChild("control", CommandResource(deviceService))
         self.putChild("stream", SampleStreamer(deviceService))
+        self.putChild("spectrum", SpectrumResource(deviceService))
+        self.putChild("stats", StatsResource(deviceService))
+        self.putChild("metrics", MetricsResource(REGISTRY))
+        if recordings is None:
+            recordings = RecordingLibrary('.')
+        self.putChild("recordings", RecordingsResource(recordings))
         self.putChild("static", File(sibpath(__file__, "webpages")))
-        self.putChild("", File(os.path.join(sibpath(__file__, "webpages"), 'index.html')))
+        self.putChild("", File(_indexPath))
+        if registry is not None:
+            self.putChild("devices", DevicesResource(registry))
 
 
     def render_GET(self, request):
-        f = File(os.path.join(sibpath(__file__, "webpages"), 'index.html'))
+        f = File(_indexPath)
         return f.render_GET(request)
 
 
+
+class DevicesResource(Resource):
+    """
+    ``devices/``: a JSON listing of the devices, their throughput and
+    losses.
+
+    ``devices/stream`` carries the samples of all devices, and each device
+    has its own page, ``control``, ``stream``, ``spectrum`` and ``stats``
+    under ``devices/<id>/``.
+    """
+
+    def __init__(self, registry):
+        """
+        :type registry: txopenbci.control.DeviceRegistry
+        """
+        Resource.__init__(self)
+        self.registry = registry
+        self._deviceResources = {}
+        self.putChild("stream", MultiplexedStreamer(registry))
+
+
+    def getChild(self, path, request):
+        if path == '':
+            return self
+        try:
+            device = self.registry.getDevice(path)
+        except KeyError:
+            return NoResource("No device %s." % (path,))
+        resource = self._deviceResources.get(path)
+        if resource is None:
+            resource = self._deviceResources[path] = DeviceResource(device)
+        return resource
+
+
+    def render_GET(self, request):
+        request.setHeader('Content-type', 'application/json')
+        return _dumps(self.registry.stats())
+
+
+
+class DeviceResource(Resource):
+    """
+    The page, ``control``, ``stream``, ``spectrum``, ``stats`` and
+    ``static`` files of one device.
+    """
+
+    def __init__(self, deviceService):
+        """
+        :type deviceService: txopenbci.control.DeviceService
+        """
+        Resource.__init__(self)
+        self.putChild("control", CommandResource(deviceService))
+        self.putChild("stream", SampleStreamer(deviceService))
+        self.putChild("spectrum", SpectrumResource(deviceService))
+        self.putChild("stats", StatsResource(deviceService))
+        self.putChild("static", File(sibpath(__file__, "webpages")))
+        self.putChild("", File(_indexPath))
+
+
+    def render_GET(self, request):
+        # the page uses relative links, so it has to be served from "<id>/".
+        return redirectTo(request.path + '/', request)
+
+
+class StatsResource(Resource):
+    """
+    ``stats``: how many samples a device has sent, how many were lost, and
+    how its connection has fared, as JSON. See
+    `txopenbci.control.DeviceReceiver.stats` and
+    `txopenbci.control.DeviceService.stats`.
+    """
+    isLeaf = True
+
+    def __init__(self, deviceService):
+        """
+        :type deviceService: txopenbci.control.DeviceService
+        """
+        Resource.__init__(self)
+        self.deviceService = deviceService
+        self.receiver = deviceService.commander.receiver
+
+
+    def render_GET(self, request):
+        request.setHeader('Content-type', 'application/json')
+        stats = self.receiver.stats()
+        stats.update(self.deviceService.stats())
+        return _dumps(stats)
+
+
+
+class MetricsResource(Resource):
+    """
+    ``metrics``: the counters, gauges and histograms of a
+    `txopenbci.metrics.Registry`, in the Prometheus text format.
+    """
+    isLeaf = True
+
+    def __init__(self, registry):
+        """
+        :type registry: txopenbci.metrics.Registry
+        """
+        Resource.__init__(self)
+        self.registry = registry
+
+
+    def render_GET(self, request):
+        request.setHeader('Content-type', 'text/plain; version=0.0.4')
+        return self.registry.exposition()
+
+
+
+class RecordingsResource(Resource):
+    """
+    ``recordings/``: a JSON listing of the recordings on disk.
+
+    ``recordings/<name>`` describes a recording, and
+    ``recordings/<name>/data`` gives a slice of it. Query arguments:
+
+    * ``by``: ``time`` (the default) for ``start`` and ``stop`` in seconds
+      since the recording began, or ``index`` for sample numbers.
+    * ``start``, ``stop``: (optional) where the slice begins and ends.
+    * ``channels``: (optional) comma-separated EEG channels, from 0.
+    * ``buckets``: (optional) reduce the slice to this many buckets, each
+      with the minimum, maximum and mean of the samples in it.
+
+    See `txopenbci.history.RecordingLibrary.query` for the result. Without
+    ``buckets``, slices of more than ``maxSamples`` are refused, as are more
+    than ``maxSamples`` buckets. Buckets of a recording without summaries
+    are made from its samples, and slices of more than ``maxRead`` of
+    those are refused.
+    """
+
+    maxSamples = protocol.SAMPLE_RATE * 60 * 5
+    maxRead = protocol.SAMPLE_RATE * 60 * 30
+
+    def __init__(self, library):
+        """
+        :type library: txopenbci.history.RecordingLibrary
+        """
+        Resource.__init__(self)
+        self.library = library
+
+
+    def getChild(self, path, request):
+        if path == '':
+            return self
+        return _RecordingResource(self, path)
+
+
+    def render_GET(self, request):
+        request.setHeader('Content-type', 'application/json')
+        return _dumps(self.library.list())
+
+
+
+class _RecordingResource(Resource):
+    isLeaf = True
+
+    def __init__(self, recordings, name):
+        Resource.__init__(self)
+        self.library = recordings.library
+        self.maxSamples = recordings.maxSamples
+        self.maxRead = recordings.maxRead
+        self.name = name
+
+
+    def render_GET(self, request):
+        try:
+            self.library.open(self.name)
+        except KeyError:
+            request.setResponseCode(NOT_FOUND)
+            return 'No recording %s.' % (self.name,)
+        if request.postpath in ([], ['']):
+            request.setHeader('Content-type', 'application/json')
+            return _dumps(self.library.info(self.name))
+        if request.postpath != ['data']:
+            request.setResponseCode(NOT_FOUND)
+            return 'No such resource.'
+
+        args = request.args
+        byTime = args.get('by', ['time'])[0]
+        if byTime not in ('time', 'index'):
+            request.setResponseCode(BAD_REQUEST)
+            return 'Unknown "by" %s.' % (byTime,)
+        byTime = byTime == 'time'
+        try:
+            start, stop = [
+                (float if byTime else int)(args[name][0])
+                if name in args else None for name in ('start', 'stop')]
+            channels = None
+            if 'channels' in args:
+                channels = [int(channel)
+                            for channel in args['channels'][0].split(',')]
+                if not all(0 <= channel < 8 for channel in channels):
+                    raise ValueError(channels)
+            buckets = int(args['buckets'][0]) if 'buckets' in args else None
+            if buckets is not None and buckets < 1:
+                raise ValueError(buckets)
+        except ValueError:
+            request.setResponseCode(BAD_REQUEST)
+            return 'Bad start, stop, channels or buckets.'
+
+        try:
+            result = self.library.query(self.name, start, stop, byTime,
+                                        channels, buckets, self.maxSamples,
+                                        self.maxRead)
+        except ValueError as e:
+            request.setResponseCode(BAD_REQUEST)
+            return str(e)
+        request.setHeader('Content-type', 'application/json')
+        return _dumps(result)
+
+
+
 class CommandResource(Resource):
     isLeaf = True
 
@@ -76,56 +320,617 @@ class CommandResource(Resource):
 
 
 
+@implementer(IPushProducer)
+class EventSubscriber(object):
+    """
+    One request in an EventFanOut, with its queue of unsent messages.
+
+    This is registered as the request's producer, so the transport tells us
+    when the client isn't keeping up and we stop writing to it. Meanwhile its
+    messages queue up, to no more than ``maxQueuedBytes``; past that, some
+    are dropped according to the fan-out's policy.
+
+    :ivar dropped: how many messages this client never got.
+    :ivar sentBytes: how much has been written to this client.
+    """
+
+    def __init__(self, fanOut, request):
+        self.fanOut = fanOut
+        self.request = request
+        self.paused = False
+        self.queue = deque()
+        self.queuedBytes = 0
+        self.dropped = 0
+        self.sentBytes = 0
+
+
+    def enqueue(self, s):
+        self.queue.append(s)
+        self.queuedBytes += len(s)
+        if self.queuedBytes > self.fanOut.maxQueuedBytes:
+            if self.fanOut.policy == 'decimate':
+                self._decimate()
+            while self.queuedBytes > self.fanOut.maxQueuedBytes:
+                self._dropOldest()
+
+
+    def _dropOldest(self):
+        self.queuedBytes -= len(self.queue.popleft())
+        self.dropped += 1
+        self.fanOut.droppedCounter.inc()
+
+
+    def _decimate(self):
+        """Throw out every other queued message, oldest first."""
+        kept = deque()
+        for i, s in enumerate(self.queue):
+            if i % 2 == 0 and i != len(self.queue) - 1:
+                self.queuedBytes -= len(s)
+                self.dropped += 1
+                self.fanOut.droppedCounter.inc()
+            else:
+                kept.append(s)
+        self.queue = kept
+
+
+    def flush(self):
+        if self.paused or not self.queue:
+            return
+        data = ''.join(self.queue)
+        self.queue.clear()
+        self.queuedBytes = 0
+        self.sentBytes += len(data)
+        self.fanOut.sentCounter.inc(len(data))
+        self.request.write(data)
+
+
+    # == IPushProducer ==
+
+    def pauseProducing(self):
+        self.paused = True
+
+
+    def resumeProducing(self):
+        self.paused = False
+        self.fanOut.scheduleFlush()
+
+
+    def stopProducing(self):
+        self.fanOut.remove(self.request)
+
+
+
+class EventFanOut(object):
+    """
+    A group of requests that all get the same Server-Sent Events.
+
+    Messages are encoded once by the caller and queued for each subscriber.
+    Everything queued in one reactor turn goes out in a single write per
+    subscriber. See `EventSubscriber` for what happens to slow clients.
+
+    :ivar policy: what to drop when a client's queue is full: ``'oldest'``
+        messages, or ``'decimate'`` to throw out every other one first.
+    :ivar dropped: messages dropped for subscribers who have since gone.
+    :ivar sentCounter: the `txopenbci.metrics.Counter` of bytes written to
+        all subscribers, shared by every fan-out with the same metrics.
+    :ivar droppedCounter: likewise, of messages dropped.
+    """
+
+    maxQueuedBytes = 1024 * 1024
+    policy = 'oldest'
+    clock = None
+
+    def __init__(self, maxQueuedBytes=None, policy=None, metrics=None):
+        """
+        :param metrics: (optional) the `txopenbci.metrics.Registry` to count
+            subscribers, bytes sent and messages dropped in; by default, the
+            global one.
+        """
+        if maxQueuedBytes is not None:
+            self.maxQueuedBytes = maxQueuedBytes
+        if policy is not None:
+            self.policy = policy
+        if metrics is None:
+            metrics = REGISTRY
+        self.subscribers = {}
+        self.dropped = 0
+        self._flushCall = None
+        self._subscribersGauge = metrics.gauge(
+            'txopenbci_stream_subscribers', "Clients subscribed to streams.")
+        self.sentCounter = metrics.counter(
+            'txopenbci_stream_sent_bytes_total', "Bytes sent to stream "
+            "clients.")
+        self.droppedCounter = metrics.counter(
+            'txopenbci_stream_dropped_messages_total', "Messages dropped "
+            "because a stream client couldn't keep up.")
+
+
+    def __len__(self):
+        return len(self.subscribers)
+
+
+    def add(self, request):
+        # send an initial message so the client knows we're really here even
+        # if there's not currently data streaming.
+        request.write(sseMsg('hello', 'keepalive'))
+
+        subscriber = EventSubscriber(self, request)
+        self.subscribers[request] = subscriber
+        self._subscribersGauge.inc()
+        request.registerProducer(subscriber, True)
+        request.notifyFinish().addBoth(lambda _: self.remove(request))
+        return subscriber
+
+
+    def remove(self, request):
+        subscriber = self.subscribers.pop(request, None)
+        if subscriber is not None:
+            self.dropped += subscriber.dropped
+            self._subscribersGauge.dec()
+
+
+    def broadcast(self, s):
+        if not self.subscribers:
+            return
+        for subscriber in self.subscribers.values():
+            subscriber.enqueue(s)
+        self.scheduleFlush()
+
+
+    def scheduleFlush(self):
+        if self._flushCall is None:
+            clock = self.clock
+            if clock is None:
+                from twisted.internet import reactor as clock
+            self._flushCall = clock.callLater(0, self.flush)
+
+
+    def flush(self):
+        self._flushCall = None
+        self.prune()
+        for subscriber in self.subscribers.values():
+            subscriber.flush()
+
+
+    def prune(self):
+        """Forget subscribers who have gone away."""
+        for request in list(self.subscribers):
+            if request.transport.disconnected:
+                self.remove(request)
+
+
+    def stats(self):
+        """
+        :returns: a list with a dict of ``sentBytes``, ``queuedBytes``,
+            ``dropped`` and ``paused`` for each subscriber.
+        """
+        return [{
+            'sentBytes': subscriber.sentBytes,
+            'queuedBytes': subscriber.queuedBytes,
+            'dropped': subscriber.dropped,
+            'paused': subscriber.paused,
+        } for subscriber in self.subscribers.values()]
+
+
+
+class _EventStreamer(Resource):
+    """
+    Send Server-Sent Events to everyone who GETs this resource.
+    """
+
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.fanOut = EventFanOut()
+
+
+    @property
+    def subscribers(self):
+        return self.fanOut.subscribers
+
+
+    def _broadcast(self, s):
+        self.fanOut.broadcast(s)
+
+
+    def render_GET(self, request):
+        request.setHeader('Content-type', 'text/event-stream')
+        self.fanOut.add(request)
+        return NOT_DONE_YET
+
+    # todo: render_HEAD
+
+
+
+class _Feed(object):
+    """
+    Samples from a source, encoded once for everyone subscribed to the feed.
+
+    The feed only listens to its source while it has subscribers.
+
+    :ivar onIdle: (optional) called when the last subscriber has gone and
+        the feed stops listening.
+    """
+
+    onIdle = None
+
+    def __init__(self, source, clock, metrics=None):
+        """
+        :param source: a DeviceReceiver, or something with the same
+            subscribeToSampleBlocks and unsubscribeFromSampleBlocks.
+        :param metrics: (optional) for the `EventFanOut`.
+        """
+        self.source = source
+        self.clock = clock
+        self.fanOut = EventFanOut(metrics=metrics)
+        self.fanOut.clock = clock
+        self.listening = False
+
+
+    def add(self, request):
+        if not self.listening:
+            self.listening = True
+            self.source.subscribeToSampleBlocks(self.handleBlock)
+        self.fanOut.add(request)
+        request.notifyFinish().addBoth(self._requestFinished)
+
+
+    def _requestFinished(self, ignored):
+        if not self.fanOut:
+            self._stopListening()
+
+
+    def _stopListening(self):
+        if not self.listening:
+            return
+        self.listening = False
+        self.source.unsubscribeFromSampleBlocks(self.handleBlock)
+        if self.onIdle is not None:
+            self.onIdle()
+
+
+
+class JSONFeed(_Feed):
+    """Each sample as a JSON ``sensorData`` event."""
+
+    def handleBlock(self, block):
+        """
+        :type block: txopenbci.ring.SampleBlock
+        """
+        if not self.fanOut:
+            self._stopListening()
+            return
+
+        self.fanOut.broadcast(''.join([
+            sseMsg([sample.counter, sample.eeg, sample.accelerometer],
+                   "sensorData")
+            for sample in block.samples()]))
+
+
+
+class BinaryBlockFeed(_Feed):
+    """
+    Batches of samples, ``fps`` times a second, packed with `wire.packBlocks`
+    and sent as base64 ``sensorBlock`` events.
+    """
+
+    def __init__(self, source, clock, fps, metrics=None):
+        _Feed.__init__(self, source, clock, metrics)
+        self.fps = fps
+        self._pending = []
+        self._loop = LoopingCall(self.sendFrame)
+        self._loop.clock = clock
+
+
+    def add(self, request):
+        if not self._loop.running:
+            self._loop.start(1.0 / self.fps, now=False)
+        _Feed.add(self, request)
+
+
+    def handleBlock(self, block):
+        """
+        :type block: txopenbci.ring.SampleBlock
+        """
+        self._pending.append(block.copy())
+
+
+    def sendFrame(self):
+        if self._pending:
+            self.fanOut.broadcast(
+                'event: sensorBlock\ndata: %s\n\n' %
+                (base64.b64encode(wire.packBlocks(self._pending)),))
+            self._pending = []
+        else:
+            self.fanOut.prune()
+        if not self.fanOut:
+            self._stopListening()
+
+
+    def _stopListening(self):
+        if self._loop.running:
+            self._loop.stop()
+        self._pending = []
+        _Feed._stopListening(self)
+
+
+
 class SampleStreamer(Resource):
+    """
+    The device's samples as Server-Sent Events.
+
+    Query arguments:
+
+    * ``format``: ``json`` (the default) for a ``sensorData`` event per
+      sample, or ``binary`` for ``sensorBlock`` events carrying a batch of
+      samples each. See `BinaryBlockFeed`.
+    * ``fps``: how many ``sensorBlock`` events to send a second (default 10).
+    * ``rate``: samples per second to send, if lower than the device's. See
+      `txopenbci.dsp.Downsampler` for how.
+    * ``mode``: ``decimate`` (the default), ``mean`` or ``minmax``.
+    * ``filtered``: if ``1``, EEG in microvolts, run through the filters
+      from ``makeFilters`` (`txopenbci.dsp.defaultFilters` unless set).
+      Filtered samples are floating point, so only come as ``json``.
+
+    Each distinct set of arguments gets one feed, and each distinct
+    rate and mode one downsampler, shared by all who ask for it. Likewise
+    the filters run once, however many clients want filtered samples. Feeds
+    and downsamplers are forgotten once no one is listening to them.
+    """
 
     isLeaf = True
 
+    clock = None
+    defaultFPS = 10
+    maxFPS = 60
+    minRate = 0.1
+    makeFilters = None
+
     def __init__(self, deviceService):
         """
         :type deviceService: txopenbci.control.DeviceService
         """
         Resource.__init__(self)
         self.deviceService = deviceService
-        self.subscribers = set()
-        self.deviceService.commander.receiver.subscribeToSampleData(
-            self.handleSample)
+        self.feeds = {}
+        self.sources = {}
+
+
+    def _getSource(self, filtered, factor, mode):
+        source = self.sources.get((filtered, factor, mode))
+        if source is not None:
+            return source
+        if factor != 1:
+            source = dsp.DownsampledSource(
+                self._getSource(filtered, 1, 'decimate'), factor, mode)
+        elif filtered:
+            source = dsp.FilteredSource(self._getSource(False, 1, 'decimate'),
+                                        self.makeFilters)
+        else:
+            source = self.deviceService.commander.receiver
+        self.sources[filtered, factor, mode] = source
+        return source
+
+
+    def _getFeed(self, streamFormat, fps, filtered, factor, mode):
+        key = (streamFormat, fps, filtered, factor, mode)
+        feed = self.feeds.get(key)
+        if feed is None:
+            clock = self.clock
+            if clock is None:
+                from twisted.internet import reactor as clock
+            source = self._getSource(filtered, factor, mode)
+            metrics = self.deviceService.metrics
+            if streamFormat == 'binary':
+                feed = BinaryBlockFeed(source, clock, fps, metrics)
+            else:
+                feed = JSONFeed(source, clock, metrics)
+            feed.onIdle = lambda: self._dropFeed(key, feed)
+            self.feeds[key] = feed
+        return feed
 
 
-    def handleSample(self, sample):
+    def _dropFeed(self, key, feed):
         """
-        :type sample: txopenbci.control.RawSample
+        Forget a feed with no subscribers, and the sources no other feed
+        needs, so that every rate anyone once asked for isn't kept forever.
         """
-        if not self.subscribers:
-            return
+        if self.feeds.get(key) is feed:
+            del self.feeds[key]
+        receiver = self.deviceService.commander.receiver
+        needed = set([receiver])
+        for source in [other.source for other in self.feeds.values()]:
+            # each downsampler or filter, back to the receiver.
+            while source is not receiver:
+                needed.add(source)
+                source = source.receiver
+        for sourceKey, source in self.sources.items():
+            if source not in needed:
+                del self.sources[sourceKey]
 
-        s = sseMsg([sample.counter, sample.eeg, sample.accelerometer],
-                   "sensorData")
 
-        dropouts = []
+    def render_GET(self, request):
+        args = request.args
+        streamFormat = args.get('format', ['json'])[0]
+        if streamFormat not in ('json', 'binary'):
+            request.setResponseCode(BAD_REQUEST)
+            return 'Unknown format %s.' % (streamFormat,)
+
+        mode = args.get('mode', ['decimate'])[0]
+        if mode not in dsp.DOWNSAMPLE_MODES:
+            request.setResponseCode(BAD_REQUEST)
+            return 'Unknown mode %s.' % (mode,)
+
+        factor = 1
+        if 'rate' in args:
+            try:
+                rate = max(self.minRate, float(args['rate'][0]))
+            except ValueError:
+                request.setResponseCode(BAD_REQUEST)
+                return 'Bad rate %s.' % (args['rate'][0],)
+            factor = max(1, int(round(protocol.SAMPLE_RATE / rate)))
+        if factor == 1:
+            mode = 'decimate'
+
+        filtered = args.get('filtered', ['0'])[0] == '1'
+        if filtered and streamFormat == 'binary':
+            request.setResponseCode(BAD_REQUEST)
+            return 'Filtered samples are only available as json.'
+
+        fps = None
+        if streamFormat == 'binary':
+            try:
+                fps = int(args.get('fps', [self.defaultFPS])[0])
+            except ValueError:
+                fps = self.defaultFPS
+            fps = max(1, min(self.maxFPS, fps))
 
-        for subscriber in self.subscribers:
-            if not subscriber.transport.disconnected:
-                subscriber.write(s)
-            else:
-                # can't change subscribers while we're iterating over it
-                dropouts.append(subscriber)
+        request.setHeader('Content-type', 'text/event-stream')
+        self._getFeed(streamFormat, fps, filtered, factor, mode).add(request)
+        return NOT_DONE_YET
 
-        for dropout in dropouts:
-            self.subscribers.remove(dropout)
+
+
+class SpectrumResource(Resource):
+    """
+    ``spectrum``: the latest band powers and spectra of each channel, as
+    JSON. See `txopenbci.spectral.SpectralEngine`.
+
+    ``spectrum/stream`` sends the same as ``spectrum`` events, as each is
+    worked out.
+
+    The device's spectra are only worked out while there are stream
+    clients, or for a while after each snapshot; so the first snapshot
+    after a quiet spell has no ``latest`` yet.
+    """
+
+    def __init__(self, deviceService, spectra=None):
+        """
+        :type deviceService: txopenbci.control.DeviceService
+        :param spectra: (optional) the `txopenbci.spectral.SpectralSource`
+            to serve; by default, the device's own.
+        """
+        Resource.__init__(self)
+        if spectra is None:
+            spectra = deviceService.spectra
+        self.spectra = spectra
+        self.putChild("stream", SpectrumStreamer(spectra))
+
+
+    def getChild(self, path, request):
+        if path == '':
+            return self
+        return Resource.getChild(self, path, request)
 
 
     def render_GET(self, request):
-        request.setHeader('Content-type', 'text/event-stream')
+        self.spectra.hold()
+        engine = self.spectra.engine
+        request.setHeader('Content-type', 'application/json')
+        return _dumps({
+            'sampleRate': engine.sampleRate,
+            'windowSize': engine.windowSize,
+            'hop': engine.hop,
+            'frequencies': engine.frequencies,
+            'bandEdges': dict((name, [low, high])
+                              for name, low, high in engine.bands),
+            'latest': engine.latest,
+        })
+
+
+
+class SpectrumStreamer(_EventStreamer):
+    """
+    Each result of a SpectralSource, as a ``spectrum`` event.
 
-        # send an initial message so the client knows we're really here even
-        # if there's not currently data streaming.
-        request.write(sseMsg('hello', 'keepalive'))
+    With ``?spectrum=0``, the events carry only the band powers, for
+    clients who don't draw spectra and would rather not get them.
+
+    The streamer only listens to the source while it has subscribers.
+    """
+
+    def __init__(self, spectra):
+        """
+        :type spectra: txopenbci.spectral.SpectralSource
+        """
+        _EventStreamer.__init__(self)
+        self.spectra = spectra
+        self.bandsFanOut = EventFanOut()
+        self.listening = False
+
+
+    def handleSpectrum(self, result):
+        if not (self.fanOut or self.bandsFanOut):
+            self._stopListening()
+            return
+        if self.fanOut:
+            self.fanOut.broadcast(sseMsg(result, "spectrum"))
+        if self.bandsFanOut:
+            self.bandsFanOut.broadcast(sseMsg(
+                {'counter': result['counter'], 'bands': result['bands']},
+                "spectrum"))
 
-        self.subscribers.add(request)
 
+    def render_GET(self, request):
+        request.setHeader('Content-type', 'text/event-stream')
+        if request.args.get('spectrum', ['1'])[0] == '0':
+            self.bandsFanOut.add(request)
+        else:
+            self.fanOut.add(request)
+        if not self.listening:
+            self.listening = True
+            self.spectra.subscribeToSpectra(self.handleSpectrum)
+        request.notifyFinish().addBoth(self._requestFinished)
         return NOT_DONE_YET
 
-    # todo: render_HEAD
+
+    def _requestFinished(self, ignored):
+        if not (self.fanOut or self.bandsFanOut):
+            self._stopListening()
+
+
+    def _stopListening(self):
+        if self.listening:
+            self.listening = False
+            self.spectra.unsubscribeFromSpectra(self.handleSpectrum)
+
+
+
+class MultiplexedStreamer(_EventStreamer):
+    """
+    The samples of every device in a registry, as ``deviceSensorData``
+    events that start with the device ID.
+    """
+
+    def __init__(self, registry):
+        """
+        :type registry: txopenbci.control.DeviceRegistry
+        """
+        _EventStreamer.__init__(self)
+        self.registry = registry
+        registry.subscribeToDevices(self._addDevice)
+
+
+    def _addDevice(self, deviceId, deviceService):
+        def handleBlock(block):
+            self.handleBlock(deviceId, block)
+        deviceService.commander.receiver.subscribeToSampleBlocks(handleBlock)
+
+
+    def handleBlock(self, deviceId, block):
+        """
+        :type block: txopenbci.ring.SampleBlock
+        """
+        if not self.subscribers:
+            return
+
+        self._broadcast(''.join([
+            sseMsg([deviceId, sample.counter, sample.eeg,
+                    sample.accelerometer],
+                   "deviceSensorData")
+            for sample in block.samples()]))
+
 
 
 def sseMsg(data, name=None):
@@ -3,14 +3,10 @@ txopenbci = (function () {
     var xport = {};
     var $eeg, $accel;
     var ACCEL_MAX = 0x7FFF;
+    var EEG_CHANNELS = 8, ACCEL_AXES = 3;
 
-    var handleSample = function handleSample(jsonmsg) {
-        var counter, eeg, accel;
-        var msg = $.parseJSON(jsonmsg.data);
+    var showSample = function showSample(counter, eeg, accel) {
         var hue, sat, lum;
-        counter = msg[0];
-        eeg = msg[1];
-        accel = msg[2];
 
         $eeg.text(eeg);
 
@@ -19,15 +15,62 @@ txopenbci = (function () {
         lum = Math.floor(100 * (accel[1] / ACCEL_MAX / 3) + 65);
         $accel.css('background',
                    'hsl(' + hue + ',' + sat + '%,' + lum + '%)');
-    }
+    };
+
+    var handleSample = function handleSample(jsonmsg) {
+        var msg = $.parseJSON(jsonmsg.data);
+        showSample(msg[0], msg[1], msg[2]);
+    };
+
+    // Decode a block in the format of txopenbci.wire.packBlocks:
+    //   uint32 count, int32 eeg[count][8], int16 accel[count][3],
+    //   uint8 counter[count], all little-endian.
+    var decodeBlock = function decodeBlock(b64) {
+        var raw = atob(b64);
+        var bytes = new Uint8Array(raw.length);
+        var i, offset, count;
+        for (i = 0; i < raw.length; i++) {
+            bytes[i] = raw.charCodeAt(i);
+        }
+        count = new DataView(bytes.buffer).getUint32(0, true);
+        offset = 4;
+        var eeg = new Int32Array(bytes.buffer, offset, count * EEG_CHANNELS);
+        offset += eeg.byteLength;
+        var accel = new Int16Array(bytes.buffer, offset, count * ACCEL_AXES);
+        offset += accel.byteLength;
+        var counter = new Uint8Array(bytes.buffer, offset, count);
+        return {count: count, eeg: eeg, accel: accel, counter: counter};
+    };
+
+    var handleBlock = function handleBlock(msg) {
+        var block = decodeBlock(msg.data);
+        var last = block.count - 1;
+        if (last < 0) {
+            return;
+        }
+        // Only the newest sample is shown; a plot would use the whole block.
+        showSample(
+            block.counter[last],
+            Array.prototype.slice.call(
+                block.eeg.subarray(last * EEG_CHANNELS,
+                                   (last + 1) * EEG_CHANNELS)),
+            block.accel.subarray(last * ACCEL_AXES, (last + 1) * ACCEL_AXES));
+    };
 
     var main = function main() {
         $eeg = $("#eeg");
         $accel = $("#accel");
-        xport.source = new EventSource("stream");
+        // Binary blocks unless the page was loaded with ?format=json
+        if (/[?&]format=json/.test(window.location.search)) {
+            xport.source = new EventSource("stream");
+        } else {
+            xport.source = new EventSource("stream?format=binary&fps=10");
+        }
         xport.source.addEventListener("sensorData", handleSample);
-    }
+        xport.source.addEventListener("sensorBlock", handleBlock);
+    };
 
+    xport.decodeBlock = decodeBlock;
     xport.main = main;
     return xport;
 })();
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+A compact binary encoding of sample blocks, for streaming to clients.
+
+All values are little-endian, and laid out so a browser can view each part
+with a typed array without copying::
+
+    uint32  count
+    int32   eeg[count][8]
+    int16   accelerometer[count][3]
+    uint8   counter[count]
+"""
+from array import array
+from struct import Struct
+import sys
+
+try:
+    import numpy
+except ImportError as e:
+    numpy = None
+    numpy_reason = e
+else:
+    numpy_reason = None
+
+from .ring import SampleBlock, EEG_CHANNELS, ACCELEROMETER_AXES
+
+
+_countStruct = Struct('<I')
+_bigEndian = sys.byteorder == 'big'
+# array's fromstring and tostring are frombytes and tobytes in Python 3.
+_arrayFromBytes = getattr(array, 'frombytes', None) or array.fromstring
+_arrayToBytes = getattr(array, 'tobytes', None) or array.tostring
+
+
+def numpy_packBlocks(blocks):
+    """
+    Encode the samples of several SampleBlocks as one.
+
+    :rtype: bytes
+    """
+    count = sum(len(block) for block in blocks)
+    parts = [_countStruct.pack(count)]
+    for field, dtype in [('eeg', '<i4'), ('accelerometer', '<i2'),
+                         ('counter', 'u1')]:
+        for block in blocks:
+            parts.append(
+                numpy.asarray(getattr(block, field), dtype).tobytes())
+    return b''.join(parts)
+
+
+def numpy_unpackBlock(data):
+    """
+    Decode the output of packBlocks.
+
+    :rtype: SampleBlock
+    """
+    (count,) = _countStruct.unpack_from(data)
+    offset = _countStruct.size
+    eeg = numpy.frombuffer(data, '<i4', count * EEG_CHANNELS, offset)
+    offset += eeg.nbytes
+    accelerometer = numpy.frombuffer(data, '<i2', count * ACCELEROMETER_AXES,
+                                     offset)
+    offset += accelerometer.nbytes
+    counter = numpy.frombuffer(data, 'u1', count, offset)
+    return SampleBlock(counter,
+                       eeg.reshape(count, EEG_CHANNELS).astype('i4'),
+                       accelerometer.reshape(count, ACCELEROMETER_AXES)
+                       .astype('i2'))
+
+
+def _packArray(typecode, rows):
+    packed = array(typecode)
+    for row in rows:
+        packed.fromlist(list(row))
+    if _bigEndian:
+        packed.byteswap()
+    return _arrayToBytes(packed)
+
+
+def python_packBlocks(blocks):
+    """
+    Encode the samples of several SampleBlocks as one.
+
+    :rtype: bytes
+    """
+    count = sum(len(block) for block in blocks)
+    return b''.join(
+        [_countStruct.pack(count),
+         _packArray('i', [row for block in blocks for row in block.eeg]),
+         _packArray('h', [row for block in blocks
+                          for row in block.accelerometer]),
+         _packArray('B', [block.counter for block in blocks])])
+
+
+def _unpackArray(typecode, data, offset, count):
+    unpacked = array(typecode)
+    end = offset + count * unpacked.itemsize
+    _arrayFromBytes(unpacked, data[offset:end])
+    if _bigEndian:
+        unpacked.byteswap()
+    return unpacked, end
+
+
+def python_unpackBlock(data):
+    """
+    Decode the output of packBlocks.
+
+    :rtype: SampleBlock
+    """
+    (count,) = _countStruct.unpack_from(data)
+    offset = _countStruct.size
+    eeg, offset = _unpackArray('i', data, offset, count * EEG_CHANNELS)
+    accelerometer, offset = _unpackArray('h', data, offset,
+                                         count * ACCELEROMETER_AXES)
+    counter, offset = _unpackArray('B', data, offset, count)
+    return SampleBlock(
+        counter,
+        [eeg[i * EEG_CHANNELS:(i + 1) * EEG_CHANNELS] for i in range(count)],
+        [accelerometer[i * ACCELEROMETER_AXES:(i + 1) * ACCELEROMETER_AXES]
+         for i in range(count)])
+
+
+if numpy:
+    packBlocks = numpy_packBlocks
+    unpackBlock = numpy_unpackBlock
+else:
+    packBlocks = python_packBlocks
+    unpackBlock = python_unpackBlock